@@ -0,0 +1,44 @@
+"""
+Scaling of batch overlap with the number of field polygons, in one process and on all cores
+Run from repository root: python -m benchmarks.batch_overlap
+"""
+import os
+import time
+import random
+import tempfile
+
+import geopandas as gp
+
+from shapely.geometry import box
+
+from sentinel2download.overlap import Sentinel2BatchOverlap
+from benchmarks.overlap import synthetic_grid
+
+
+def synthetic_fields(number, seed=0) -> gp.GeoDataFrame:
+    # fields of 1 - 100 ha scattered over Europe
+    generator = random.Random(seed)
+    geometries = list()
+    for _ in range(number):
+        longitude, latitude = generator.uniform(-5, 35), generator.uniform(40, 65)
+        size = generator.uniform(0.001, 0.01)
+        geometries.append(box(longitude, latitude, longitude + size * 1.5, latitude + size))
+    return gp.GeoDataFrame(geometry=geometries, crs="epsg:4326")
+
+
+if __name__ == '__main__':
+    cores = os.cpu_count()
+    with tempfile.TemporaryDirectory() as directory:
+        grid_path = os.path.join(directory, 'grid.geojson')
+        synthetic_grid().to_file(grid_path, driver='GeoJSON')
+        # grid cache is built outside of measurements
+        Sentinel2BatchOverlap(synthetic_fields(1), grid_path=grid_path).overlap()
+
+        for number in (1000, 10000, 50000):
+            overlap = Sentinel2BatchOverlap(synthetic_fields(number), grid_path=grid_path)
+            for workers in sorted({1, cores}):
+                start_time = time.time()
+                result = overlap.overlap(cores=workers)
+                elapsed = time.time() - start_time
+                print(f"{number:6d} fields, {workers:2d} cores: {len(result.tiles):4d} unique tiles, "
+                      f"{elapsed:.3f}s, {elapsed / number * 1e6:.0f}us per field")
@@ -0,0 +1,87 @@
+"""
+Sequential and parallel conversion with a fake sen2cor, including a hung and an out of memory job
+and products of legacy naming convention
+Run from repository root: python -m benchmarks.conversion
+"""
+import os
+import time
+import tempfile
+
+from sentinel2preprocessing.conversion import Sentinel2Converter
+
+FAKE_SEN2COR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fake_sen2cor.py')
+
+# product named before December 2016, its metadata file is named after the product
+LEGACY_PRODUCT = 'S2A_OPER_PRD_MSIL1C_PDMC_20160109T154620_R021_V20160108T085317_20160108T085317.SAFE'
+
+
+def fake_products(input_dir, number):
+    names = list()
+    for index in range(number):
+        name = f"S2A_MSIL1C_202012{index + 1:02d}T084801_N0209_R107_T36UYA_202012{index + 1:02d}T094101.SAFE"
+        os.makedirs(os.path.join(input_dir, name))
+        with open(os.path.join(input_dir, name, 'MTD_MSIL1C.xml'), 'w') as file:
+            file.write(f"<product>{name}</product>\n")
+        names.append(name)
+    return names
+
+
+def legacy_product(input_dir):
+    os.makedirs(os.path.join(input_dir, LEGACY_PRODUCT, 'GRANULE'))
+    metadata_name = LEGACY_PRODUCT.replace('_PRD_MSIL1C_', '_MTD_SAFL1C_').replace('.SAFE', '.xml')
+    with open(os.path.join(input_dir, LEGACY_PRODUCT, metadata_name), 'w') as file:
+        file.write(f"<product>{LEGACY_PRODUCT}</product>\n")
+    return LEGACY_PRODUCT
+
+
+def run(products, workers, **kwargs):
+    with tempfile.TemporaryDirectory() as input_dir, tempfile.TemporaryDirectory() as output_dir:
+        fake_products(input_dir, products)
+        converter = Sentinel2Converter(verbose=False)
+        start_time = time.time()
+        results = converter.convert(input_dir, output_dir, FAKE_SEN2COR, workers=workers, **kwargs)
+        return results, time.time() - start_time
+
+
+def run_legacy():
+    # a legacy product is converted along with compact named ones and skipped by a rerun
+    with tempfile.TemporaryDirectory() as input_dir, tempfile.TemporaryDirectory() as output_dir:
+        fake_products(input_dir, 2)
+        legacy_product(input_dir)
+        converter = Sentinel2Converter(verbose=False)
+        results = converter.convert(input_dir, output_dir, FAKE_SEN2COR, workers=2)
+        assert len(results) == 3 and not results.failed, results.results
+        rerun = converter.convert(input_dir, output_dir, FAKE_SEN2COR, workers=2)
+        assert all(result.skipped for result in rerun.results), rerun.results
+        return results, rerun
+
+
+if __name__ == '__main__':
+    os.environ['FAKE_SEN2COR_RUNTIME'] = '0.5'
+    os.environ['FAKE_SEN2COR_MEMORY'] = str(64 * 1024 * 1024)
+    for workers in (1, 4, 8):
+        results, elapsed = run(16, workers)
+        cpu_time = sum(result.cpu_time for result in results.results)
+        peak_rss = max(result.peak_rss for result in results.results)
+        print(f"{workers} workers: {len(results)} of {len(results.results)} converted in {elapsed:.2f}s, "
+              f"cpu {cpu_time:.2f}s, peak RSS {peak_rss / 2 ** 20:.0f} MB")
+    stages = results.results[0].stages
+    print("stages of the last product: " + ', '.join(f"{stage} {seconds:.2f}s" for stage, seconds in stages.items()))
+
+    # one job hangs and is killed
+    os.environ['FAKE_SEN2COR_HANG'] = '20201203'
+    results, elapsed = run(4, 4, timeout=3)
+    del os.environ['FAKE_SEN2COR_HANG']
+    # jobs exceed their memory limit
+    os.environ['FAKE_SEN2COR_MEMORY'] = str(512 * 1024 * 1024)
+    memory_results, memory_elapsed = run(2, 2, memory_limit=256 * 1024 * 1024)
+
+    for title, results, elapsed in (('timeout', results, elapsed), ('memory limit', memory_results, memory_elapsed)):
+        print(f"{title}: {len(results)} of {len(results.results)} converted in {elapsed:.2f}s")
+        for result in results.failed:
+            print(f"  {os.path.basename(result.input_path)}: returncode {result.returncode}, {result.error.strip()}")
+
+    os.environ['FAKE_SEN2COR_MEMORY'] = '0'
+    results, rerun = run_legacy()
+    print(f"legacy naming: {len(results)} of {len(results.results)} converted, "
+          f"{sum(result.skipped for result in rerun.results)} skipped by rerun")
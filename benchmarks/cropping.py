@@ -0,0 +1,67 @@
+"""
+Decoding a whole JP2 band against cropping an AOI window of it into a COG
+Run from repository root: python -m benchmarks.cropping
+"""
+import os
+import time
+import tempfile
+
+import numpy as np
+import geopandas as gp
+import rasterio
+
+from rasterio.transform import from_origin
+from shapely.geometry import Point
+
+from sentinel2preprocessing.cropping import Sentinel2Cropper
+
+PRODUCT = 'S2A_MSIL1C_20201001T084801_N0209_R107_T36UYA_20201001T094101.SAFE'
+
+
+def fake_product(input_dir, bands=('B05', 'B06', 'B07', 'B8A'), size=5490):
+    """
+    Product with synthetic 20 m bands of a full tile
+    """
+    image_dir = os.path.join(input_dir, PRODUCT, 'GRANULE', 'L1C_T36UYA_A027600_20201001T084801', 'IMG_DATA')
+    os.makedirs(image_dir)
+    data = (np.arange(size * size, dtype=np.uint32) % 4000).astype(np.uint16).reshape(1, size, size)
+    for band in bands:
+        with rasterio.open(os.path.join(image_dir, f"T36UYA_20201001T084801_{band}.jp2"), 'w',
+                           driver='JP2OpenJPEG', width=size, height=size, count=1, dtype='uint16',
+                           crs='EPSG:32636', transform=from_origin(600000, 5600040, 20, 20),
+                           QUALITY=100, REVERSIBLE='YES', BLOCKXSIZE=1024, BLOCKYSIZE=1024) as file:
+            file.write(data)
+    return os.path.join(input_dir, PRODUCT)
+
+
+def directory_size(path):
+    return sum(os.path.getsize(os.path.join(root, name)) for root, _, names in os.walk(path) for name in names)
+
+
+if __name__ == '__main__':
+    with tempfile.TemporaryDirectory() as input_dir, tempfile.TemporaryDirectory() as output_dir:
+        product_path = fake_product(input_dir)
+        band_paths = [os.path.join(root, name) for root, _, names in os.walk(product_path) for name in names]
+
+        start_time = time.time()
+        for band_path in band_paths:
+            with rasterio.open(band_path) as file:
+                file.read()
+        full_elapsed = time.time() - start_time
+        print(f"decode {len(band_paths)} full bands: {full_elapsed:.2f}s, {directory_size(product_path)} bytes")
+
+        for radius in (500, 2000, 10000):
+            aoi = gp.GeoDataFrame(geometry=[Point(650000, 5550000).buffer(radius)], crs='EPSG:32636')
+            cropper = Sentinel2Cropper(aoi.to_crs('epsg:4326'))
+            field_dir = os.path.join(output_dir, str(radius))
+            start_time = time.time()
+            results = cropper.crop(product_path, field_dir, mask=True)
+            crop_elapsed = time.time() - start_time
+
+            start_time = time.time()
+            for result in results:
+                with rasterio.open(result.output_path) as file:
+                    file.read()
+            read_elapsed = time.time() - start_time
+            print(f"field of {radius} m radius: crop {crop_elapsed:.2f}s, read COGs {read_elapsed:.3f}s, "
+                  f"{directory_size(field_dir)} bytes")
@@ -0,0 +1,50 @@
+"""
+Compare threads and async transfer engines on many small blobs served by a local HTTP stand-in of the bucket
+Run from repository root: python -m benchmarks.engines
+"""
+import time
+import tempfile
+
+from pathlib import Path
+from requests.adapters import HTTPAdapter
+from google.auth.credentials import AnonymousCredentials
+from google.cloud import storage
+
+from sentinel2download.aio import AsyncTransfer
+from sentinel2download.catalog import BlobInfo
+from sentinel2download.storage import GCSStorage
+from sentinel2download.transfer import ThreadTransfer
+from benchmarks.fake_bucket import FakeBucket
+from benchmarks.http_bucket import HTTPBucket
+
+
+def run(engine, blobs, output_dir):
+    start_time = time.time()
+    futures = list()
+    for blob in blobs:
+        save_path = Path(output_dir) / blob.name
+        save_path.parent.mkdir(parents=True, exist_ok=True)
+        futures.append(engine.submit(blob, save_path))
+    loaded = sum(1 for future in futures if future.result()[0])
+    engine.close()
+    return loaded, time.time() - start_time
+
+
+if __name__ == '__main__':
+    count = 5000
+    objects = {f"tiles/36/U/YA/QI_DATA/MSK_{index:05d}.gml": bytes(2048) for index in range(count)}
+    bucket = FakeBucket(objects)
+    blobs = [BlobInfo(name, len(data), None, None, None) for name, data in objects.items()]
+
+    with HTTPBucket(bucket) as http_bucket:
+        client = storage.Client(project='benchmark', credentials=AnonymousCredentials(),
+                                client_options={'api_endpoint': http_bucket.url})
+        client._http.mount('http://', HTTPAdapter(pool_connections=32, pool_maxsize=32))
+        backend = GCSStorage(client, bucket.name, check=False)
+        engines = (('threads x5', lambda: ThreadTransfer(backend, 5)),
+                   ('threads x32', lambda: ThreadTransfer(backend, 32)),
+                   ('async x200', lambda: AsyncTransfer(bucket.name, 200, base_url=http_bucket.url)), )
+        for name, create_engine in engines:
+            with tempfile.TemporaryDirectory() as output_dir:
+                loaded, elapsed = run(create_engine(), blobs, output_dir)
+            print(f"{name:>12}: {loaded} of {count} blobs in {elapsed:.2f}s, {loaded / elapsed:.0f} blobs/s")
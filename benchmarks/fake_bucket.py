@@ -0,0 +1,198 @@
+import time
+import base64
+import hashlib
+import threading
+import google_crc32c
+
+from datetime import datetime, timedelta
+
+PAGE_SIZE = 1000
+
+METADATA = ('<?xml version="1.0" encoding="UTF-8"?>'
+            '<n1:Level-1C_Tile_ID xmlns:n1="https://psd-14.sentinel2.eo.esa.int/PSD/S2_PDI_Level-1C_Tile_Metadata.xsd">'
+            '<n1:General_Info><TILE_ID>{name}</TILE_ID></n1:General_Info>'
+            '<n1:Geometric_Info>{angles}</n1:Geometric_Info>'
+            '<n1:Quality_Indicators_Info><Image_Content_QI>'
+            '<CLOUDY_PIXEL_PERCENTAGE>{cloudy}</CLOUDY_PIXEL_PERCENTAGE>'
+            '<NODATA_PIXEL_PERCENTAGE>{nodata}</NODATA_PIXEL_PERCENTAGE>'
+            '</Image_Content_QI></n1:Quality_Indicators_Info></n1:Level-1C_Tile_ID>')
+
+
+class FakeBlob:
+    def __init__(self, bucket, name, generation=None):
+        self.bucket = bucket
+        self.name = name
+        data = bucket.objects.get(name, b'')
+        self.size = len(data)
+        self.crc32c = base64.b64encode(google_crc32c.value(data).to_bytes(4, 'big')).decode()
+        self.md5_hash = base64.b64encode(hashlib.md5(data).digest()).decode()
+        self.generation = generation or 1
+
+    def download_as_string(self, start=None, end=None):
+        self.bucket.count('get')
+        data = self.bucket.objects[self.name]
+        return data[start or 0:None if end is None else end + 1]
+
+    def download_to_file(self, file, start=None, end=None):
+        file.write(self.download_as_string(start, end))
+
+
+class FakeBucket:
+    """
+    In-memory stand-in of gcp-public-data-sentinel-2 bucket that counts requests
+    """
+
+    def __init__(self, objects, *, latency: float = 0.0):
+        """
+        :param objects: dict, blob name to blob content
+        :param latency: float, seconds added to every request
+        """
+        self.name = 'gcp-public-data-sentinel-2'
+        self.objects = objects
+        self.names = sorted(objects)
+        self.latency = latency
+        self.requests = dict()
+        self._lock = threading.Lock()
+
+    def count(self, request):
+        with self._lock:
+            self.requests[request] = self.requests.get(request, 0) + 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def blob(self, name, generation=None):
+        return FakeBlob(self, name, generation)
+
+
+class _Page:
+    def __init__(self, items, prefixes):
+        self.items = items
+        self.prefixes = prefixes
+
+    def __iter__(self):
+        return iter(self.items)
+
+
+class _Iterator:
+    def __init__(self, bucket, names, prefix, delimiter):
+        self.bucket = bucket
+        self.names = names
+        self.prefix = prefix
+        self.delimiter = delimiter
+
+    @property
+    def pages(self):
+        entries = list()
+        for name in self.names:
+            rest = name[len(self.prefix):]
+            if self.delimiter and self.delimiter in rest:
+                entry = self.prefix + rest.split(self.delimiter)[0] + self.delimiter
+                if entries and entries[-1] == entry:
+                    continue
+            else:
+                entry = self.bucket.blob(name)
+            entries.append(entry)
+
+        for start in range(0, max(len(entries), 1), PAGE_SIZE):
+            self.bucket.count('list')
+            page = entries[start:start + PAGE_SIZE]
+            yield _Page([entry for entry in page if not isinstance(entry, str)],
+                        {entry for entry in page if isinstance(entry, str)})
+
+    def __iter__(self):
+        for page in self.pages:
+            yield from page
+
+
+class FakeClient:
+    """
+    Subset of storage.Client interface used by Sentinel2Downloader
+    """
+
+    def __init__(self, bucket: FakeBucket):
+        self._bucket = bucket
+
+    def bucket(self, name):
+        return self._bucket
+
+    def get_bucket(self, name):
+        self._bucket.count('get_bucket')
+        return self._bucket
+
+    def list_blobs(self, bucket, prefix='', delimiter=None, start_offset=None, end_offset=None):
+        names = [name for name in bucket.names if name.startswith(prefix)
+                 and (start_offset is None or name >= start_offset)
+                 and (end_offset is None or name < end_offset)]
+        return _Iterator(bucket, names, prefix, delimiter)
+
+
+# resolution folder of L2A bands, other bands are 60 m
+L2A_RESOLUTIONS = dict.fromkeys(('TCI', 'B02', 'B03', 'B04', 'B08'), 10)
+L2A_RESOLUTIONS.update(dict.fromkeys(('B05', 'B06', 'B07', 'B8A', 'B11', 'B12'), 20))
+
+
+def deep_archive(tiles=('36UYA',), *, years: int = 8, end_date: datetime = datetime(2020, 12, 31),
+                 revisit: int = 5, bands=('B02', 'B03', 'B04', 'B08', 'TCI'), band_size: int = 1024,
+                 product_type: str = 'L1C'):
+    """
+    Build bucket contents with products of two missions for every revisit day in the bucket layout:
+    tiles/ for L1C and L2/tiles/ for L2A products, GRANULE with MTD_TL.xml, IMG_DATA and QI_DATA,
+    empty _$folder$ markers of directories
+    :return: dict, blob name to blob content
+    """
+    objects = dict()
+    days = years * 365
+    level = product_type[1:]
+    for tile in tiles:
+        tile_prefix = f"tiles/{tile[:2]}/{tile[2]}/{tile[3:]}/"
+        if product_type == 'L2A':
+            tile_prefix = "L2/" + tile_prefix
+        for index, delta in enumerate(range(0, days, revisit)):
+            date = end_date - timedelta(days=delta)
+            for offset, mission in enumerate(('S2A', 'S2B')):
+                sensing = (date - timedelta(days=offset * revisit // 2)).strftime('%Y%m%dT084801')
+                name = f"{mission}_MSI{product_type}_{sensing}_N0209_R107_T{tile}_{sensing[:8]}T094101"
+                safe_prefix = f"{tile_prefix}{name}.SAFE/"
+                granule = f"{safe_prefix}GRANULE/{product_type}_T{tile}_A{index:06d}_{sensing}/"
+                metadata = METADATA.format(name=name, angles='<Values>0.0 0.0</Values>' * 500,
+                                           cloudy=(index * 7) % 100, nodata=0.0)
+                for folder in ('AUX_DATA', 'DATASTRIP', 'GRANULE', 'HTML', 'rep_info'):
+                    objects[f"{safe_prefix}{folder}_$folder$"] = b''
+                for folder in ('AUX_DATA', 'IMG_DATA', 'QI_DATA'):
+                    objects[f"{granule}{folder}_$folder$"] = b''
+                objects[f"{safe_prefix}MTD_MSI{product_type}.xml"] = b'<metadata/>'
+                objects[f"{safe_prefix}manifest.safe"] = b'<manifest/>'
+                objects[f"{granule}MTD_TL.xml"] = metadata.replace('Level-1C', f'Level-{level}').encode()
+                objects[f"{granule}QI_DATA/MSK_CLOUDS_B00.gml"] = b'<gml/>'
+                if product_type == 'L2A':
+                    objects[f"{granule}QI_DATA/MSK_CLDPRB_20m.jp2"] = bytes(band_size // 4)
+                    for band in bands:
+                        resolution = L2A_RESOLUTIONS.get(band, 60)
+                        objects[f"{granule}IMG_DATA/R{resolution}m/T{tile}_{sensing}_{band}_{resolution}m.jp2"] = \
+                            bytes(band_size)
+                else:
+                    for band in bands:
+                        objects[f"{granule}IMG_DATA/T{tile}_{sensing}_{band}.jp2"] = bytes(band_size)
+    return objects
+
+
+def legacy_product(tile: str = '36UYA', *, generation: datetime = datetime(2016, 1, 9, 15, 46, 20),
+                   band_size: int = 1024):
+    """
+    Build bucket contents of an L1C product named before December 2016, ex: S2A_OPER_PRD_MSIL1C_PDMC_20160109T...,
+    its granule metadata is named after the granule, thus it isn't matched against constraints
+    :return: dict, blob name to blob content
+    """
+    generated = generation.strftime('%Y%m%dT%H%M%S')
+    sensing = (generation - timedelta(days=1)).strftime('%Y%m%dT084801')
+    name = f"S2A_OPER_PRD_MSIL1C_PDMC_{generated}_R021_V{sensing}_{sensing}"
+    safe_prefix = f"tiles/{tile[:2]}/{tile[2]}/{tile[3:]}/{name}.SAFE/"
+    granule_name = f"S2A_OPER_MSI_L1C_TL_SGS__{generated}_A002835_T{tile}_N02.01"
+    granule = f"{safe_prefix}GRANULE/{granule_name}/"
+    objects = {f"{safe_prefix}{folder}_$folder$": b'' for folder in ('AUX_DATA', 'DATASTRIP', 'GRANULE', 'HTML')}
+    objects[f"{safe_prefix}{name.replace('_PRD_MSIL1C_', '_MTD_SAFL1C_')}.xml"] = b'<metadata/>'
+    objects[f"{safe_prefix}manifest.safe"] = b'<manifest/>'
+    objects[f"{granule}{granule_name.replace('_MSI_L1C_TL_', '_MTD_L1C_TL_')}.xml"] = b'<metadata/>'
+    for band in ('B02', 'B03', 'B04', 'B08'):
+        objects[f"{granule}IMG_DATA/{granule_name[:-7]}_{band}.jp2"] = bytes(band_size)
+    return objects
@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+"""
+Stand-in of sen2cor L2A_Process with the same command line: fake_sen2cor.py --output_dir=<dir> <L1C product>
+Behaviour is set by environment variables:
+FAKE_SEN2COR_RUNTIME: float, seconds of processing, default: 1.0
+FAKE_SEN2COR_MEMORY: int, bytes allocated during processing, default: 0
+FAKE_SEN2COR_FAIL: str, products with this substring in the name fail, default: none
+FAKE_SEN2COR_HANG: str, products with this substring in the name never finish, default: none
+Runtime is split between processing stages reported with sen2cor progress markers
+"""
+import os
+import sys
+import time
+import argparse
+
+# stage and its share of runtime
+STAGES = (('L2A_Tables: start of pre processing', 0.1),
+          ('L2A_SceneClass: start of scene classification', 0.3),
+          ('L2A_AtmCorr: start of atmospheric correction', 0.5),
+          ('L2A_Tables: start of post processing', 0.1), )
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--output_dir', required=True)
+    parser.add_argument('input_dir')
+    args = parser.parse_args()
+
+    name = os.path.basename(os.path.normpath(args.input_dir))
+    runtime = float(os.environ.get('FAKE_SEN2COR_RUNTIME', 1.0))
+    memory = int(os.environ.get('FAKE_SEN2COR_MEMORY', 0))
+    fail = os.environ.get('FAKE_SEN2COR_FAIL')
+    hang = os.environ.get('FAKE_SEN2COR_HANG')
+
+    print(f"Starting processing of {name}", flush=True)
+    try:
+        # touch every page, memory is really used
+        data = bytearray(memory)
+        for offset in range(0, memory, 4096):
+            data[offset] = 1
+    except MemoryError:
+        print(f"Out of memory while allocating {memory} bytes", file=sys.stderr)
+        sys.exit(2)
+
+    if hang and hang in name:
+        while True:
+            time.sleep(1)
+    progress = 0.0
+    for stage, share in STAGES:
+        print(f"Progress[%]: {progress * 100:6.2f} : {stage}", flush=True)
+        time.sleep(runtime * share)
+        progress += share
+    if fail and fail in name:
+        print(f"Processing of {name} failed", file=sys.stderr)
+        sys.exit(1)
+
+    output_name = name.replace('MSIL1C', 'MSIL2A')
+    metadata_name = 'MTD_MSIL2A.xml'
+    if '_OPER_' in name:
+        # legacy naming, ex: S2A_OPER_PRD_MSIL1C_PDMC_... is converted into S2A_USER_PRD_MSIL2A_PDMC_...
+        output_name = output_name.replace('_OPER_', '_USER_')
+        metadata_name = output_name.replace('_PRD_MSIL2A_', '_MTD_SAFL2A_').replace('.SAFE', '.xml')
+    os.makedirs(os.path.join(args.output_dir, output_name), exist_ok=True)
+    with open(os.path.join(args.output_dir, output_name, metadata_name), 'w') as file:
+        file.write(f"<product>{output_name}</product>\n")
+    print(f"Progress[%]: 100.00 : L2A_Process: end of processing, elapsed time: {runtime:.1f}", flush=True)
+    print(f"Processing of {name} finished", flush=True)
@@ -0,0 +1,69 @@
+import re
+import threading
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import unquote, urlparse
+
+MEDIA_PATH = re.compile(r"^/download/storage/v1/b/([^/]+)/o/(.+)$")
+RANGE = re.compile(r"bytes=(\d+)-(\d*)")
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        match = MEDIA_PATH.match(urlparse(self.path).path)
+        bucket = self.server.bucket
+        name = unquote(match.group(2)) if match else None
+        if name not in bucket.objects:
+            self.send_response(404)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+
+        bucket.count('get')
+        data = bucket.objects[name]
+        status = 200
+        byte_range = RANGE.match(self.headers.get('Range', ''))
+        if byte_range:
+            start = int(byte_range.group(1))
+            end = int(byte_range.group(2)) if byte_range.group(2) else len(data) - 1
+            self.send_response(206)
+            self.send_header('Content-Range', f"bytes {start}-{end}/{len(data)}")
+            data = data[start:end + 1]
+            status = 206
+        if status == 200:
+            self.send_response(200)
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+class _Server(ThreadingHTTPServer):
+    daemon_threads = True
+    # hundreds of concurrent connections from async engine
+    request_queue_size = 1024
+
+
+class HTTPBucket:
+    """
+    Local HTTP stand-in of the bucket serving GCS JSON API media requests from FakeBucket
+    """
+
+    def __init__(self, bucket, host: str = '127.0.0.1', port: int = 0):
+        self.server = _Server((host, port), _Handler)
+        self.server.bucket = bucket
+        self.url = f"http://{host}:{self.server.server_address[1]}"
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.server.shutdown()
+        self.server.server_close()
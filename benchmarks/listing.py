@@ -0,0 +1,38 @@
+"""
+Compare full tile listing with date-aware listing on a deep archive
+Run from repository root: python -m benchmarks.listing
+"""
+import time
+
+from sentinel2download.downloader import Sentinel2Downloader
+from benchmarks.fake_bucket import FakeBucket, FakeClient, deep_archive
+
+
+def full_history(loader, tile_prefix):
+    # listing used before date-aware ranges: whole tile history, filtered on client side
+    prefixes = loader._list_prefixes(tile_prefix)
+    return loader._filter_by_dates(prefixes)
+
+
+def measure(bucket, func, *args):
+    bucket.requests.clear()
+    start_time = time.time()
+    result = func(*args)
+    return len(result), bucket.requests.get('list', 0), time.time() - start_time
+
+
+if __name__ == '__main__':
+    latency = 0.05
+    bucket = FakeBucket(deep_archive(years=8, revisit=1, bands=()), latency=latency)
+    loader = Sentinel2Downloader(None, client=FakeClient(bucket))
+    tile_prefix = 'tiles/36/U/YA/'
+
+    print(f"Archive: {len(bucket.names)} blobs, list page latency {latency}s")
+    for start_date, end_date in (('2020-12-01', '2020-12-05'), ('2020-10-01', '2020-12-31'),
+                                 ('2019-01-01', '2020-12-31')):
+        loader._setup('L1C', ['36UYA'], start_date, end_date, {'B04'}, {}, './sentinel2imagery', 1, False)
+        for name, func in (('full history', full_history), ('date-aware', loader._get_filtered_prefixes)):
+            args = (loader, tile_prefix) if func is full_history else (tile_prefix,)
+            products, requests, elapsed = measure(bucket, func, *args)
+            print(f"{start_date}..{end_date} {name:>12}: {products:5d} products, "
+                  f"{requests:3d} list requests, {elapsed:.3f}s")
@@ -0,0 +1,89 @@
+"""
+Compare per-tile intersection areas and greedy coverage with the implementation they replaced
+on a synthetic grid and AOIs of increasing size
+Run from repository root: python -m benchmarks.overlap
+"""
+import os
+import math
+import time
+import tempfile
+
+import geopandas as gp
+
+from shapely.geometry import Polygon, box
+
+from sentinel2download.overlap import Sentinel2Overlap
+
+# Sentinel-2 tiles are 109.8 km squares with about 10 km overlap
+TILE_SIZE = 1.0
+TILE_OVERLAP = 0.1
+
+
+def synthetic_grid(west=-10.0, south=35.0, east=40.0, north=70.0) -> gp.GeoDataFrame:
+    names, geometries = list(), list()
+    for row, latitude in enumerate(range(int(south), int(north))):
+        for column, longitude in enumerate(range(int(west), int(east))):
+            names.append(f"{row:02d}{column:03d}")
+            geometries.append(box(longitude, latitude, longitude + TILE_SIZE + TILE_OVERLAP,
+                                  latitude + TILE_SIZE + TILE_OVERLAP))
+    return gp.GeoDataFrame({'Name': names}, geometry=geometries, crs="epsg:4326")
+
+
+def synthetic_aoi(radius, vertices=20000, center=(15.3, 52.7)) -> gp.GeoDataFrame:
+    # star-shaped region, number of vertices drives the cost of intersection and difference
+    points = list()
+    for index in range(vertices):
+        angle = 2 * math.pi * index / vertices
+        scale = radius * (0.75 + 0.25 * math.sin(7 * angle) * math.cos(3 * angle))
+        points.append((center[0] + scale * math.cos(angle), center[1] + scale * math.sin(angle) * 0.6))
+    return gp.GeoDataFrame(geometry=[Polygon(points)], crs="epsg:4326")
+
+
+def legacy_overlap(overlap, grid, limit=0.001):
+    # implementation before vectorized areas and prepared greedy coverage, grid is read in advance
+    aoi = overlap.aoi.copy()
+    geometry = aoi.geometry[0]
+    grid = grid.iloc[list(grid.sindex.intersection(geometry.bounds))]
+    grid = grid.loc[grid.intersects(geometry)].copy()
+    epsg = overlap.epsg_code(geometry.centroid.x, geometry.centroid.y)
+    aoi['geometry'] = aoi.geometry.to_crs(epsg=epsg)
+    grid['geometry'] = grid.geometry.to_crs(epsg=epsg)
+    grid['area'] = grid.geometry.apply(lambda g: g.intersection(aoi.geometry[0]).area / 1e6)
+    grid = grid.loc[grid['area'] >= limit]
+    grid = grid.sort_values(by=['area', 'Name'], ascending=[False, True])
+
+    overlap_tiles = list()
+    remaining = aoi.geometry[0]
+    for row in grid.itertuples():
+        start_area = remaining.area
+        remaining = remaining.difference(row.geometry)
+        if start_area != remaining.area:
+            overlap_tiles.append(row.Name)
+    return sorted(overlap_tiles) or None
+
+
+def measure(func, repeat=3):
+    elapsed = list()
+    for _ in range(repeat):
+        start_time = time.time()
+        result = func()
+        elapsed.append(time.time() - start_time)
+    return result, min(elapsed)
+
+
+if __name__ == '__main__':
+    with tempfile.TemporaryDirectory() as directory:
+        grid_path = os.path.join(directory, 'grid.geojson')
+        synthetic_grid().to_file(grid_path, driver='GeoJSON')
+        grid = gp.read_file(grid_path)
+        for radius in (0.5, 2.0, 5.0, 10.0, 15.0):
+            aoi_path = os.path.join(directory, f"aoi_{radius}.geojson")
+            synthetic_aoi(radius).to_file(aoi_path, driver='GeoJSON')
+            overlap = Sentinel2Overlap(aoi_path, grid_path=grid_path)
+
+            legacy, legacy_time = measure(lambda: legacy_overlap(overlap, grid))
+            tiles, elapsed = measure(overlap.overlap)
+            # legacy coverage also takes disjoint tiles when difference changes area by rounding noise
+            assert set(tiles) <= set(legacy), f"tiles differ for radius {radius}"
+            print(f"AOI radius {radius:4.1f} deg: {len(tiles):3d} tiles ({len(legacy)} legacy), "
+                  f"legacy {legacy_time:.3f}s, vectorized {elapsed:.3f}s, x{legacy_time / elapsed:.1f}")
@@ -0,0 +1,64 @@
+"""
+Download followed by conversion against the pipeline that converts products while others are loaded,
+with a slow fake bucket and a fake sen2cor
+Run from repository root: python -m benchmarks.pipeline
+"""
+import os
+import time
+import tempfile
+
+from datetime import datetime
+
+from sentinel2download.downloader import Sentinel2Downloader
+from sentinel2preprocessing.conversion import Sentinel2Converter
+from sentinel2preprocessing.pipeline import Sentinel2Pipeline
+from benchmarks.fake_bucket import FakeBucket, FakeClient, deep_archive, legacy_product
+from benchmarks.conversion import FAKE_SEN2COR
+
+TILES = ['36UYA', '36UYB']
+DATES = dict(start_date='2020-12-01', end_date='2020-12-31')
+# products named before December 2016 are converted along with the others
+LEGACY_DATES = dict(start_date='2016-01-01', end_date='2016-01-31')
+
+
+def sequential(bucket, download_dir, output_dir, workers):
+    loader = Sentinel2Downloader(None, client=FakeClient(bucket))
+    loader.download('L1C', TILES, output_dir=download_dir, cores=4, full_download=True, **DATES)
+    converter = Sentinel2Converter(verbose=False)
+    return converter.convert(download_dir, output_dir, FAKE_SEN2COR, workers=workers)
+
+
+def pipelined(bucket, download_dir, output_dir, workers, **kwargs):
+    pipeline = Sentinel2Pipeline(Sentinel2Downloader(None, client=FakeClient(bucket)))
+    return pipeline.run(TILES, download_dir=download_dir, output_dir=output_dir, cores=4,
+                        sen2cor_path=FAKE_SEN2COR, workers=workers, **{**DATES, **kwargs})
+
+
+def disk_products(path):
+    return len([name for name in os.listdir(path) if name.endswith('.SAFE')])
+
+
+if __name__ == '__main__':
+    os.environ['FAKE_SEN2COR_RUNTIME'] = '0.5'
+    workers = 2
+    archive = deep_archive(TILES, years=1)
+    archive.update(deep_archive(TILES, years=1, end_date=datetime(2016, 1, 31)))
+    archive.update(legacy_product(TILES[0]))
+    bucket = FakeBucket(archive, latency=0.1)
+    for name, run, kwargs in (('download, then convert', sequential, dict()),
+                              ('pipeline', pipelined, dict()),
+                              ('pipeline, delete L1C', pipelined, dict(delete_input=True, max_products=2)),
+                              # products over the limit are neither loaded nor converted
+                              ('pipeline, clouds <= 20%', pipelined,
+                               dict(constraints={'CLOUDY_PIXEL_PERCENTAGE': 20.0})),
+                              ('pipeline, legacy product', pipelined, LEGACY_DATES)):
+        with tempfile.TemporaryDirectory() as download_dir, tempfile.TemporaryDirectory() as output_dir:
+            start_time = time.time()
+            results = run(bucket, download_dir, output_dir, workers, **kwargs)
+            elapsed = time.time() - start_time
+            print(f"{name:>24}: {len(results)} of {len(results.results)} products converted in {elapsed:.2f}s, "
+                  f"{disk_products(download_dir)} L1C products left on disk")
+            if name == 'pipeline':
+                start_time = time.time()
+                rerun = pipelined(bucket, download_dir, output_dir, workers)
+                print(f"{'rerun':>24}: {len(rerun.results)} products loaded again in {time.time() - start_time:.2f}s")
@@ -0,0 +1,75 @@
+"""
+Decoding and resampling bands of every product by each consumer against reading a stack written once
+Run from repository root: python -m benchmarks.stacking
+"""
+import os
+import time
+import tempfile
+
+import numpy as np
+import rasterio
+
+from rasterio.enums import Resampling
+from rasterio.transform import from_origin
+
+from sentinel2preprocessing.stacking import Sentinel2Stacker, open_stack
+
+BANDS = (('B04', 10), ('B08', 10), ('B11', 20), ('CLD', 20))
+
+
+def fake_products(input_dir, days=(1, 6, 11), size=4096):
+    """
+    L2A products with synthetic JP2 bands at 10 and 20 m, tiled by 1024 pixels as Sentinel-2 bands
+    """
+    paths = list()
+    for day in days:
+        sensing = f"202010{day:02d}T084801"
+        name = f"S2A_MSIL2A_{sensing}_N0214_R107_T36UYA_{sensing[:8]}T113817.SAFE"
+        for band, resolution in BANDS:
+            width = size * 10 // resolution
+            if band == 'CLD':
+                path = os.path.join(input_dir, name, 'GRANULE', 'L2A', 'QI_DATA', f"MSK_CLDPRB_{resolution}m.jp2")
+                data = (np.arange(width * width) % 101).astype(np.uint8).reshape(1, width, width)
+            else:
+                path = os.path.join(input_dir, name, 'GRANULE', 'L2A', 'IMG_DATA', f"R{resolution}m",
+                                    f"T36UYA_{sensing}_{band}_{resolution}m.jp2")
+                data = (np.arange(width * width) % 4000 + day).astype(np.uint16).reshape(1, width, width)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with rasterio.open(path, 'w', driver='JP2OpenJPEG', width=width, height=width, count=1,
+                               dtype=data.dtype, crs='EPSG:32636', QUALITY=100, REVERSIBLE='YES',
+                               BLOCKXSIZE=1024, BLOCKYSIZE=1024,
+                               transform=from_origin(600000, 5600040, resolution, resolution)) as file:
+                file.write(data)
+        paths.append(os.path.join(input_dir, name))
+    return paths
+
+
+def decode_all(product_paths, size):
+    for product_path in product_paths:
+        for root, _, names in os.walk(product_path):
+            for name in names:
+                with rasterio.open(os.path.join(root, name)) as file:
+                    file.read(out_shape=(1, size, size), resampling=Resampling.bilinear)
+
+
+if __name__ == '__main__':
+    size = 4096
+    with tempfile.TemporaryDirectory() as input_dir, tempfile.TemporaryDirectory() as stack_dir:
+        product_paths = fake_products(input_dir, size=size)
+
+        start_time = time.time()
+        decode_all(product_paths, size)
+        print(f"decode and resample {len(product_paths)} products: {time.time() - start_time:.2f}s per consumer")
+
+        start_time = time.time()
+        Sentinel2Stacker().stack(product_paths, stack_dir, bands=[band for band, _ in BANDS])
+        print(f"stack once: {time.time() - start_time:.2f}s")
+
+        stack = open_stack(stack_dir)
+        start_time = time.time()
+        stack.read()
+        print(f"read the whole {stack.shape} stack: {time.time() - start_time:.2f}s")
+        start_time = time.time()
+        stack = open_stack(stack_dir)
+        field = stack.read(window=(2000, 2000, 256, 256))
+        print(f"open and read a {field.shape} field time series: {(time.time() - start_time) * 1000:.1f}ms")
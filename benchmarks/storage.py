@@ -0,0 +1,93 @@
+"""
+Download throughput of band-only and full .SAFE downloads from a simulated bucket, no network or credentials needed.
+Every scenario runs on the same synthetic archive with seeded errors, so results of different commits are comparable.
+Run from repository root: python -m benchmarks.storage [--repeat 3] [--output benchmarks.jsonl]
+"""
+import json
+import time
+import argparse
+import statistics
+import subprocess
+import tempfile
+
+from datetime import datetime
+
+from sentinel2download.downloader import Sentinel2Downloader, ProductComplete
+from sentinel2download.storage import MemoryStorage
+from benchmarks.fake_bucket import deep_archive
+
+TILES = ['36UYA', '36UYB', '36UXA', '36UXB']
+DATES = dict(start_date='2020-10-01', end_date='2020-12-31')
+BANDS = {'B04', 'B08'}
+
+# name, product type, full_download, storage options
+SCENARIOS = (('L1C bands', 'L1C', False, dict(latency=0.01)),
+             ('L1C full', 'L1C', True, dict(latency=0.01)),
+             ('L2A bands', 'L2A', False, dict(latency=0.01)),
+             ('L2A full', 'L2A', True, dict(latency=0.01)),
+             ('L1C bands, 50 MB/s', 'L1C', False, dict(latency=0.01, bandwidth=50 * 1024 * 1024)),
+             ('L1C bands, 5% errors', 'L1C', False, dict(latency=0.01, error_rate=0.05)), )
+
+
+def measure(archive, product_type, full_download, options, cores):
+    backend = MemoryStorage(archive, **options)
+    loader = Sentinel2Downloader(None, backend=backend)
+    with tempfile.TemporaryDirectory() as output_dir:
+        start_time = time.perf_counter()
+        results = loader.download(product_type, TILES, bands=BANDS, output_dir=output_dir, cores=cores,
+                                  full_download=full_download, constraints={}, **DATES)
+        elapsed = time.perf_counter() - start_time
+    loaded = results.report['counters'].get('bytes', 0)
+    return dict(seconds=elapsed, blobs=len(results), tiles_per_second=len(TILES) / elapsed,
+                blobs_per_second=len(results) / elapsed, mb_per_second=loaded / elapsed / 1024 / 1024,
+                list_requests=backend.requests.get('list', 0), get_requests=backend.requests.get('get', 0))
+
+
+def repeated_tiles(archive, cores):
+    # tiles passed twice are loaded once, every product is completed once
+    backend = MemoryStorage(archive, latency=0.01)
+    loader = Sentinel2Downloader(None, backend=backend)
+    with tempfile.TemporaryDirectory() as output_dir:
+        events = list(loader.download_iter('L1C', TILES + TILES, bands=BANDS, output_dir=output_dir, cores=cores,
+                                           full_download=True, constraints={}, **DATES))
+    products = [event for event in events if isinstance(event, ProductComplete)]
+    assert len(products) == len({product.prefix for product in products}), "products are completed twice"
+    return len(events) - len(products), len(products)
+
+
+def revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--repeat', type=int, default=3, help="runs of every scenario, median is reported")
+    parser.add_argument('--cores', type=int, default=16, help="concurrent transfers")
+    parser.add_argument('--output', help="JSON lines file results are appended to")
+    args = parser.parse_args()
+
+    archives = {product_type: deep_archive(TILES, years=1, band_size=512 * 1024, product_type=product_type)
+                for product_type in ('L1C', 'L2A')}
+    record = dict(revision=revision(), time=datetime.now().isoformat(timespec='seconds'), cores=args.cores,
+                  scenarios=dict())
+    for name, product_type, full_download, options in SCENARIOS:
+        runs = [measure(archives[product_type], product_type, full_download, options, args.cores)
+                for _ in range(args.repeat)]
+        result = {key: statistics.median(run[key] for run in runs) for key in runs[0]}
+        record['scenarios'][name] = result
+        print(f"{name:>22}: {result['blobs']:5.0f} blobs in {result['seconds']:6.2f}s, "
+              f"{result['tiles_per_second']:6.2f} tiles/s, {result['blobs_per_second']:7.1f} blobs/s, "
+              f"{result['mb_per_second']:7.1f} MB/s, {result['list_requests']:.0f} list and "
+              f"{result['get_requests']:.0f} get requests")
+
+    blobs, products = repeated_tiles(archives['L1C'], args.cores)
+    assert blobs == record['scenarios']['L1C full']['blobs'], "blobs of repeated tiles are loaded twice"
+    print(f"{'L1C full, repeated tiles':>22}: {blobs} blobs of {products} products")
+
+    if args.output:
+        with open(args.output, 'a') as file:
+            file.write(json.dumps(record) + '\n')
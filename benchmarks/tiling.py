@@ -0,0 +1,53 @@
+"""
+Compare per-request overlap latency of the cached tiling grid with reading the grid file per instance
+Run from repository root: python -m benchmarks.tiling
+"""
+import os
+import time
+import tempfile
+
+import geopandas as gp
+
+from sentinel2download import tiling
+from sentinel2download.overlap import Sentinel2Overlap
+from benchmarks.overlap import synthetic_grid, synthetic_aoi
+
+
+def read_file_request(aoi_path, grid_path):
+    # grid loading used before the cache: whole file parsed and indexed per instance
+    grid = gp.read_file(grid_path)
+    aoi = gp.read_file(aoi_path)
+    return list(grid.sindex.intersection(aoi.total_bounds))
+
+
+def cached_request(aoi_path, grid_path):
+    return Sentinel2Overlap(aoi_path, grid_path=grid_path).overlap()
+
+
+def measure(func, *args, repeat=5):
+    elapsed = list()
+    for _ in range(repeat):
+        start_time = time.time()
+        func(*args)
+        elapsed.append(time.time() - start_time)
+    return min(elapsed)
+
+
+if __name__ == '__main__':
+    with tempfile.TemporaryDirectory() as directory:
+        grid_path = os.path.join(directory, 'grid.geojson')
+        # about the size of the global Sentinel-2 grid
+        synthetic_grid(west=-180, south=-80, east=180, north=80).to_file(grid_path, driver='GeoJSON')
+        aoi_path = os.path.join(directory, 'aoi.geojson')
+        synthetic_aoi(0.3, vertices=200).to_file(aoi_path, driver='GeoJSON')
+
+        print(f"read_file per request: {measure(read_file_request, aoi_path, grid_path, repeat=2):.3f}s")
+
+        start_time = time.time()
+        tiling.build_cache(grid_path, grid_path + tiling.CACHE_SUFFIX)
+        print(f"cache build, once per grid file: {time.time() - start_time:.3f}s")
+
+        start_time = time.time()
+        cached_request(aoi_path, grid_path)
+        print(f"first request of the process, maps cache: {time.time() - start_time:.3f}s")
+        print(f"cached grid per request: {measure(cached_request, aoi_path, grid_path) * 1000:.1f}ms")
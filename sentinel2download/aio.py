@@ -0,0 +1,136 @@
+import asyncio
+import logging
+import threading
+
+from concurrent.futures import Future
+from typing import Optional
+from urllib.parse import quote
+
+from .storage import STORAGE_URL
+from .throttle import RateLimiter
+from .transfer import PartFile, BlobResult, ChecksumWriter, STATUS, RANGE_THRESHOLD, RANGE_SIZE
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+logger = logging.getLogger(__name__)
+logging.basicConfig()
+
+
+class AsyncTransfer:
+    """
+    Blob transfers as asyncio tasks sharing a keep-alive HTTP connection pool,
+    blobs are loaded with GCS JSON API media requests
+    """
+
+    def __init__(self, bucket_name: str, concurrency: int = 200, *,
+                 base_url: str = STORAGE_URL, credentials=None, chunk_size: int = 1024 * 1024,
+                 range_threshold: Optional[int] = RANGE_THRESHOLD, range_size: int = RANGE_SIZE,
+                 rate: Optional[RateLimiter] = None):
+        """
+        :param bucket_name: str, ex: gcp-public-data-sentinel-2
+        :param concurrency: int, max number of in-flight requests, default: 200
+        :param base_url: str, storage endpoint, local stand-in of the bucket can be used, default: STORAGE_URL
+        :param credentials: google.auth.credentials.Credentials, default: None, anonymous requests
+        :param chunk_size: int, size of chunks read from response, default: 1 MB
+        :param range_threshold: int, blobs larger than threshold in bytes are loaded in parallel ranges,
+        None disables ranges, default: RANGE_THRESHOLD
+        :param range_size: int, size of a range in bytes, default: RANGE_SIZE
+        :param rate: RateLimiter, bandwidth cap shared by all transfers, default: None
+        """
+        if aiohttp is None:
+            raise ImportError("aiohttp is required for async engine: pip install aiohttp")
+        self.bucket_name = bucket_name
+        self.concurrency = concurrency
+        self.base_url = base_url.rstrip('/')
+        self.credentials = credentials
+        self.chunk_size = chunk_size
+        self.range_threshold = range_threshold
+        self.range_size = range_size
+        self.rate = rate
+
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever, name="async-transfer", daemon=True)
+        self._thread.start()
+        self._session = asyncio.run_coroutine_threadsafe(self._create_session(), self._loop).result()
+
+    async def _create_session(self):
+        connector = aiohttp.TCPConnector(limit=self.concurrency, keepalive_timeout=60)
+        return aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=None, sock_read=60))
+
+    def _url(self, blob):
+        url = f"{self.base_url}/download/storage/v1/b/{self.bucket_name}/o/{quote(blob.name, safe='')}?alt=media"
+        if blob.generation:
+            url += f"&generation={blob.generation}"
+        return url
+
+    async def _headers(self):
+        if self.credentials is None:
+            return dict()
+        if not self.credentials.valid:
+            from google.auth.transport.requests import Request
+            # token refresh is a blocking call
+            await self._loop.run_in_executor(None, self.credentials.refresh, Request())
+        return {'Authorization': f"Bearer {self.credentials.token}"}
+
+    async def _stream(self, blob, file, start=None, end=None):
+        headers = await self._headers()
+        if start is not None:
+            headers['Range'] = f"bytes={start}-{'' if end is None else end}"
+        async with self._session.get(self._url(blob), headers=headers) as response:
+            response.raise_for_status()
+            if 'Range' in headers and response.status != 206:
+                raise ValueError(f"range request is not satisfied, status: {response.status}")
+            async for chunk in response.content.iter_chunked(self.chunk_size):
+                file.write(chunk)
+                if self.rate is not None:
+                    # the loop must not block, tasks over the cap sleep instead
+                    delay = self.rate.reserve(len(chunk))
+                    if delay:
+                        await asyncio.sleep(delay)
+
+    async def _download_range(self, blob, part, index, start, end):
+        with open(part.path, 'r+b') as file:
+            file.seek(start)
+            writer = ChecksumWriter(file)
+            await self._stream(blob, writer, start, end)
+        part.complete_range(index, writer.crc)
+
+    async def _download(self, blob, save_path) -> BlobResult:
+        try:
+            part = PartFile(blob, save_path, self.range_threshold, self.range_size)
+            if part.ranges:
+                results = await asyncio.gather(*[self._download_range(blob, part, *pending)
+                                                 for pending in part.pending_ranges()], return_exceptions=True)
+                errors = [result for result in results if isinstance(result, Exception)]
+                if errors:
+                    raise errors[0]
+            else:
+                offset = part.resume_offset()
+                with open(part.path, 'ab') as file:
+                    writer = part.stream_writer(file, offset)
+                    if blob.size is None or offset < blob.size:
+                        await self._stream(blob, writer, offset or None)
+                part.complete_stream(writer)
+            part.commit()
+        except Exception as ex:
+            logger.info(f"Error while loading {blob.name}: {str(ex)}")
+            return BlobResult(None, blob.name, STATUS.FAILED, error=ex)
+        logger.info(f"Loaded {blob.name}")
+        return BlobResult(str(save_path), blob.name, STATUS.DOWNLOADED, size=blob.size or 0)
+
+    def submit(self, blob, save_path) -> Future:
+        """
+        :param blob: BlobInfo, blob to load
+        :param save_path: Path, path to save blob to, parent directory exists
+        :return: Future, resolves to BlobResult (save_path, blob_name), save_path is None if the blob is not loaded
+        """
+        return asyncio.run_coroutine_threadsafe(self._download(blob, save_path), self._loop)
+
+    def close(self):
+        asyncio.run_coroutine_threadsafe(self._session.close(), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._loop.close()
@@ -0,0 +1,169 @@
+import os
+import time
+import shutil
+import sqlite3
+import logging
+import threading
+
+from pathlib import Path
+from typing import Dict
+
+logger = logging.getLogger(__name__)
+logging.basicConfig()
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS products (name TEXT PRIMARY KEY, bytes INTEGER NOT NULL, last_access REAL NOT NULL,
+                                     pins INTEGER NOT NULL DEFAULT 0);
+CREATE INDEX IF NOT EXISTS products_access ON products (last_access);
+"""
+
+
+class Sentinel2Cache:
+    """
+    Size-bounded LRU cache of downloaded products in the downloader output directory.
+    Products (.SAFE or product directories) are evicted as a whole, least recently used first.
+    """
+
+    INDEX_NAME = '.sentinel2cache.sqlite'
+
+    def __init__(self, output_dir: str, max_bytes: int):
+        """
+        :param output_dir: str, downloader output directory
+        :param max_bytes: int, budget of the output directory in bytes
+        """
+        self.output_dir = Path(output_dir)
+        self.output_dir.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self._lock = threading.RLock()
+        index_path = self.output_dir / self.INDEX_NAME
+        new_index = not index_path.is_file()
+        self._connection = sqlite3.connect(str(index_path), check_same_thread=False)
+        self._connection.executescript(SCHEMA)
+        # bytes of in-flight transfers
+        self._reserved = 0
+        # products of running downloads are never evicted
+        self._active = dict()
+        self.hits = 0
+        self.misses = 0
+        self.evicted_bytes = 0
+        self.evicted_products = 0
+        if new_index:
+            self.rebuild()
+
+    def product_name(self, save_path) -> str:
+        """
+        :param save_path: Path, path of a blob inside output directory
+        :return: str, product directory name
+        """
+        return Path(os.path.relpath(save_path, self.output_dir)).parts[0]
+
+    def rebuild(self):
+        """
+        Index products of the output directory, the only full directory walk
+        """
+        rows = list()
+        for entry in os.scandir(self.output_dir):
+            if entry.is_dir() and not entry.name.startswith('.'):
+                size = sum(os.path.getsize(os.path.join(root, name))
+                           for root, _, names in os.walk(entry.path) for name in names)
+                rows.append((entry.name, size, entry.stat().st_mtime))
+        with self._lock, self._connection:
+            self._connection.execute("DELETE FROM products")
+            self._connection.executemany("INSERT INTO products (name, bytes, last_access) VALUES (?, ?, ?)", rows)
+
+    @property
+    def used_bytes(self) -> int:
+        with self._lock:
+            return self._connection.execute("SELECT COALESCE(SUM(bytes), 0) FROM products").fetchone()[0]
+
+    def _touch(self, product, size=0):
+        self._connection.execute("INSERT INTO products (name, bytes, last_access) VALUES (?, ?, ?) "
+                                 "ON CONFLICT (name) DO UPDATE SET bytes = bytes + ?, last_access = ?",
+                                 (product, size, time.time(), size, time.time()))
+
+    def activate(self, product):
+        with self._lock:
+            self._active[product] = self._active.get(product, 0) + 1
+
+    def deactivate(self, product):
+        with self._lock:
+            self._active[product] -= 1
+            if not self._active[product]:
+                del self._active[product]
+
+    def hit(self, product):
+        with self._lock, self._connection:
+            self.hits += 1
+            self._touch(product)
+
+    def _evict(self, needed):
+        candidates = self._connection.execute("SELECT name, bytes FROM products WHERE pins = 0 "
+                                              "ORDER BY last_access").fetchall()
+        for name, size in candidates:
+            if needed <= 0:
+                break
+            if name in self._active:
+                continue
+            shutil.rmtree(self.output_dir / name, ignore_errors=True)
+            with self._connection:
+                self._connection.execute("DELETE FROM products WHERE name = ?", (name,))
+            self.evicted_bytes += size
+            self.evicted_products += 1
+            needed -= size
+            logger.info(f"Evicted {name} from cache, {size} bytes")
+        return needed
+
+    def reserve(self, product, size):
+        """
+        Make room for a blob transfer before it starts, least recently used products are evicted.
+        A local file replaced by the transfer is kept until the transfer is complete, thus its size is not deducted.
+        :param product: str, product directory name
+        :param size: int, blob size in bytes
+        """
+        with self._lock:
+            self.misses += 1
+            needed = self.used_bytes + self._reserved + size - self.max_bytes
+            if needed > 0 and self._evict(needed) > 0:
+                logger.info(f"Cache budget {self.max_bytes} bytes is exceeded, all products are in use")
+            self._reserved += size
+
+    def commit(self, product, size, loaded=True, replaced=0):
+        """
+        :param product: str, product directory name
+        :param size: int, reserved blob size in bytes
+        :param loaded: bool, False if transfer failed
+        :param replaced: int, size in bytes of the local file overwritten by the transfer, ex: an outdated blob
+        in sync mode, default: 0
+        """
+        with self._lock, self._connection:
+            self._reserved -= size
+            if loaded:
+                self._touch(product, size - replaced)
+
+    def pin(self, product):
+        """
+        Pinned products are never evicted, pins are kept in the index and shared between processes
+        """
+        with self._lock, self._connection:
+            self._touch(product)
+            self._connection.execute("UPDATE products SET pins = pins + 1 WHERE name = ?", (product,))
+
+    def unpin(self, product):
+        with self._lock, self._connection:
+            self._connection.execute("UPDATE products SET pins = MAX(pins - 1, 0) WHERE name = ?", (product,))
+
+    def remove(self, product):
+        """
+        Delete a product that is not needed anymore, ex: a converted L1C product
+        """
+        with self._lock, self._connection:
+            shutil.rmtree(self.output_dir / product, ignore_errors=True)
+            self._connection.execute("DELETE FROM products WHERE name = ?", (product,))
+
+    def stats(self) -> Dict[str, int]:
+        return dict(hits=self.hits, misses=self.misses, evicted_bytes=self.evicted_bytes,
+                    evicted_products=self.evicted_products, used_bytes=self.used_bytes, max_bytes=self.max_bytes)
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
@@ -0,0 +1,152 @@
+import json
+import time
+import sqlite3
+import threading
+
+from collections import namedtuple
+from typing import Optional, List, Set, Dict
+
+BlobInfo = namedtuple('BlobInfo', 'name size crc32c md5_hash generation')
+
+# upper bound for names starting with a prefix
+PREFIX_END = chr(0x10FFFF)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS tiles (prefix TEXT PRIMARY KEY, synced_at REAL NOT NULL);
+CREATE TABLE IF NOT EXISTS products (prefix TEXT PRIMARY KEY, tile_prefix TEXT NOT NULL);
+CREATE INDEX IF NOT EXISTS products_tile ON products (tile_prefix);
+CREATE TABLE IF NOT EXISTS windows (tile_prefix TEXT NOT NULL, start_day TEXT NOT NULL, end_day TEXT NOT NULL,
+                                    synced_at REAL NOT NULL);
+CREATE TABLE IF NOT EXISTS listings (prefix TEXT PRIMARY KEY, synced_at REAL NOT NULL);
+CREATE TABLE IF NOT EXISTS blobs (name TEXT PRIMARY KEY, size INTEGER, crc32c TEXT, md5_hash TEXT,
+                                  generation INTEGER);
+CREATE TABLE IF NOT EXISTS constraints (name TEXT PRIMARY KEY, generation INTEGER, tag_values TEXT NOT NULL);
+"""
+
+
+def to_blob_info(blob) -> BlobInfo:
+    return BlobInfo(blob.name, blob.size, blob.crc32c, blob.md5_hash, blob.generation)
+
+
+class Sentinel2Catalog:
+    """
+    Persistent SQLite catalog of Sentinel2 bucket listings and parsed metadata constraint values
+    """
+
+    def __init__(self, path: str = './sentinel2catalog.sqlite', *, ttl: float = 24 * 60 * 60, offline: bool = False):
+        """
+        :param path: str, path to SQLite catalog file, default: './sentinel2catalog.sqlite'
+        :param ttl: float, seconds after which date windows of tile listings are listed again, default: 1 day
+        :param offline: bool, serve listings and metadata from catalog only, without bucket calls, default: False
+        """
+        self.path = path
+        self.ttl = ttl
+        self.offline = offline
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.executescript(SCHEMA)
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
+    def tile_synced_at(self, tile_prefix) -> Optional[float]:
+        with self._lock:
+            row = self._connection.execute("SELECT synced_at FROM tiles WHERE prefix = ?", (tile_prefix,)).fetchone()
+        return row[0] if row else None
+
+    def is_fresh(self, tile_prefix, start_day: Optional[str] = None, end_day: Optional[str] = None) -> bool:
+        """
+        :param tile_prefix: str, tile prefix, ex: tiles/36/U/YA/
+        :param start_day: str, format: 20200101, start of acquisition dates, default: None, whole tile history
+        :param end_day: str, format: 20200131, end of acquisition dates, default: None, whole tile history
+        :return: bool, the whole tile or a date window covering the dates was listed within ttl
+        """
+        synced_at = self.tile_synced_at(tile_prefix)
+        if synced_at is not None and time.time() - synced_at < self.ttl:
+            return True
+        if start_day is None or end_day is None:
+            return False
+        with self._lock:
+            row = self._connection.execute("SELECT 1 FROM windows WHERE tile_prefix = ? AND start_day <= ? "
+                                           "AND end_day >= ? AND synced_at > ?",
+                                           (tile_prefix, start_day, end_day, time.time() - self.ttl)).fetchone()
+        return row is not None
+
+    def products(self, tile_prefix) -> Optional[Set[str]]:
+        """
+        :param tile_prefix: str, tile prefix, ex: tiles/36/U/YA/
+        :return: set, known .SAFE prefixes or None if tile was never synced
+        """
+        if self.tile_synced_at(tile_prefix) is None:
+            return None
+        with self._lock:
+            rows = self._connection.execute("SELECT prefix FROM products WHERE tile_prefix = ?",
+                                            (tile_prefix,)).fetchall()
+        return {row[0] for row in rows}
+
+    def update_products(self, tile_prefix, prefixes, start_day: Optional[str] = None, end_day: Optional[str] = None):
+        """
+        Add listed products, known products are kept
+        :param prefixes: iterable, listed .SAFE prefixes
+        :param start_day: str, format: 20200101, start of listed acquisition dates, default: None, whole tile listed
+        :param end_day: str, format: 20200131, end of listed acquisition dates, default: None, whole tile listed
+        """
+        now = time.time()
+        with self._lock, self._connection:
+            self._connection.executemany("INSERT OR IGNORE INTO products (prefix, tile_prefix) VALUES (?, ?)",
+                                         [(prefix, tile_prefix) for prefix in prefixes])
+            if start_day is None or end_day is None:
+                self._connection.execute("INSERT OR REPLACE INTO tiles (prefix, synced_at) VALUES (?, ?)",
+                                         (tile_prefix, now))
+            else:
+                self._connection.execute("DELETE FROM windows WHERE tile_prefix = ? AND synced_at <= ?",
+                                         (tile_prefix, now - self.ttl))
+                self._connection.execute("INSERT INTO windows (tile_prefix, start_day, end_day, synced_at) "
+                                         "VALUES (?, ?, ?, ?)", (tile_prefix, start_day, end_day, now))
+
+    def blobs(self, prefix) -> Optional[List[BlobInfo]]:
+        """
+        Product contents never change once published, so blob listings are not subject to ttl
+        :param prefix: str, listed prefix,
+        ex: tiles/36/U/YA/S2A_MSIL1C_20201001T084801_N0209_R107_T36UYA_20201001T094101.SAFE/
+        :return: list, BlobInfo tuples or None if prefix or its parent was never listed
+        """
+        # prefix itself or any of its parent directories
+        parents = [prefix[:index + 1] for index, char in enumerate(prefix) if char == '/'] + [prefix]
+        with self._lock:
+            listed = self._connection.execute(f"SELECT 1 FROM listings WHERE prefix IN "
+                                              f"({', '.join('?' * len(parents))})", parents).fetchone()
+            if not listed:
+                return None
+            rows = self._connection.execute("SELECT name, size, crc32c, md5_hash, generation FROM blobs "
+                                            "WHERE name >= ? AND name < ? ORDER BY name",
+                                            (prefix, prefix + PREFIX_END)).fetchall()
+        return [BlobInfo(*row) for row in rows]
+
+    def update_blobs(self, prefix, blobs):
+        with self._lock, self._connection:
+            self._connection.executemany("INSERT OR REPLACE INTO blobs (name, size, crc32c, md5_hash, generation) "
+                                         "VALUES (?, ?, ?, ?, ?)", [tuple(blob) for blob in blobs])
+            self._connection.execute("INSERT OR REPLACE INTO listings (prefix, synced_at) VALUES (?, ?)",
+                                     (prefix, time.time()))
+
+    def constraint_values(self, name, generation) -> Optional[Dict[str, Optional[float]]]:
+        """
+        :param name: str, metadata blob name
+        :param generation: int, metadata blob generation
+        :return: dict, parsed constraint values, None value means constraint is absent in metadata
+        """
+        with self._lock:
+            row = self._connection.execute("SELECT generation, tag_values FROM constraints WHERE name = ?",
+                                           (name,)).fetchone()
+        if not row or row[0] != generation:
+            return None
+        return json.loads(row[1])
+
+    def update_constraint_values(self, name, generation, values):
+        cached = self.constraint_values(name, generation) or dict()
+        cached.update(values)
+        with self._lock, self._connection:
+            self._connection.execute("INSERT OR REPLACE INTO constraints (name, generation, tag_values) "
+                                     "VALUES (?, ?, ?)", (name, generation, json.dumps(cached)))
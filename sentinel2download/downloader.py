@@ -2,21 +2,36 @@ import os
 import re
 import logging
 import time
+import threading
 
 from datetime import datetime, timedelta
 from collections import namedtuple
 from types import MappingProxyType
-from typing import Optional, List, Tuple
-from xml.dom import minidom
+from typing import Callable, Optional, List, Iterator
 from google.cloud import storage
 from pathlib import Path
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from functools import partial
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from .cache import Sentinel2Cache
+from .catalog import Sentinel2Catalog
+from .metadata import parse_constraints
+from .scheduler import Pipeline
+from .throttle import AdaptiveLimiter, RateLimiter, RetryPolicy, ERROR_KIND, classify_error
+from .manifest import Sentinel2Manifest
+from .metrics import Metrics, MetricsRecorder, BYTES_BUCKETS, NULL_METRICS
+from .planning import DownloadPlan, PlannedProduct
+from .products import BASELINE, baseline_policy, select_baseline
+from .storage import StorageBackend, GCSStorage, BUCKET_NAME
+from .transfer import ThreadTransfer, BlobResult, STATUS, RANGE_THRESHOLD, file_checksums, match_checksums
 
 logger = logging.getLogger(__name__)
 logging.basicConfig()
 
 PRODUCT_TYPE = namedtuple('type', 'L2A L1C')('L2A', 'L1C')
 
+ENGINE = namedtuple('engine', 'THREADS ASYNC')('threads', 'async')
+
 BANDS = frozenset(('TCI', 'B01', 'B02', 'B03', 'B04', 'B05', 'B06',
                    'B07', 'B08', 'B8A', 'B09', 'B10', 'B11', 'B12', 'CLD'))
 
@@ -24,26 +39,65 @@ CONSTRAINTS = MappingProxyType({'CLOUDY_PIXEL_PERCENTAGE': 100.0, 'NODATA_PIXEL_
 
 FOLDER_SUFFIX = "_$folder$"
 
+# prefix: .SAFE prefix, ex: tiles/36/U/YA/S2A_MSIL1C_20201001T084801_N0209_R107_T36UYA_20201001T094101.SAFE/
+# save_dir: local product directory, results: BlobResult tuples of the product
+ProductComplete = namedtuple('ProductComplete', 'prefix save_dir results')
+
+# listing and metadata stages are served by threads for any engine
+MAX_DISCOVERY_WORKERS = 32
+
+# products named as S2A_OPER_PRD_MSIL1C_PDMC_20160109T..., date in the name is a generation date
+LEGACY_STEM = 'S2A_OPER_'
+LEGACY_NAMING_END = datetime(2016, 12, 6)
+
+
+class DownloadResults(list):
+    """
+    List of BlobResult tuples, report keeps counters and histograms of the run, see MetricsRecorder.report()
+    """
+
+    def __init__(self, results: List[BlobResult], report: Optional[dict] = None):
+        super().__init__(results)
+        self.report = report or dict()
+
 
 class Sentinel2Downloader:
     """
     Class for loading Sentinel2 L1C or L2A images
     """
 
-    def __init__(self, api_key: str, verbose: bool = False):
+    def __init__(self, api_key: str, verbose: bool = False, *,
+                 catalog: Optional[Sentinel2Catalog] = None, client: Optional[storage.Client] = None,
+                 metrics: Optional[Metrics] = None, backend: Optional[StorageBackend] = None):
         """
         :param api_key: str, path to google key, https://cloud.google.com/storage/docs/public-datasets/sentinel-2
         :param verbose: bool, flag, print logging information, default: False
+        :param catalog: Sentinel2Catalog, persistent cache of bucket listings and metadata, default: None
+        :param client: storage.Client, preconfigured storage client, default: None, client is created with api_key
+        :param metrics: Metrics, receives counters and timings of listing, metadata and transfers of every run,
+        ex: a process-wide MetricsRecorder, default: None, only run reports are kept
+        :param backend: StorageBackend, bucket used for listing, metadata and blob reads, ex: MemoryStorage
+        for offline tests and benchmarks, default: None, GCSStorage of gcp-public-data-sentinel-2 with client
         """
         if verbose:
             logger.setLevel(logging.INFO)
         else:
             logger.setLevel(logging.CRITICAL)
-
-        os.environ['GOOGLE_APPLICATION_CREDENTIALS'] = api_key
-        self.client = storage.Client()
-        self.bucket = self.client.get_bucket('gcp-public-data-sentinel-2')
+        # scheduler and transfer engines log through package logger
+        logging.getLogger(__package__).setLevel(logger.level)
+
+        self.catalog = catalog
+        if backend is None:
+            if client is None:
+                os.environ['GOOGLE_APPLICATION_CREDENTIALS'] = api_key
+                client = storage.Client()
+            # no bucket metadata request in offline mode
+            backend = GCSStorage(client, BUCKET_NAME, check=not (catalog and catalog.offline))
+        self.backend = backend
         self.metadata_suffix = 'MTD_TL.xml'
+        self.metrics = metrics or NULL_METRICS
+        # counters and timings of the last run
+        self.run_metrics = MetricsRecorder(forward=self.metrics)
 
     def _filter_by_dates(self, safe_prefixes) -> List[str]:
         # acquired date: 20200812T113607
@@ -51,9 +105,9 @@ class Sentinel2Downloader:
         filtered = list()
         for safe_prefix in safe_prefixes:
             search = re.search(date_pattern, safe_prefix)
+            # dates in %Y%m%d format are compared as strings
             date = search.group(1)
-            date = datetime.strptime(date, '%Y%m%d')
-            if date in self.date_range:
+            if self.start_day <= date <= self.end_day:
                 filtered.append(safe_prefix)
         return filtered
 
@@ -67,19 +121,121 @@ class Sentinel2Downloader:
     def is_dir(blob):
         return blob.name.endswith(FOLDER_SUFFIX)
 
-    @staticmethod
-    def _date_range(start_date, end_date):
-        days = (end_date - start_date).days
-        date_range = [start_date + timedelta(days=delta) for delta in range(0, days + 1)]
-        return date_range
+    def _missions(self, tile_prefix):
+        """
+        Missions with products in the tile, ex: {S2A, S2B}, listed by name stems, thus new missions are found as well
+        :param tile_prefix: str, ex: tiles/36/U/YA/
+        :return: set of str
+        """
+        # product names start with mission, ex: S2A_MSIL1C_20200812T113607_...
+        stems = self._list_prefixes(tile_prefix, delimiter='_')
+        return {stem[len(tile_prefix):-1] for stem in stems}
 
-    def _get_safe_prefixes(self, prefix, delimiter='/'):
-        iterator = self.client.list_blobs(self.bucket, prefix=prefix, delimiter=delimiter)
+    def _date_ranges(self, tile_prefix):
+        """
+        Listing ranges of products acquired within search dates
+        :param tile_prefix: str, ex: tiles/36/U/YA/
+        :return: list, (prefix, start_offset, end_offset) tuples
+        """
+        # end offset is exclusive
+        next_day = (self.end_date + timedelta(days=1)).strftime('%Y%m%d')
+        missions = self._missions(tile_prefix)
+        ranges = list()
+        for mission in sorted(missions):
+            stem = f"{tile_prefix}{mission}_MSI{self.product_type}_"
+            ranges.append((stem, stem + self.start_day, stem + next_day))
+        if self.start_date < LEGACY_NAMING_END and LEGACY_STEM.split('_')[0] in missions:
+            ranges.append((tile_prefix + LEGACY_STEM, None, None))
+        return ranges
+
+    def _request(self, func, *args):
+        """
+        Call a listing or metadata request, transient errors and throttling are retried with backoff
+        """
+        attempt = 0
+        while True:
+            try:
+                return func(*args)
+            except Exception as ex:
+                delay = self.retry.delay(ex, attempt) if self.retry else None
+                if delay is None:
+                    raise
+                logger.info(f"Retrying request in {delay:.1f} s, attempt {attempt + 1}: {str(ex)}")
+                self.run_metrics.increment('request_retries', kind=classify_error(ex))
+                time.sleep(delay)
+                attempt += 1
+
+    def _discover(self, stage, func, item):
+        """
+        Run a discovery step of item, item is skipped if its requests fail after retries, fatal errors are raised
+        """
+        try:
+            return func(item)
+        except Exception as ex:
+            kind = classify_error(ex)
+            if kind == ERROR_KIND.FATAL:
+                raise
+            logger.error(f"Skipping {item}, {stage} requests failed after retries: {str(ex)}")
+            self.run_metrics.increment('discovery_errors', stage=stage, kind=kind)
+            return None
+
+    def _list_pages(self, prefix, delimiter, start_offset, end_offset):
+        prefixes = set()
+        for page in self.backend.list_prefixes(prefix, delimiter, start_offset, end_offset):
+            self.run_metrics.increment('listing_pages')
+            prefixes.update(page)
+        return prefixes
+
+    def _list_prefixes(self, prefix, delimiter='/', start_offset=None, end_offset=None):
+        with self.run_metrics.timer('listing_seconds'):
+            # a failed page is listed again with the whole range
+            return self._request(self._list_pages, prefix, delimiter, start_offset, end_offset)
+
+    def _list_date_ranges(self, prefix, delimiter='/'):
+        # list only products within search dates, not the whole tile history
         prefixes = set()
-        for page in iterator.pages:
-            prefixes.update(page.prefixes)
+        for range_prefix, start_offset, end_offset in self._date_ranges(prefix):
+            prefixes.update(self._list_prefixes(range_prefix, delimiter, start_offset, end_offset))
         return prefixes
 
+    def _get_safe_prefixes(self, prefix, delimiter='/'):
+        if not self.catalog:
+            return self._list_date_ranges(prefix, delimiter)
+
+        known = self.catalog.products(prefix)
+        if known is not None and (self.catalog.offline or self.catalog.is_fresh(prefix, self.start_day, self.end_day)):
+            return known
+        if self.catalog.offline:
+            logger.info(f"Prefix {prefix} is not in catalog, offline mode")
+            return set()
+
+        if known is not None:
+            # synced tile, even one without products: products reprocessed with a new baseline keep sensing dates
+            # of their datatakes, so the whole date window is listed again, not only products newer than known ones
+            prefixes = self._list_date_ranges(prefix, delimiter)
+            self.catalog.update_products(prefix, prefixes, self.start_day, self.end_day)
+        else:
+            prefixes = self._list_prefixes(prefix, delimiter)
+            self.catalog.update_products(prefix, prefixes)
+        logger.info(f"Catalog synced for {prefix}: {len(prefixes - (known or set()))} new products")
+        return prefixes | (known or set())
+
+    def _get_blobs(self, prefix):
+        if self.catalog:
+            blobs = self.catalog.blobs(prefix)
+            if blobs is not None:
+                return blobs
+            if self.catalog.offline:
+                logger.info(f"Prefix {prefix} is not in catalog, offline mode")
+                return list()
+
+        with self.run_metrics.timer('blob_listing_seconds'):
+            blobs = self._request(self.backend.list_blobs, prefix)
+        self.run_metrics.increment('listed_blobs', len(blobs))
+        if self.catalog:
+            self.catalog.update_blobs(prefix, blobs)
+        return blobs
+
     def _file_suffixes(self):
         if self.product_type == 'L2A':
             file_suffixes = list()
@@ -97,31 +253,44 @@ class Sentinel2Downloader:
             file_suffixes = [f"{band}.jp2" for band in self.bands]
         return file_suffixes
 
+    def _parse_constraints(self, metadata_blob):
+        with self.run_metrics.timer('metadata_fetch_seconds'):
+            return self._request(parse_constraints, self.backend, metadata_blob, self.constraints)
+
+    def _constraint_values(self, metadata_blob):
+        if not self.catalog:
+            return self._parse_constraints(metadata_blob)
+
+        values = self.catalog.constraint_values(metadata_blob.name, metadata_blob.generation) or dict()
+        if not set(self.constraints).issubset(values):
+            if self.catalog.offline:
+                raise ValueError("metadata is not in catalog, offline mode")
+            values.update(self._parse_constraints(metadata_blob))
+            self.catalog.update_constraint_values(metadata_blob.name, metadata_blob.generation, values)
+        return values
+
     def _match_constraints(self, metadata_blob):
-        try:
-            metadata = metadata_blob.download_as_string()
-            xml_dom = minidom.parseString(metadata)
-
-            for constraint, value in self.constraints.items():
-                xml_node = xml_dom.getElementsByTagName(constraint)
-                if xml_node:
-                    parsed_value = float(xml_node[0].firstChild.data)
-                    logger.info(f"Blob: {metadata_blob.name}, "
-                                f"constraint {constraint}:{value}, parsed value: {parsed_value}")
-                    if parsed_value > value:
-                        return False
-                else:
-                    logger.info(f"Constraint: {constraint} not present in metadata: {metadata_blob.name}")
-        except Exception as ex:
-            logger.info(f"Error parsing blob metadata: {metadata_blob.name}: {str(ex)}")
-            return False
-        else:
-            return True
+        """
+        :return: bool, metadata matches constraints, errors of reading metadata are raised
+        """
+        values = self._constraint_values(metadata_blob)
+
+        for constraint, value in self.constraints.items():
+            parsed_value = values[constraint]
+            if parsed_value is not None:
+                logger.info(f"Blob: {metadata_blob.name}, "
+                            f"constraint {constraint}:{value}, parsed value: {parsed_value}")
+                if parsed_value > value:
+                    return False
+            else:
+                logger.info(f"Constraint: {constraint} not present in metadata: {metadata_blob.name}")
+        return True
 
     def get_save_path(self, blob):
         if self.full_download:
             name = blob.name
-            # extract full path, for ex: S2A_MSIL1C_20201001T084801_N0209_R107_T36UYA_20201001T094101.SAFE/rep_info_$folder$
+            # extract full path,
+            # for ex: S2A_MSIL1C_20201001T084801_N0209_R107_T36UYA_20201001T094101.SAFE/rep_info_$folder$
             search = re.search(r"([^/]+\.SAFE.*)", name)
             file_path = search.group(1)
             if self.is_dir(blob):
@@ -135,79 +304,235 @@ class Sentinel2Downloader:
             save_path = Path(self.output_dir) / Path(save_dir) / Path(name).name
         return save_path
 
+    def _match_product(self, metadata_blobs) -> bool:
+        for metadata_blob in metadata_blobs:
+            try:
+                matched = self._match_constraints(metadata_blob)
+            except Exception as ex:
+                # unreadable metadata is not a constraint rejection
+                logger.error(f"Skipping product, error reading blob metadata: {metadata_blob.name}: {str(ex)}")
+                self.run_metrics.increment('metadata_errors', kind=classify_error(ex))
+                return False
+            if not matched:
+                self.run_metrics.increment('products_rejected')
+                return False
+        return True
+
     def _filter_by_suffix(self, blobs, file_suffixes):
-        blobs_to_load = set()
+        # check metadata first, band blobs are considered only for matching products
+        metadata_blobs = [blob for blob in blobs if blob.name.endswith(self.metadata_suffix)]
+        if not self._match_product(metadata_blobs):
+            return
+
+        blobs_to_load = set(metadata_blobs)
         for blob in blobs:
-            if blob.name.endswith(self.metadata_suffix):
-                if not self._match_constraints(blob):
-                    return
-                else:
-                    blobs_to_load.add(blob)
             for suffix in file_suffixes:
                 if blob.name.endswith(suffix):
                     blobs_to_load.add(blob)
         return blobs_to_load
 
-    def _get_blobs_to_load(self, prefixes):
-        blobs_to_load = set()
-        file_suffixes = self._file_suffixes()
-        for prefix in prefixes:
-            granule_prefix = prefix + "GRANULE/"
-            blobs = list(self.client.list_blobs(self.bucket, prefix=granule_prefix))
-
-            granule_blobs = self._filter_by_suffix(blobs, file_suffixes)
-            if granule_blobs:
-                blobs_to_load.update(granule_blobs)
-
-        return blobs_to_load
+    def _get_granule_blobs(self, prefix, file_suffixes):
+        granule_prefix = prefix + "GRANULE/"
+        blobs = self._get_blobs(granule_prefix)
+        return self._filter_by_suffix(blobs, file_suffixes)
 
     def _get_filtered_prefixes(self, tile_prefix) -> List[str]:
         # filter store items by base prefix, ex: tiles/36/U/YA/
         safe_prefixes = self._get_safe_prefixes(tile_prefix)
         # filter .SAFE paths by date range
         filtered_prefixes = self._filter_by_dates(safe_prefixes)
+        # reprocessed datatakes are listed under every processing baseline
+        filtered_prefixes = select_baseline(sorted(filtered_prefixes), self.baseline)
+        if self.product_filter:
+            # ex: S2A_MSIL1C_20201001T084801_N0209_R107_T36UYA_20201001T094101.SAFE
+            filtered_prefixes = [prefix for prefix in filtered_prefixes
+                                 if self.product_filter(prefix.rstrip('/').rsplit('/', 1)[-1])]
         return filtered_prefixes
 
-    def _download_blob(self, blob, save_path) -> Tuple[str, str]:
+    def _verify_local(self, blob, save_path) -> Optional[str]:
+        """
+        :return: str, status of local file matching remote blob or None if blob has to be transferred
+        """
+        if self.manifest.is_synced(save_path, blob):
+            logger.info(f"Blob {save_path} is in sync, skipping download")
+            return STATUS.SKIPPED
+        # local file unknown to manifest or changed, hashed once
+        if os.path.getsize(save_path) == blob.size and match_checksums(blob, *file_checksums(save_path)):
+            logger.info(f"Blob {save_path} matches remote checksums, skipping download")
+            self.manifest.record(save_path, blob)
+            return STATUS.VERIFIED
+        logger.info(f"Blob {save_path} doesn't match remote blob, loading again")
+        return None
+
+    def _local_status(self, blob, save_path) -> Optional[str]:
+        """
+        :return: str, status of local blob or None if blob has to be transferred
+        """
         # check if file exists
         if save_path.is_file():
-            logger.info(f"Blob {save_path} exists, skipping download")
-            # update mtime thus tile is not evicted from cache
-            save_path.touch()
-            return str(save_path), blob.name
+            if self.manifest:
+                status = self._verify_local(blob, save_path)
+                if status:
+                    return status
+            else:
+                logger.info(f"Blob {save_path} exists, skipping download")
+                # update mtime thus tile is not evicted from cache
+                save_path.touch()
+                return STATUS.SKIPPED
         if self.is_dir(blob):
             Path.mkdir(save_path, parents=True, exist_ok=True)
-            return str(save_path), blob.name
+            return STATUS.SKIPPED
 
         Path.mkdir(save_path.parent, parents=True, exist_ok=True)
-
-        with open(save_path, 'wb') as file:
-            blob.download_to_file(file)
-        logger.info(f"Loaded {blob.name}")
-        return str(save_path), blob.name
-
-    def _download_blobs_mult(self, blobs) -> List[Tuple[str, str]]:
-        results = list()
-        with ThreadPoolExecutor(max_workers=self.cores) as executor:
-            future_to_blob = {executor.submit(self._download_blob, blob, self.get_save_path(blob)): blob.name
-                              for blob in blobs}
-            for future in as_completed(future_to_blob):
-                blob_name = future_to_blob[future]
-                try:
-                    result = future.result()
-                    results.append(result)
-                except Exception as ex:
-                    logger.info(f"Error while loading {blob_name}: {str(ex)}")
-                    results.append((None, blob_name))
-        return results
+        return None
+
+    def _record(self, blob, save_path, future):
+        if future.result()[0]:
+            self.manifest.record(save_path, blob)
+
+    def _cache_product(self, save_path):
+        product = self.cache.product_name(save_path)
+        if product not in self._active_products:
+            # products of this download are not evicted until it ends
+            self.cache.activate(product)
+            self._active_products.add(product)
+        return product
+
+    def _release_products(self):
+        for product in self._active_products:
+            self.cache.deactivate(product)
+        self._active_products = set()
+
+    def _list_tile(self, tile):
+        logger.info(f"Loading blobs for tile {tile}...")
+        tile_prefix = self._tile_prefix(tile)
+        return self._discover('listing', self._get_filtered_prefixes, tile_prefix)
+
+    def _product_blobs(self, prefix):
+        if self.full_download:
+            blobs = self._get_blobs(prefix)
+            # granule metadata, product level metadata is MTD_MSIL1C.xml or MTD_MSIL2A.xml
+            metadata_blobs = [blob for blob in blobs if blob.name.endswith(self.metadata_suffix)]
+            return blobs if self._match_product(metadata_blobs) else None
+        return self._get_granule_blobs(prefix, self.file_suffixes)
+
+    def _register_product(self, prefix, blobs):
+        if blobs:
+            # registered before blobs are passed to transfer
+            with self._products_lock:
+                if prefix in self._products:
+                    logger.info(f"Skipping {prefix}, it is loaded already")
+                    return None
+                self._products[prefix] = [len(blobs), list()]
+        return blobs
+
+    def _list_product(self, prefix):
+        return self._register_product(prefix, self._discover('metadata', self._product_blobs, prefix))
+
+    def _planned_blobs(self, product: PlannedProduct):
+        return self._register_product(product.prefix, product.blobs)
+
+    def _complete_product(self, result) -> Optional[ProductComplete]:
+        prefix = re.search(r"^(.*?\.SAFE/)", result[1]).group(1)
+        with self._products_lock:
+            product = self._products.get(prefix)
+            if product is None:
+                return None
+            product[0] -= 1
+            product[1].append(result)
+            if product[0]:
+                return None
+            del self._products[prefix]
+
+        name = re.search(r"([^/]+)\.SAFE/$", prefix).group(1)
+        save_dir = Path(self.output_dir) / (f"{name}.SAFE" if self.full_download else name)
+        return ProductComplete(prefix, str(save_dir), product[1])
+
+    def _submit(self, engine, blob) -> Future:
+        save_path = self.get_save_path(blob)
+        try:
+            product = self._cache_product(save_path) if self.cache else None
+            status = self._local_status(blob, save_path)
+            if status is None:
+                if self.cache:
+                    # make room before transfer starts, an outdated local copy is replaced once it is complete
+                    replaced = save_path.stat().st_size if save_path.is_file() else 0
+                    self.cache.reserve(product, blob.size or 0)
+                started = time.perf_counter()
+                future = engine.submit(blob, save_path)
+                future.add_done_callback(partial(self._observe_transfer, started))
+                if self.manifest:
+                    future.add_done_callback(partial(self._record, blob, save_path))
+                if self.cache:
+                    future.add_done_callback(
+                        lambda done: self.cache.commit(product, blob.size or 0, loaded=bool(done.result()[0]),
+                                                       replaced=replaced))
+                return future
+            if self.cache:
+                self.cache.hit(product)
+            result = BlobResult(str(save_path), blob.name, status)
+        except Exception as ex:
+            logger.info(f"Error while loading {blob.name}: {str(ex)}")
+            result = BlobResult(None, blob.name, STATUS.FAILED)
+        future = Future()
+        future.set_result(result)
+        return future
+
+    def _observe_transfer(self, started, future):
+        if future.cancelled():
+            return
+        # every attempt is timed, retries included
+        self.run_metrics.observe('transfer_seconds', time.perf_counter() - started)
+        if future.exception() is None and future.result().size:
+            self.run_metrics.observe('blob_bytes', future.result().size, BYTES_BUCKETS)
+
+    def _create_engine(self):
+        # engine is sized for the upper limit of adaptive concurrency
+        workers = self.max_cores or self.cores
+        rate = RateLimiter(self.bandwidth) if self.bandwidth else None
+        if self.engine == ENGINE.ASYNC:
+            from .aio import AsyncTransfer
+            return AsyncTransfer(self.backend.name, workers, base_url=self.backend.base_url,
+                                 credentials=self.backend.credentials, range_threshold=self.range_threshold, rate=rate)
+        return ThreadTransfer(self.backend, workers, range_threshold=self.range_threshold, rate=rate)
+
+    def _discovery_stages(self):
+        workers = min(self.cores, MAX_DISCOVERY_WORKERS)
+        return [("listing", self._list_tile, max(1, min(len(self.tiles), workers))),
+                ("metadata", self._list_product, workers), ]
+
+    def _pipeline(self, engine, stages):
+        limiter = AdaptiveLimiter(self.cores, maximum=self.max_cores)
+        return Pipeline(stages, lambda blob: self._submit(engine, blob), concurrency=limiter, retry=self.retry,
+                        metrics=self.run_metrics)
 
     def _setup(self, product_type, tiles, start_date, end_date, bands,
-               constraints, output_dir, cores, full_download):
+               constraints, output_dir, cores, full_download, engine=ENGINE.THREADS,
+               range_threshold=RANGE_THRESHOLD, sync=False, cache=None, max_cores=None, bandwidth=None, retries=3,
+               product_filter=None, baseline=BASELINE.LATEST):
         if product_type not in PRODUCT_TYPE:
             raise ValueError(f"Provide proper Sentinel2 type: {PRODUCT_TYPE}")
         self.product_type = product_type
-
-        self.tiles = tiles
+        self.run_metrics = MetricsRecorder(forward=self.metrics)
+
+        if engine not in ENGINE:
+            raise ValueError(f"Provide proper download engine: {ENGINE}")
+        if engine == ENGINE.ASYNC and not isinstance(self.backend, GCSStorage):
+            raise ValueError(f"{ENGINE.ASYNC} engine loads blobs with GCS JSON API requests, it needs GCSStorage")
+        self.engine = engine
+        self.range_threshold = range_threshold
+        self.manifest = Sentinel2Manifest(output_dir) if sync else None
+
+        if cache and Path(output_dir).resolve() != cache.output_dir.resolve():
+            raise ValueError(f"Cache directory {cache.output_dir} differs from output directory {output_dir}")
+        self.cache = cache
+        self._active_products = set()
+        # .SAFE prefix to [blobs left, results]
+        self._products = dict()
+        self._products_lock = threading.Lock()
+
+        # repeated tiles are listed and loaded once
+        self.tiles = list(dict.fromkeys(tiles))
 
         format = '%Y-%m-%d'
         if end_date:
@@ -221,7 +546,10 @@ class Sentinel2Downloader:
             delta = 10
             start_date = end_date - timedelta(days=delta)
 
-        self.date_range = self._date_range(start_date, end_date)
+        self.start_date = start_date
+        self.end_date = end_date
+        self.start_day = start_date.strftime('%Y%m%d')
+        self.end_day = end_date.strftime('%Y%m%d')
         logger.info(f"Search date range from {start_date} to {end_date}")
 
         bands = set(bands).intersection(BANDS)
@@ -232,8 +560,76 @@ class Sentinel2Downloader:
 
         self.constraints = constraints
         self.output_dir = output_dir
+        if max_cores and max_cores < cores:
+            raise ValueError(f"max_cores {max_cores} is less than cores {cores}")
         self.cores = cores
+        self.max_cores = max_cores
+        self.bandwidth = bandwidth
+        self.retries = retries
+        # shared by transfers, listing and metadata requests
+        self.retry = RetryPolicy(retries) if retries else None
+        self.product_filter = product_filter
+        self.baseline = baseline_policy(baseline)
         self.full_download = full_download
+        self.file_suffixes = self._file_suffixes()
+
+    def download_iter(self,
+                      product_type: str,
+                      tiles: list,
+                      *,
+                      start_date: Optional[str] = None,
+                      end_date: Optional[str] = None,
+                      bands: set = BANDS,
+                      constraints: dict = CONSTRAINTS,
+                      output_dir: str = './sentinel2imagery',
+                      cores: int = 5,
+                      full_download: bool = False,
+                      engine: str = ENGINE.THREADS,
+                      range_threshold: Optional[int] = RANGE_THRESHOLD,
+                      sync: bool = False,
+                      cache: Optional[Sentinel2Cache] = None,
+                      max_cores: Optional[int] = None,
+                      bandwidth: Optional[int] = None,
+                      retries: int = 3,
+                      baseline: str = BASELINE.LATEST,
+                      product_filter: Optional[Callable[[str], bool]] = None) -> Iterator:
+        """
+        Stream download results as soon as blobs are loaded, parameters are the same as in download().
+        Transfers are held back while results are not consumed, closing the iterator cancels the download.
+        :param product_filter: callable, called from listing threads with .SAFE product name,
+        products it returns False for are not loaded, default: None, all products within dates and constraints
+        :return: iterator of BlobResult (save_path, blob_name) tuples and ProductComplete events,
+        ProductComplete is yielded once all blobs of a product are loaded
+        """
+
+        self._setup(product_type, tiles, start_date, end_date, bands, constraints, output_dir, cores, full_download,
+                    engine, range_threshold, sync, cache, max_cores, bandwidth, retries, product_filter, baseline)
+
+        yield from self._stream(self._discovery_stages(), self.tiles)
+
+    def _stream(self, stages, items) -> Iterator:
+        self.backend.share_connections((self.max_cores or self.cores) * 2 + len(self.tiles))
+        engine = self._create_engine()
+        results = self._pipeline(engine, stages).run(items)
+        try:
+            for result in results:
+                self.run_metrics.increment('blobs', status=result.status)
+                if result.size:
+                    self.run_metrics.increment('bytes', result.size)
+                yield result
+                product = self._complete_product(result)
+                if product:
+                    self.run_metrics.increment('products')
+                    logger.info(f"Finished loading product {product.prefix}")
+                    yield product
+        finally:
+            results.close()
+            engine.close()
+            if self.manifest:
+                self.manifest.close()
+            if self.cache:
+                self._release_products()
+                logger.info(f"Cache stats: {self.cache.stats()}")
 
     def download(self,
                  product_type: str,
@@ -245,7 +641,15 @@ class Sentinel2Downloader:
                  constraints: dict = CONSTRAINTS,
                  output_dir: str = './sentinel2imagery',
                  cores: int = 5,
-                 full_download: bool = False) -> Optional[List]:
+                 full_download: bool = False,
+                 engine: str = ENGINE.THREADS,
+                 range_threshold: Optional[int] = RANGE_THRESHOLD,
+                 sync: bool = False,
+                 cache: Optional[Sentinel2Cache] = None,
+                 max_cores: Optional[int] = None,
+                 bandwidth: Optional[int] = None,
+                 retries: int = 3,
+                 baseline: str = BASELINE.LATEST) -> Optional[DownloadResults]:
         """
         :param product_type: str, "L2A" or "L1C" Sentinel2 products
         :param tiles: list, tiles to load (ex: {36UYA, 36UYB})
@@ -256,35 +660,134 @@ class Sentinel2Downloader:
         :param constraints: dict, constraints that blobs must match, default: {'CLOUDY_PIXEL_PERCENTAGE': 100.0, },
         for L2A product_type, 'NODATA_PIXEL_PERCENTAGE' can be added
         :param output_dir: str, path to loading dir, default: './sentinel2imagery'
-        :param cores: int, number of cores, default: 5
+        :param cores: int, number of cores, for "async" engine number of concurrent requests, default: 5
         :param full_download: bool, option for full download of Sentinel-2 .SAFE folder, default: False
+        :param engine: str, "threads" or "async" download engine, default: "threads". "async" engine runs
+        concurrent requests on a keep-alive connection pool to the endpoint of GCSStorage backend and needs aiohttp,
+        use it with cores of 100 and more
+        :param range_threshold: int, blobs larger than threshold in bytes are loaded in parallel byte ranges,
+        None disables ranges, default: 64 MB. Blobs are written to .part files and renamed when complete,
+        interrupted transfers are resumed on the next call
+        :param sync: bool, compare local files with remote size and crc32c/md5 through a manifest in output_dir
+        instead of existence check, only missing or mismatched blobs are loaded, default: False
+        :param cache: Sentinel2Cache, size-bounded LRU cache of output_dir, least recently used products are evicted
+        before transfers that exceed the budget, default: None
+        :param max_cores: int, upper limit of adaptive concurrency, number of in-flight transfers starts at cores
+        and is raised while throughput grows and lowered on throttling (429/503) and errors, default: None, fixed cores
+        :param bandwidth: int, global download cap in bytes per second, default: None, no cap
+        :param retries: int, number of retries of transient errors, throttling and checksum mismatches
+        of transfers, listing and metadata requests with jittered exponential backoff, default: 3
+        :param baseline: str, products of a datatake reprocessed with several processing baselines to load:
+        "latest" baseline only, "all" of them, or a baseline number as "N0209", default: "latest"
         :return: [tuple, None], tuples (save_path, blob_name), if save_path is None, the blob not loaded
-        or None if nothing to load
+        or None if nothing to load. Tuples are BlobResult, their status is one of STATUS:
+        downloaded, verified (existing file matches remote checksums), skipped or failed.
+        The list is DownloadResults, its report keeps elapsed seconds, bytes_per_second, counters of blobs by status,
+        bytes, products, listing pages, retries and errors, products rejected by constraints, tiles and products
+        skipped on listing and metadata errors, histograms of listing, metadata and transfer timings
         """
 
-        self._setup(product_type, tiles, start_date, end_date, bands, constraints, output_dir, cores, full_download)
-
         logger.info("Start downloading...")
         start_time = time.time()
-        results = list()
-        for tile in tiles:
-            logger.info(f"Loading blobs for tile {tile}...")
-
-            tile_prefix = self._tile_prefix(tile)
-            filtered_prefixes = self._get_filtered_prefixes(tile_prefix)
-            if self.full_download:
-                for prefix in filtered_prefixes:
-                    blobs = list(self.client.list_blobs(self.bucket, prefix=prefix))
-                    if blobs:
-                        result = self._download_blobs_mult(blobs)
-                        results.extend(result)
-            else:
-                blobs_to_load = self._get_blobs_to_load(filtered_prefixes)
-                result = self._download_blobs_mult(blobs_to_load)
-                results.extend(result)
-            logger.info(f"Finished loading blobs for tile {tile}")
-
+        results = [result for result in self.download_iter(product_type,
+                                                           tiles,
+                                                           start_date=start_date,
+                                                           end_date=end_date,
+                                                           bands=bands,
+                                                           constraints=constraints,
+                                                           output_dir=output_dir,
+                                                           cores=cores,
+                                                           full_download=full_download,
+                                                           engine=engine,
+                                                           range_threshold=range_threshold,
+                                                           sync=sync,
+                                                           cache=cache,
+                                                           max_cores=max_cores,
+                                                           bandwidth=bandwidth,
+                                                           retries=retries,
+                                                           baseline=baseline)
+                   if not isinstance(result, ProductComplete)]
+
+        return self._results(results, start_time)
+
+    def _results(self, results, start_time) -> DownloadResults:
+        report = self.run_metrics.report()
+        report['bytes_per_second'] = self.run_metrics.counter('bytes') / max(report['elapsed'], 1e-9)
         logger.info(f"Loaded: {len([r[0] for r in results if r[0]])} blobs")
         logger.info(f"Finished loading at {time.strftime('%H:%M:%S', time.gmtime(time.time() - start_time))}")
+        return DownloadResults(results, report)
+
+    def plan(self,
+             product_type: str,
+             tiles: list,
+             *,
+             start_date: Optional[str] = None,
+             end_date: Optional[str] = None,
+             bands: set = BANDS,
+             constraints: dict = CONSTRAINTS,
+             cores: int = 5,
+             full_download: bool = False,
+             baseline: str = BASELINE.LATEST) -> DownloadPlan:
+        """
+        Resolve products matching dates and constraints and their blobs with sizes, only granule metadata is read,
+        with full_download as well, parameters are the same as in download()
+        :return: DownloadPlan, to be saved, split into shards and executed with download_plan()
+        """
+        logger.info("Start planning...")
+        start_time = time.time()
+        self._setup(product_type, tiles, start_date, end_date, bands, constraints, None, cores, full_download,
+                    baseline=baseline)
+
+        workers = min(cores, MAX_DISCOVERY_WORKERS)
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            prefixes = sorted(prefix for prefixes in executor.map(self._list_tile, self.tiles)
+                              for prefix in prefixes or ())
+            product_blobs = executor.map(partial(self._discover, 'metadata', self._product_blobs), prefixes)
+            products = [PlannedProduct(prefix, sorted(blobs, key=lambda blob: blob.name))
+                        for prefix, blobs in zip(prefixes, product_blobs) if blobs]
+
+        plan = DownloadPlan(product_type, products, full_download=full_download, bands=self.bands, tiles=tiles,
+                            start_date=self.start_date.strftime('%Y-%m-%d'),
+                            end_date=self.end_date.strftime('%Y-%m-%d'), constraints=constraints)
+        logger.info(f"Planned {len(plan)} products, {plan.blob_count} blobs, {plan.size} bytes")
+        if self.run_metrics.counter('discovery_errors') or self.run_metrics.counter('metadata_errors'):
+            logger.error(f"Plan is incomplete, listing or metadata requests failed: "
+                         f"{self.run_metrics.report()['counters']}")
+        logger.info(f"Finished planning at {time.strftime('%H:%M:%S', time.gmtime(time.time() - start_time))}")
+        return plan
+
+    def download_plan_iter(self,
+                           plan: DownloadPlan,
+                           *,
+                           output_dir: str = './sentinel2imagery',
+                           cores: int = 5,
+                           engine: str = ENGINE.THREADS,
+                           range_threshold: Optional[int] = RANGE_THRESHOLD,
+                           sync: bool = False,
+                           cache: Optional[Sentinel2Cache] = None,
+                           max_cores: Optional[int] = None,
+                           bandwidth: Optional[int] = None,
+                           retries: int = 3) -> Iterator:
+        """
+        Stream download results of a plan or a shard, no listing or metadata requests are made,
+        parameters are the same as in download()
+        :return: iterator of BlobResult tuples and ProductComplete events, the same as download_iter()
+        """
+        self._setup(plan.product_type, plan.tiles, plan.start_date, plan.end_date, plan.bands, plan.constraints,
+                    output_dir, cores, plan.full_download, engine, range_threshold, sync, cache, max_cores,
+                    bandwidth, retries)
+
+        yield from self._stream([("plan", self._planned_blobs, 1), ], plan.products)
+
+    def download_plan(self, plan: DownloadPlan, **kwargs) -> Optional[DownloadResults]:
+        """
+        :param plan: DownloadPlan, plan or its shard, ex: DownloadPlan.load('shard-0.json')
+        :param kwargs: download options of download_plan_iter()
+        :return: list, BlobResult tuples with a run report, the same as download()
+        """
+        logger.info(f"Start downloading plan of {len(plan)} products, {plan.size} bytes...")
+        start_time = time.time()
+        results = [result for result in self.download_plan_iter(plan, **kwargs)
+                   if not isinstance(result, ProductComplete)]
 
-        return results
+        return self._results(results, start_time)
@@ -0,0 +1,67 @@
+import os
+import sqlite3
+import threading
+
+from collections import namedtuple
+from pathlib import Path
+from typing import Optional
+
+ManifestEntry = namedtuple('ManifestEntry', 'blob_name generation size crc32c md5_hash mtime_ns')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, blob_name TEXT NOT NULL, generation INTEGER, size INTEGER,
+                                  crc32c TEXT, md5_hash TEXT, mtime_ns INTEGER NOT NULL);
+"""
+
+
+class Sentinel2Manifest:
+    """
+    Manifest of loaded blobs and their remote checksums, stored in the output directory.
+    Local files that match their manifest entries are not hashed again.
+    """
+
+    FILE_NAME = '.sentinel2manifest.sqlite'
+
+    def __init__(self, output_dir: str):
+        """
+        :param output_dir: str, downloader output directory
+        """
+        self.output_dir = Path(output_dir)
+        self.output_dir.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(str(self.output_dir / self.FILE_NAME), check_same_thread=False)
+        self._connection.executescript(SCHEMA)
+
+    def _key(self, save_path):
+        return os.path.relpath(save_path, self.output_dir)
+
+    def get(self, save_path) -> Optional[ManifestEntry]:
+        with self._lock:
+            row = self._connection.execute("SELECT blob_name, generation, size, crc32c, md5_hash, mtime_ns "
+                                           "FROM files WHERE path = ?", (self._key(save_path),)).fetchone()
+        return ManifestEntry(*row) if row else None
+
+    def is_synced(self, save_path, blob) -> bool:
+        """
+        :return: bool, True if local file wasn't changed since it was recorded for the same remote blob
+        """
+        entry = self.get(save_path)
+        if entry is None:
+            return False
+        stat = os.stat(save_path)
+        return (entry.blob_name, entry.generation, entry.size, entry.crc32c, entry.md5_hash) == \
+               (blob.name, blob.generation, blob.size, blob.crc32c, blob.md5_hash) and \
+               (stat.st_size, stat.st_mtime_ns) == (entry.size, entry.mtime_ns)
+
+    def record(self, save_path, blob):
+        mtime_ns = os.stat(save_path).st_mtime_ns
+        with self._lock, self._connection:
+            self._connection.execute("INSERT OR REPLACE INTO files "
+                                     "(path, blob_name, generation, size, crc32c, md5_hash, mtime_ns) "
+                                     "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                                     (self._key(save_path), blob.name, blob.generation, blob.size,
+                                      blob.crc32c, blob.md5_hash, mtime_ns))
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
@@ -0,0 +1,53 @@
+from typing import Dict, Optional
+from xml.etree.ElementTree import XMLPullParser
+
+
+class ConstraintsFound(Exception):
+    pass
+
+
+class ConstraintsStream:
+    """
+    Write-only file-like object that parses streamed metadata and stops the download
+    as soon as all constraint tags are found
+    """
+
+    def __init__(self, constraints):
+        """
+        :param constraints: iterable, metadata tags to parse, ex: {'CLOUDY_PIXEL_PERCENTAGE', }
+        """
+        self.constraints = set(constraints)
+        self.values = dict()
+        self._parser = XMLPullParser(events=('end',))
+
+    def write(self, data):
+        self._parser.feed(data)
+        for _, element in self._parser.read_events():
+            # strip namespace, ex: {https://psd-14.sentinel2.eo.esa.int/...}Quality_Indicators_Info
+            tag = element.tag.rsplit('}', 1)[-1]
+            if tag in self.constraints:
+                self.values[tag] = float(element.text)
+            element.clear()
+        if self.constraints.issubset(self.values):
+            raise ConstraintsFound()
+        return len(data)
+
+    def close(self):
+        self._parser.close()
+
+
+def parse_constraints(backend, blob, constraints) -> Dict[str, Optional[float]]:
+    """
+    Stream metadata blob into incremental XML parser
+    :param backend: StorageBackend, bucket to read the blob from
+    :param blob: BlobInfo, metadata blob, ex: MTD_TL.xml
+    :param constraints: iterable, metadata tags to parse
+    :return: dict, parsed values, None value means tag is absent in metadata
+    """
+    stream = ConstraintsStream(constraints)
+    try:
+        backend.read(blob, stream)
+        stream.close()
+    except ConstraintsFound:
+        pass
+    return {constraint: stream.values.get(constraint) for constraint in stream.constraints}
@@ -0,0 +1,241 @@
+import os
+import json
+import time
+import bisect
+import threading
+
+from pathlib import Path
+from typing import Dict, Optional, Sequence, Tuple
+
+# upper bounds of histogram buckets
+SECONDS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0, 1800.0, 3600.0)
+# 1 KB to 16 GB
+BYTES_BUCKETS = tuple(float(2 ** power) for power in range(10, 35, 2))
+
+
+class _NullTimer:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+_NULL_TIMER = _NullTimer()
+
+
+class Metrics:
+    """
+    Instrumentation surface of downloader, overlap and converter: counters, timers and histograms with labels.
+    The base class records nothing, subclass it to send events elsewhere.
+    """
+
+    def increment(self, name: str, value: float = 1, **labels):
+        """
+        :param name: str, counter name, ex: blobs
+        :param value: float, increment
+        :param labels: str, label values, ex: status="downloaded"
+        """
+
+    def observe(self, name: str, value: float, buckets: Sequence[float] = SECONDS_BUCKETS, **labels):
+        """
+        :param name: str, histogram name, ex: transfer_seconds
+        :param value: float, observed value
+        :param buckets: sequence, upper bounds of histogram buckets, used on the first observation of a histogram
+        :param labels: str, label values
+        """
+
+    def timer(self, name: str, **labels):
+        """
+        :return: context manager, elapsed seconds of its block are observed in histogram name
+        """
+        return _NULL_TIMER
+
+
+NULL_METRICS = Metrics()
+
+
+class _Timer:
+    __slots__ = ('metrics', 'name', 'labels', 'start')
+
+    def __init__(self, metrics, name, labels):
+        self.metrics = metrics
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.metrics.observe(self.name, time.perf_counter() - self.start, **self.labels)
+        return False
+
+
+class _Histogram:
+    __slots__ = ('buckets', 'counts', 'count', 'sum', 'min', 'max')
+
+    def __init__(self, buckets):
+        self.buckets = tuple(buckets)
+        # the last count is +Inf bucket
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.min = None
+        self.max = None
+
+    def add(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+
+    def merge(self, other):
+        if other.buckets != self.buckets:
+            raise ValueError("Histograms with different buckets can't be merged")
+        self.counts = [count + other_count for count, other_count in zip(self.counts, other.counts)]
+        self.count += other.count
+        self.sum += other.sum
+        for value in (other.min, other.max):
+            if value is not None:
+                self.min = value if self.min is None else min(self.min, value)
+                self.max = value if self.max is None else max(self.max, value)
+
+    def summary(self) -> dict:
+        return dict(count=self.count, sum=self.sum, min=self.min, max=self.max,
+                    mean=self.sum / self.count if self.count else None,
+                    buckets={str(bound): count for bound, count in zip(self.buckets + ('+Inf', ), self.counts)})
+
+
+def _series(name, labels) -> str:
+    if not labels:
+        return name
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in labels)
+    return name + '{' + ','.join(f'{label}="{value}"' for (label, _), value in zip(labels, escaped)) + '}'
+
+
+def _write_atomic(path, text):
+    path = Path(path)
+    tmp_path = path.with_name(f"{path.name}.tmp")
+    tmp_path.write_text(text)
+    os.replace(str(tmp_path), str(path))
+
+
+class MetricsRecorder(Metrics):
+    """
+    Thread-safe in-memory counters and histograms with JSON and Prometheus textfile exporters.
+    Events are forwarded to another Metrics, thus a run recorder can feed a process-wide one.
+    """
+
+    def __init__(self, forward: Optional[Metrics] = None):
+        """
+        :param forward: Metrics, receives every recorded event, default: None, events are not forwarded
+        """
+        self.forward = forward or NULL_METRICS
+        self.started_at = time.time()
+        self._counters = dict()
+        self._histograms = dict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(name, labels) -> Tuple[str, tuple]:
+        return name, tuple(sorted(labels.items()))
+
+    def increment(self, name: str, value: float = 1, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+        self.forward.increment(name, value, **labels)
+
+    def observe(self, name: str, value: float, buckets: Sequence[float] = SECONDS_BUCKETS, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = _Histogram(buckets)
+            histogram.add(value)
+        self.forward.observe(name, value, buckets, **labels)
+
+    def timer(self, name: str, **labels):
+        return _Timer(self, name, labels)
+
+    def counter(self, name: str, **labels) -> float:
+        """
+        :return: float, sum of counter series having given label values
+        """
+        with self._lock:
+            return sum(value for (series, series_labels), value in self._counters.items()
+                       if series == name and set(labels.items()) <= set(series_labels))
+
+    def merge(self, other: 'MetricsRecorder'):
+        """
+        Add counters and histograms of another recorder, merged events are not forwarded
+        """
+        with other._lock:
+            counters = dict(other._counters)
+            histograms = list(other._histograms.items())
+        with self._lock:
+            for key, value in counters.items():
+                self._counters[key] = self._counters.get(key, 0) + value
+            for key, other_histogram in histograms:
+                histogram = self._histograms.get(key)
+                if histogram is None:
+                    histogram = self._histograms[key] = _Histogram(other_histogram.buckets)
+                histogram.merge(other_histogram)
+            self.started_at = min(self.started_at, other.started_at)
+
+    def report(self) -> Dict[str, object]:
+        """
+        :return: dict, started_at, elapsed seconds, counters and histogram summaries by series,
+        ex: {'counters': {'blobs{status="downloaded"}': 10}, 'histograms': {'transfer_seconds': {'count': 10, ...}}}
+        """
+        with self._lock:
+            counters = {_series(*key): value for key, value in sorted(self._counters.items())}
+            histograms = {_series(*key): histogram.summary() for key, histogram in sorted(self._histograms.items())}
+        return dict(started_at=self.started_at, elapsed=time.time() - self.started_at,
+                    counters=counters, histograms=histograms)
+
+    def write_json(self, path: str, **extra):
+        """
+        :param path: str, JSON summary file, written atomically
+        :param extra: values added to the summary, ex: run="backfill-2020"
+        """
+        _write_atomic(path, json.dumps(dict(self.report(), **extra), indent=2))
+
+    def prometheus(self, namespace: str = 'sentinel2') -> str:
+        """
+        :return: str, metrics in Prometheus text exposition format, counters get _total suffix
+        """
+        with self._lock:
+            counters = sorted(self._counters.items())
+            histograms = sorted((key, histogram.summary(), histogram) for key, histogram in self._histograms.items())
+        lines = list()
+        typed = set()
+        for (name, labels), value in counters:
+            metric = f"{namespace}_{name}_total"
+            if metric not in typed:
+                lines.append(f"# TYPE {metric} counter")
+                typed.add(metric)
+            lines.append(f"{_series(metric, labels)} {value}")
+        for (name, labels), summary, histogram in histograms:
+            metric = f"{namespace}_{name}"
+            if metric not in typed:
+                lines.append(f"# TYPE {metric} histogram")
+                typed.add(metric)
+            cumulative = 0
+            for bound, count in zip(histogram.buckets + ('+Inf', ), histogram.counts):
+                cumulative += count
+                lines.append(f"{_series(metric + '_bucket', labels + (('le', bound), ))} {cumulative}")
+            lines.append(f"{_series(metric + '_sum', labels)} {summary['sum']}")
+            lines.append(f"{_series(metric + '_count', labels)} {summary['count']}")
+        return '\n'.join(lines) + '\n'
+
+    def write_prometheus(self, path: str, namespace: str = 'sentinel2'):
+        """
+        :param path: str, .prom file of node_exporter textfile collector, written atomically
+        :param namespace: str, prefix of metric names
+        """
+        _write_atomic(path, self.prometheus(namespace))
@@ -1,18 +1,60 @@
 import os
+import numpy as np
 import geopandas as gp
 import logging
+from collections import namedtuple, defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
 from shapely.geometry import box
-from typing import Optional, List
+from shapely.prepared import prep
+from typing import Optional, List, Union, Dict, Hashable
+
+from .metrics import Metrics, NULL_METRICS
+from .tiling import TilingGrid, load_grid
 
 logger = logging.getLogger(__name__)
 logging.basicConfig()
 
 GRID_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), "./grid"))
 
+# feature_tiles: feature index to sorted tile names, tile_features: tile name to feature indexes,
+# tiles: sorted unique tile names of all features
+BatchOverlap = namedtuple('BatchOverlap', 'feature_tiles tile_features tiles')
+
+# inputs with fewer features are resolved in the calling process
+PARALLEL_THRESHOLD = 5000
+
+
+def greedy_cover(geometry, tiles) -> List[int]:
+    """
+    Select tiles that cover not yet covered part of geometry, tiles are taken in the given order
+    :param geometry: shapely geometry, region in the tiles projection
+    :param tiles: iterable, tile geometries sorted by priority
+    :return: list, positions of selected tiles
+    """
+    selected = list()
+    remaining = geometry
+    prepared = prep(remaining)
+    for position, tile in enumerate(tiles):
+        if remaining.is_empty or not remaining.area:
+            # region is fully covered
+            break
+        # prepared remaining region is reused until a tile is selected
+        if not prepared.intersects(tile):
+            continue
+        difference = remaining.difference(tile)
+        if difference.area != remaining.area:
+            selected.append(position)
+            remaining = difference
+            prepared = prep(remaining)
+    return selected
+
 
 class Sentinel2Overlap:
-    def __init__(self, aoi_path: str, *, grid_path: str = os.path.join(GRID_DIR, "sentinel2grid.shp"), verbose: bool = False):
+    def __init__(self, aoi_path: str, *, grid_path: str = os.path.join(GRID_DIR, "sentinel2grid.shp"),
+                 verbose: bool = False, metrics: Optional[Metrics] = None):
         self.crs = "epsg:4326"
+        self.metrics = metrics or NULL_METRICS
 
         if verbose:
             logger.setLevel(logging.INFO)
@@ -28,38 +70,58 @@ class Sentinel2Overlap:
             aoi = gp.GeoDataFrame(geometry=[bbox], crs=self.crs)
 
         self.aoi = aoi
-        self.grid = gp.read_file(grid_path)
+        self.grid_path = grid_path
+
+    @property
+    def tiling(self) -> TilingGrid:
+        """
+        Grid is converted once into a memory-mapped cache and shared by all instances of the process
+        """
+        return load_grid(self.grid_path)
+
+    @property
+    def grid(self) -> gp.GeoDataFrame:
+        """
+        Whole grid, decoding all tiles is slow, tiles of a region are decoded by _intersect()
+        """
+        return self.tiling.frame()
 
     def _intersect(self, limit):
         """
         Find all tiles that intersects given region with area >= limit km2
         :param limit: float, min intersection area in km2
-        :return: (GeoDataFrame, epsg), precised intersected tiles and UTM zone code
+        :return: (GeoDataFrame, epsg, geometry), precised intersected tiles, UTM zone code
+        and region geometry in UTM projection
         """
 
         # Get the indices of the tiles that are likely to be inside the bounding box of the given Polygon
-        aoi = self.aoi
-        grid = self.grid
-        geometry = aoi.geometry[0]
+        geometry = self.aoi.geometry[0]
 
-        tiles_indexes = list(grid.sindex.intersection(geometry.bounds))
-        grid = grid.loc[tiles_indexes]
+        with self.metrics.timer('grid_load_seconds'):
+            tiling = self.tiling
+        grid = tiling.frame(tiling.query(geometry.bounds))
         # Make the precise tiles in Polygon query
-
-        grid = grid.loc[grid.intersects(geometry)]
+        prepared = prep(geometry)
+        grid = grid.loc[[prepared.intersects(tile) for tile in grid.geometry.values]].copy()
 
         # intersection area
         epsg = self.epsg_code(geometry.centroid.x, geometry.centroid.y)
 
         # to UTM projection in meters
-        aoi['geometry'] = aoi.geometry.to_crs(epsg=epsg)
+        utm_geometry = self.aoi.geometry.to_crs(epsg=epsg).iloc[0]
         grid['geometry'] = grid.geometry.to_crs(epsg=epsg)
 
-        grid['area'] = grid.geometry.apply(lambda g: g.intersection(aoi.geometry[0]).area / 1e6)
+        # tiles inside the region are covered entirely, only tiles on its boundary are clipped
+        prepared = prep(utm_geometry)
+        inside = np.array([prepared.contains(tile) for tile in grid.geometry.values], dtype=bool)
+        area = grid.geometry.area.to_numpy(copy=True)
+        if not inside.all():
+            area[~inside] = grid.geometry[~inside].intersection(utm_geometry).area.values
+        grid['area'] = area / 1e6
         grid = grid.loc[grid['area'] >= limit]
         grid = grid.sort_values(by=['area', 'Name'], ascending=[False, True])
 
-        return grid, epsg
+        return grid, epsg, utm_geometry
 
     def overlap(self, *, limit: float = 0.001) -> Optional[List]:
         """
@@ -70,23 +132,14 @@ class Sentinel2Overlap:
 
         logger.info(f"Start finding overlapping tiles")
 
-        grid, epsg = self._intersect(limit)
-
-        aoi = self.aoi
-        overlap_tiles = list()
-        for row in grid.itertuples():
-            start_area = aoi.geometry[0].area
-            aoi.geometry[0] = aoi.geometry[0].difference(row.geometry)
-            if start_area != aoi.geometry[0].area:
-                overlap_tiles.append(dict(Name=row.Name, geometry=row.geometry))
-
-        if not overlap_tiles:
+        with self.metrics.timer('overlap_seconds', mode='single'):
+            grid, epsg, geometry = self._intersect(limit)
+            selected = greedy_cover(geometry, grid.geometry.values)
+        self.metrics.increment('overlap_tiles', len(selected), mode='single')
+        if not selected:
             return
 
-        tiles = gp.GeoDataFrame(overlap_tiles, crs=epsg)
-        tiles = tiles.to_crs(self.crs)
-
-        tile_names = sorted(tiles.Name)
+        tile_names = sorted(grid['Name'].iloc[selected])
         logger.info(f"Found {len(tile_names)} tiles: {', '.join(tile_names)}")
         return tile_names
 
@@ -120,3 +173,138 @@ class Sentinel2Overlap:
             return 32600 + zone
         else:
             return 32700 + zone
+
+
+def _epsg_codes(geometries) -> np.ndarray:
+    centroids = [geometry.centroid for geometry in geometries]
+    return np.array([Sentinel2Overlap.epsg_code(centroid.x, centroid.y) for centroid in centroids], dtype=np.int64)
+
+
+def _resolve_features(features, grid_path, limit) -> Dict[Hashable, List[str]]:
+    """
+    Tiles of every feature: spatial join with the grid, intersection areas in UTM zone of each feature
+    and greedy coverage of the feature by its tiles
+    """
+    tiling = load_grid(grid_path)
+    grid = tiling.frame(tiling.query_many(features.geometry.bounds.values))
+    feature_tiles = {index: list() for index in features.index}
+    if grid.empty:
+        return feature_tiles
+
+    pairs = gp.sjoin(features[['geometry']], grid, how='inner')
+    if pairs.empty:
+        return feature_tiles
+
+    # features are referred by position, their index may be of any type
+    pair_positions = features.index.get_indexer(pairs.index)
+    pair_codes = _epsg_codes(features.geometry.values)[pair_positions]
+    utm_features = np.empty(len(pairs), dtype=object)
+    utm_tiles = np.empty(len(pairs), dtype=object)
+    areas = np.empty(len(pairs))
+    for code in np.unique(pair_codes):
+        # pairs of one UTM zone are projected and intersected at once
+        mask = pair_codes == code
+        left = gp.GeoSeries(pairs.geometry.values[mask], crs=features.crs).to_crs(epsg=int(code))
+        right = gp.GeoSeries(grid.geometry.loc[pairs['index_right'].values[mask]].values,
+                             crs=grid.crs).to_crs(epsg=int(code))
+        utm_features[mask] = left.values
+        utm_tiles[mask] = right.values
+        areas[mask] = left.intersection(right).area.values / 1e6
+
+    keep = np.flatnonzero(areas >= limit)
+    positions = pair_positions[keep]
+    names = pairs['Name'].values.astype(str)[keep]
+    # grouped by feature, then by area descending and name
+    order = np.lexsort((names, -areas[keep], positions))
+    rows, positions, names = keep[order], positions[order], names[order]
+    starts = np.flatnonzero(np.diff(positions)) + 1
+    for start, end in zip(np.r_[0, starts], np.r_[starts, len(rows)]):
+        if start == end:
+            continue
+        feature = features.index[positions[start]]
+        if end - start == 1:
+            feature_tiles[feature] = [str(names[start])]
+            continue
+        selected = greedy_cover(utm_features[rows[start]], utm_tiles[rows[start:end]])
+        feature_tiles[feature] = sorted(names[start:end][selected].tolist())
+    return feature_tiles
+
+
+class Sentinel2BatchOverlap:
+    """
+    Tiles of many features in one spatial join, every Polygon or MultiPolygon is covered by its own tiles
+    """
+
+    def __init__(self, aoi: Union[str, gp.GeoDataFrame], *,
+                 grid_path: str = os.path.join(GRID_DIR, "sentinel2grid.shp"), verbose: bool = False,
+                 metrics: Optional[Metrics] = None):
+        """
+        :param aoi: str or GeoDataFrame, path to a file with features or features themselves
+        :param grid_path: str, path to tiling grid file
+        :param verbose: bool, default: False
+        :param metrics: Metrics, receives overlap timings and counts of features and tiles, default: None
+        """
+        self.crs = "epsg:4326"
+        self.metrics = metrics or NULL_METRICS
+
+        if verbose:
+            logger.setLevel(logging.INFO)
+        else:
+            logger.setLevel(logging.CRITICAL)
+        features = gp.read_file(aoi) if isinstance(aoi, str) else aoi
+        if features.crs is not None and features.crs != self.crs:
+            features = features.to_crs(self.crs)
+        empty = features.geometry.isna() | features.geometry.is_empty
+        if empty.any():
+            logger.info(f"{int(empty.sum())} features without geometry are skipped")
+        self.features = features.loc[~empty]
+        self.empty_features = list(features.index[empty])
+        self.grid_path = grid_path
+
+    def _chunks(self, number):
+        # spatially close features in the same chunk, each worker decodes fewer tiles
+        bounds = self.features.geometry.bounds
+        order = np.lexsort((bounds['minx'].values, bounds['miny'].values))
+        features = self.features[['geometry']].iloc[order]
+        size = -(-len(features) // number)
+        return [features.iloc[start:start + size] for start in range(0, len(features), size)]
+
+    def overlap(self, *, limit: float = 0.001, cores: int = 1) -> BatchOverlap:
+        """
+        Find tiles that intersect each feature with area >= limit
+        :param limit: float, min intersection area in km2
+        :param cores: int, number of processes for inputs larger than PARALLEL_THRESHOLD features, default: 1
+        :return: BatchOverlap, tiles of each feature, features of each tile and unique tiles of all features
+        """
+
+        logger.info(f"Start finding overlapping tiles for {len(self.features)} features")
+
+        with self.metrics.timer('overlap_seconds', mode='batch'):
+            feature_tiles = self._feature_tiles(limit, cores)
+
+        tile_features = defaultdict(list)
+        for index, tiles in feature_tiles.items():
+            for tile in tiles:
+                tile_features[tile].append(index)
+
+        tiles = sorted(tile_features)
+        self.metrics.increment('overlap_features', len(feature_tiles))
+        self.metrics.increment('overlap_tiles', len(tiles), mode='batch')
+        logger.info(f"Found {len(tiles)} tiles for {len(feature_tiles)} features")
+        return BatchOverlap(feature_tiles, dict(tile_features), tiles)
+
+    def _feature_tiles(self, limit, cores) -> Dict[Hashable, List[str]]:
+        if cores > 1 and len(self.features) > PARALLEL_THRESHOLD:
+            chunks = self._chunks(cores * 4)
+            feature_tiles = dict()
+            with ProcessPoolExecutor(max_workers=cores) as executor:
+                for tiles in executor.map(_resolve_features, chunks, repeat(self.grid_path), repeat(limit)):
+                    feature_tiles.update(tiles)
+        else:
+            feature_tiles = _resolve_features(self.features[['geometry']], self.grid_path, limit)
+
+        # input order of features
+        feature_tiles = {index: feature_tiles.get(index, list()) for index in self.features.index}
+        for index in self.empty_features:
+            feature_tiles[index] = list()
+        return feature_tiles
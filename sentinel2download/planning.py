@@ -0,0 +1,148 @@
+import os
+import json
+import heapq
+import time
+
+from collections import namedtuple
+from pathlib import Path
+from typing import Dict, List, Optional
+
+from .catalog import BlobInfo
+
+PLAN_VERSION = 1
+
+# prefix: .SAFE prefix, ex: tiles/36/U/YA/S2A_MSIL1C_20201001T084801_N0209_R107_T36UYA_20201001T094101.SAFE/
+# blobs: list of BlobInfo to load
+PlannedProduct = namedtuple('PlannedProduct', 'prefix blobs')
+
+
+def product_size(product: PlannedProduct) -> int:
+    return sum(blob.size or 0 for blob in product.blobs)
+
+
+class DownloadPlan:
+    """
+    Products and blobs resolved by Sentinel2Downloader.plan() without transferring data.
+    A plan is saved as JSON, split into shards balanced by bytes and executed by Sentinel2Downloader.download_plan(),
+    products are never split between shards.
+    """
+
+    def __init__(self, product_type: str, products: List[PlannedProduct], *,
+                 full_download: bool = False, bands: Optional[List[str]] = None, tiles: Optional[List[str]] = None,
+                 start_date: Optional[str] = None, end_date: Optional[str] = None,
+                 constraints: Optional[Dict[str, float]] = None, shard: Optional[List[int]] = None,
+                 created_at: Optional[float] = None):
+        """
+        :param product_type: str, "L2A" or "L1C" Sentinel2 products
+        :param products: list, PlannedProduct tuples
+        :param full_download: bool, whole .SAFE folders are planned, blobs are saved under .SAFE paths
+        :param bands: list, planned bands
+        :param tiles: list, planned tiles
+        :param start_date: str, format: 2020-01-01, start of search dates
+        :param end_date: str, format: 2020-01-02, end of search dates
+        :param constraints: dict, constraints granule metadata of every planned product was matched with
+        :param shard: list, [index, count] of a shard, None for a whole plan
+        :param created_at: float, unix time of planning
+        """
+        self.product_type = product_type
+        self.products = products
+        self.full_download = full_download
+        self.bands = sorted(bands or ())
+        self.tiles = list(tiles or ())
+        self.start_date = start_date
+        self.end_date = end_date
+        self.constraints = dict(constraints or {})
+        self.shard = shard
+        self.created_at = created_at or time.time()
+
+    def __len__(self):
+        return len(self.products)
+
+    @property
+    def size(self) -> int:
+        """
+        :return: int, total bytes of planned blobs
+        """
+        return sum(product_size(product) for product in self.products)
+
+    @property
+    def blob_count(self) -> int:
+        return sum(len(product.blobs) for product in self.products)
+
+    def estimate(self, output_dir: Optional[str] = None, bandwidth: Optional[int] = None) -> Dict[str, float]:
+        """
+        :param output_dir: str, download directory, blobs already present there with the planned size
+        are not counted as transfer volume, default: None, everything is transferred
+        :param bandwidth: int, expected download rate in bytes per second, default: None, no duration estimate
+        :return: dict, products, blobs, bytes (planned volume), transfer_bytes (volume left to transfer)
+        and seconds (transfer duration at bandwidth or None)
+        """
+        transfer_bytes = 0
+        for product in self.products:
+            for blob in product.blobs:
+                if output_dir:
+                    save_path = self._save_path(output_dir, blob)
+                    if os.path.isfile(save_path) and os.path.getsize(save_path) == blob.size:
+                        continue
+                transfer_bytes += blob.size or 0
+        return dict(products=len(self.products), blobs=self.blob_count, bytes=self.size,
+                    transfer_bytes=transfer_bytes, seconds=transfer_bytes / bandwidth if bandwidth else None)
+
+    def _save_path(self, output_dir, blob) -> str:
+        # the same layout as Sentinel2Downloader.get_save_path
+        parts = blob.name.split('/')
+        safe_index = next(index for index, part in enumerate(parts) if part.endswith('.SAFE'))
+        if self.full_download:
+            return os.path.join(output_dir, *parts[safe_index:])
+        return os.path.join(output_dir, parts[safe_index][:-len('.SAFE')], parts[-1])
+
+    def split(self, count: int) -> List['DownloadPlan']:
+        """
+        Split products into shards of balanced total bytes, the largest products are assigned first,
+        each to the least loaded shard
+        :param count: int, number of shards
+        :return: list, DownloadPlan of every shard, shards can be empty if there are fewer products than shards
+        """
+        if count < 1:
+            raise ValueError(f"Number of shards must be positive, got {count}")
+        loads = [(0, index) for index in range(count)]
+        shards = [list() for _ in range(count)]
+        for product in sorted(self.products, key=product_size, reverse=True):
+            size, index = heapq.heappop(loads)
+            shards[index].append(product)
+            heapq.heappush(loads, (size + product_size(product), index))
+        return [DownloadPlan(self.product_type, sorted(products, key=lambda product: product.prefix),
+                             full_download=self.full_download, bands=self.bands,
+                             tiles=self.tiles, start_date=self.start_date, end_date=self.end_date,
+                             constraints=self.constraints, shard=[index, count], created_at=self.created_at)
+                for index, products in enumerate(shards)]
+
+    def to_dict(self) -> dict:
+        return dict(version=PLAN_VERSION, product_type=self.product_type, full_download=self.full_download,
+                    bands=self.bands, tiles=self.tiles, start_date=self.start_date, end_date=self.end_date,
+                    constraints=self.constraints, shard=self.shard, created_at=self.created_at,
+                    bytes=self.size, products=[dict(prefix=product.prefix, blobs=[list(blob) for blob in product.blobs])
+                                               for product in self.products])
+
+    @classmethod
+    def from_dict(cls, data: dict) -> 'DownloadPlan':
+        if data.get('version') != PLAN_VERSION:
+            raise ValueError(f"Unsupported plan version {data.get('version')}, expected {PLAN_VERSION}")
+        products = [PlannedProduct(product['prefix'], [BlobInfo(*blob) for blob in product['blobs']])
+                    for product in data['products']]
+        return cls(data['product_type'], products, full_download=data['full_download'], bands=data['bands'],
+                   tiles=data['tiles'], start_date=data['start_date'], end_date=data['end_date'],
+                   constraints=data['constraints'], shard=data['shard'], created_at=data['created_at'])
+
+    def save(self, path: str):
+        """
+        :param path: str, JSON file, written atomically
+        """
+        path = Path(path)
+        tmp_path = path.with_name(f"{path.name}.tmp")
+        tmp_path.write_text(json.dumps(self.to_dict()))
+        os.replace(str(tmp_path), str(path))
+
+    @classmethod
+    def load(cls, path: str) -> 'DownloadPlan':
+        return cls.from_dict(json.loads(Path(path).read_text()))
@@ -0,0 +1,96 @@
+import os
+import re
+
+from collections import namedtuple
+from typing import Iterable, List, Optional
+
+PRODUCT_LEVEL = namedtuple('level', 'L1C L2A')('L1C', 'L2A')
+
+# product metadata file at the root of a .SAFE directory
+METADATA_FILES = {PRODUCT_LEVEL.L1C: 'MTD_MSIL1C.xml', PRODUCT_LEVEL.L2A: 'MTD_MSIL2A.xml', }
+
+# ex: S2A_MSIL1C_20201001T084801_N0209_R107_T36UYA_20201001T094101.SAFE
+PRODUCT_PATTERN = re.compile(r"^(?P<mission>S2[A-Z])_MSI(?P<level>L1C|L2A)_(?P<sensing_time>\d{8}T\d{6})"
+                             r"_N(?P<baseline>\d{4})_R(?P<orbit>\d{3})_T(?P<tile>\d{2}[A-Z]{3})"
+                             r"_(?P<discriminator>\d{8}T\d{6})(?:\.SAFE)?$")
+
+# policies of products reprocessed with several processing baselines, a baseline number as "0209" or "N0209"
+# keeps products of that baseline only
+BASELINE = namedtuple('baseline', 'LATEST ALL')('latest', 'all')
+BASELINE_PATTERN = re.compile(r"^N?(\d{4})$")
+
+ProductName = namedtuple('ProductName', 'name mission level sensing_time baseline orbit tile discriminator')
+
+# datatake and tile of a product, the same for L1C product and L2A products made of it
+DatatakeKey = namedtuple('DatatakeKey', 'mission sensing_time orbit tile')
+
+
+def parse_product_name(name) -> Optional[ProductName]:
+    """
+    :param name: str, product name with or without .SAFE suffix, or path to a product
+    :return: ProductName, None if name is not a Sentinel-2 product name of compact naming convention
+    """
+    name = os.path.basename(os.path.normpath(name))
+    search = PRODUCT_PATTERN.match(name)
+    if not search:
+        return None
+    return ProductName(name, *search.group('mission', 'level', 'sensing_time', 'baseline', 'orbit', 'tile',
+                                           'discriminator'))
+
+
+def datatake_key(product: ProductName) -> DatatakeKey:
+    return DatatakeKey(product.mission, product.sensing_time, product.orbit, product.tile)
+
+
+def is_product(path, level: Optional[str] = None) -> bool:
+    """
+    :param path: str, path to a .SAFE directory
+    :param level: str, "L1C" or "L2A", default: None, any level
+    :return: bool, True if path is a product directory with its metadata file
+    """
+    product = parse_product_name(path)
+    if product is None or (level and product.level != level):
+        return False
+    return os.path.isfile(os.path.join(path, METADATA_FILES[product.level]))
+
+
+def _version(product: ProductName):
+    # reprocessed products have a later baseline, or a later generation time with the same baseline
+    return product.baseline, product.discriminator
+
+
+def baseline_policy(policy) -> str:
+    """
+    :param policy: str, "latest", "all" or a processing baseline as "0209" or "N0209"
+    :return: str, policy with baseline number without N prefix
+    """
+    if policy in BASELINE:
+        return policy
+    search = BASELINE_PATTERN.match(str(policy))
+    if not search:
+        raise ValueError(f"Provide proper baseline policy: {BASELINE} or a baseline number as N0209")
+    return search.group(1)
+
+
+def select_baseline(names: Iterable[str], policy: str = BASELINE.LATEST) -> List[str]:
+    """
+    Select products of a processing baseline among reprocessed products of the same datatake and tile
+    :param names: iterable, product names, paths or .SAFE prefixes
+    :param policy: str, "latest" keeps the latest baseline and generation of every datatake and tile,
+    "all" keeps every product, a baseline number as "0209" or "N0209" keeps products of that baseline only
+    :return: list, selected names in input order, names of other naming conventions are kept
+    """
+    policy = baseline_policy(policy)
+    names = list(names)
+    if policy == BASELINE.ALL:
+        return names
+    products = [(name, parse_product_name(name)) for name in names]
+    if policy == BASELINE.LATEST:
+        latest = dict()
+        for _, product in products:
+            if product:
+                key = datatake_key(product)
+                latest[key] = max(latest.get(key, _version(product)), _version(product))
+        return [name for name, product in products
+                if product is None or _version(product) == latest[datatake_key(product)]]
+    return [name for name, product in products if product is None or product.baseline == policy]
@@ -0,0 +1,226 @@
+import queue
+import logging
+import threading
+
+from functools import partial
+from concurrent.futures import Future, CancelledError
+from typing import Callable, Iterable, Iterator, List, Tuple, Optional, Union
+
+from .metrics import Metrics, NULL_METRICS
+from .throttle import AdaptiveLimiter, RetryPolicy, classify_error
+
+logger = logging.getLogger(__name__)
+logging.basicConfig()
+
+_DONE = object()
+
+
+class Pipeline:
+    """
+    Job-wide pipeline of discovery stages and a transfer stage connected by bounded queues.
+    Items of all tiles flow through the same long-lived workers, so transfers of one tile
+    overlap with listing and metadata filtering of the next ones.
+    A transfer slot is freed only when its result is consumed, so a slow consumer holds back
+    transfers and the number of in-flight and buffered results never exceeds concurrency.
+    Failed transfers are retried with backoff in the same slot, results with an error attribute count as failed.
+    """
+
+    def __init__(self,
+                 stages: List[Tuple[str, Callable[[object], Iterable], int]],
+                 submit: Callable[[object], Future],
+                 *,
+                 concurrency: Union[int, AdaptiveLimiter],
+                 retry: Optional[RetryPolicy] = None,
+                 queue_size: int = 256,
+                 metrics: Metrics = NULL_METRICS):
+        """
+        :param stages: list, (name, func, workers) tuples, func maps an item to iterable of next stage items
+        :param submit: callable, starts transfer of an item of the last stage and returns Future of its result
+        :param concurrency: int or AdaptiveLimiter, max number of in-flight transfers
+        :param retry: RetryPolicy, retries of failed transfers, default: None, no retries
+        :param queue_size: int, max number of items waiting between stages
+        :param metrics: Metrics, receives counters of failed and retried transfer attempts by error kind
+        """
+        self.stages = stages
+        self.submit = submit
+        if not isinstance(concurrency, AdaptiveLimiter):
+            concurrency = AdaptiveLimiter(concurrency)
+        self.limiter = concurrency
+        self.retry = retry
+        self.metrics = metrics
+        # input queue of the first stage is filled at start, the rest are bounded
+        self._queues = [queue.Queue()] + [queue.Queue(maxsize=queue_size) for _ in stages]
+        self._results = queue.Queue()
+        self._alive = [workers for _, _, workers in stages]
+        self._pending = 0
+        # transfer future to the future of its current attempt
+        self._futures = dict()
+        self._lock = threading.Lock()
+        self._idle = threading.Condition(self._lock)
+        self._cancelled = threading.Event()
+        self._error = None
+        self._threads = list()
+
+    def _put(self, items_queue, item):
+        while not self._cancelled.is_set():
+            try:
+                items_queue.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    def _fail(self, ex):
+        with self._lock:
+            if self._error is None:
+                self._error = ex
+        self._cancelled.set()
+
+    def _stage_worker(self, index):
+        name, func, _ = self.stages[index]
+        input_queue, output_queue = self._queues[index], self._queues[index + 1]
+        while True:
+            item = input_queue.get()
+            if item is _DONE:
+                break
+            if self._cancelled.is_set():
+                continue
+            try:
+                for output in func(item) or ():
+                    self._put(output_queue, output)
+            except Exception as ex:
+                logger.info(f"Error in {name} stage for {item}: {str(ex)}")
+                self._fail(ex)
+
+        with self._lock:
+            self._alive[index] -= 1
+            last = self._alive[index] == 0
+        if last:
+            # the next stage may be blocked on a full queue only while its workers are alive
+            next_workers = self.stages[index + 1][2] if index + 1 < len(self.stages) else 1
+            for _ in range(next_workers):
+                output_queue.put(_DONE)
+
+    def _transfer_done(self, future):
+        try:
+            self._results.put(future.result())
+        except CancelledError:
+            pass
+        except Exception as ex:
+            self._fail(ex)
+        finally:
+            with self._idle:
+                self._futures.pop(future, None)
+                self._pending -= 1
+                self._idle.notify_all()
+
+    def _attempt(self, item, future, attempt=0):
+        if self._cancelled.is_set():
+            future.set_exception(CancelledError())
+            return
+        try:
+            current = self.submit(item)
+        except Exception as ex:
+            current = Future()
+            current.set_exception(ex)
+        with self._lock:
+            self._futures[future] = current
+        current.add_done_callback(partial(self._attempt_done, item, future, attempt))
+
+    def _retry_later(self, item, future, attempt, delay):
+        # cancellation interrupts backoff
+        self._cancelled.wait(delay)
+        self._attempt(item, future, attempt)
+
+    def _attempt_done(self, item, future, attempt, current):
+        if current.cancelled():
+            future.set_exception(CancelledError())
+            return
+        result, error = None, current.exception()
+        if error is None:
+            result = current.result()
+        failure = error or getattr(result, 'error', None)
+        self.limiter.record(getattr(result, 'size', 0) or 0, failure)
+        if failure is not None:
+            self.metrics.increment('transfer_errors', kind=classify_error(failure))
+
+        delay = None
+        if failure is not None and self.retry is not None and not self._cancelled.is_set():
+            delay = self.retry.delay(failure, attempt)
+        if delay is not None:
+            self.metrics.increment('transfer_retries', kind=classify_error(failure))
+            logger.info(f"Retrying {item} in {delay:.1f} s, attempt {attempt + 1}: {str(failure)}")
+            threading.Thread(target=self._retry_later, args=(item, future, attempt + 1, delay),
+                             name="transfer-retry", daemon=True).start()
+        elif error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(result)
+
+    def _acquire_slot(self):
+        while not self._cancelled.is_set():
+            if self.limiter.acquire(timeout=0.1):
+                return True
+        return False
+
+    def _dispatch(self):
+        while True:
+            item = self._queues[-1].get()
+            if item is _DONE:
+                break
+            if not self._acquire_slot():
+                continue
+            with self._lock:
+                self._pending += 1
+            # resolved only by attempts, so it can't be cancelled before its attempt is
+            future = Future()
+            future.set_running_or_notify_cancel()
+            future.add_done_callback(self._transfer_done)
+            self._attempt(item, future)
+
+        with self._idle:
+            self._idle.wait_for(lambda: self._pending == 0)
+        self._results.put(_DONE)
+
+    def _start(self, items):
+        for item in items:
+            self._queues[0].put(item)
+        for _ in range(self.stages[0][2]):
+            self._queues[0].put(_DONE)
+
+        for index, (name, _, workers) in enumerate(self.stages):
+            for number in range(workers):
+                self._threads.append(threading.Thread(target=self._stage_worker, args=(index,),
+                                                      name=f"{name}-{number}", daemon=True))
+        self._threads.append(threading.Thread(target=self._dispatch, name="transfer", daemon=True))
+        for thread in self._threads:
+            thread.start()
+
+    def cancel(self):
+        """
+        Stop all stages, transfers that are not started yet are cancelled
+        """
+        self._cancelled.set()
+        with self._lock:
+            futures = list(self._futures.values())
+        for future in futures:
+            future.cancel()
+
+    def run(self, items: Iterable) -> Iterator:
+        """
+        :param items: iterable, input items of the first stage
+        :return: iterator, transfer results in completion order
+        """
+        self._start(items)
+        try:
+            while True:
+                result = self._results.get()
+                if result is _DONE:
+                    break
+                self.limiter.release()
+                yield result
+        finally:
+            self.cancel()
+            for thread in self._threads:
+                thread.join()
+        if self._error is not None:
+            raise self._error
@@ -0,0 +1,309 @@
+import os
+import abc
+import time
+import base64
+import bisect
+import random
+import hashlib
+import threading
+import google_crc32c
+
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Set
+
+from .catalog import BlobInfo, to_blob_info
+
+BUCKET_NAME = 'gcp-public-data-sentinel-2'
+STORAGE_URL = 'https://storage.googleapis.com'
+
+# entries of a listing page, the same as GCS
+PAGE_SIZE = 1000
+# simulated transfers are written in chunks, thus readers see progressive writes
+CHUNK_SIZE = 256 * 1024
+
+
+class StorageError(IOError):
+    """
+    Error of a simulated request, code is HTTP status, ex: 503, classified by throttle.classify_error
+    """
+
+    def __init__(self, message, code):
+        super().__init__(message)
+        self.code = code
+
+
+class StorageBackend(abc.ABC):
+    """
+    Bucket operations used by Sentinel2Downloader: listing, blob reads and metadata.
+    Objects are addressed by bucket names, ex: tiles/36/U/YA/S2A_MSIL1C_...SAFE/GRANULE/.../MTD_TL.xml
+    """
+
+    name = BUCKET_NAME
+
+    @abc.abstractmethod
+    def list_prefixes(self, prefix: str, delimiter: str = '/', start_offset: Optional[str] = None,
+                      end_offset: Optional[str] = None) -> Iterator[Set[str]]:
+        """
+        :param prefix: str, ex: tiles/36/U/YA/
+        :param delimiter: str, names are collapsed into prefixes up to the first delimiter after prefix
+        :param start_offset: str, names before it are not listed, default: None
+        :param end_offset: str, names from it are not listed, default: None
+        :return: iterator of sets of prefixes of every listing page
+        """
+
+    @abc.abstractmethod
+    def list_blobs(self, prefix: str) -> List[BlobInfo]:
+        """
+        :return: list, BlobInfo of every object under prefix
+        """
+
+    @abc.abstractmethod
+    def read(self, blob: BlobInfo, file, start: Optional[int] = None, end: Optional[int] = None):
+        """
+        :param blob: BlobInfo, object to read, its generation is requested if set
+        :param file: file-like object, bytes are written to it
+        :param start: int, first byte, default: None, from the beginning
+        :param end: int, last byte inclusive, default: None, to the end
+        """
+
+    def share_connections(self, count: int):
+        """
+        Size connection pool for count concurrent requests
+        """
+
+
+class GCSStorage(StorageBackend):
+    """
+    Google Cloud Storage bucket accessed through storage.Client
+    """
+
+    def __init__(self, client, name: str = BUCKET_NAME, *, check: bool = True, base_url: Optional[str] = None):
+        """
+        :param client: storage.Client or a client with the same interface
+        :param name: str, bucket name, default: gcp-public-data-sentinel-2
+        :param check: bool, request bucket metadata to fail early on missing bucket or access, default: True
+        :param base_url: str, storage endpoint of requests made without client, ex: by the async engine,
+        default: None, API endpoint of client or STORAGE_URL
+        """
+        self.client = client
+        self.name = name
+        connection = getattr(client, '_connection', None)
+        self.base_url = base_url or getattr(connection, 'API_BASE_URL', None) or STORAGE_URL
+        self.bucket = client.get_bucket(name) if check else client.bucket(name)
+
+    @property
+    def credentials(self):
+        return getattr(self.client, '_credentials', None)
+
+    def list_prefixes(self, prefix, delimiter='/', start_offset=None, end_offset=None) -> Iterator[Set[str]]:
+        iterator = self.client.list_blobs(self.bucket, prefix=prefix, delimiter=delimiter,
+                                          start_offset=start_offset, end_offset=end_offset)
+        for page in iterator.pages:
+            yield set(page.prefixes)
+
+    def list_blobs(self, prefix) -> List[BlobInfo]:
+        return [to_blob_info(blob) for blob in self.client.list_blobs(self.bucket, prefix=prefix)]
+
+    def read(self, blob, file, start=None, end=None):
+        storage_blob = self.bucket.blob(blob.name, generation=blob.generation)
+        storage_blob.download_to_file(file, start=start, end=end)
+
+    def share_connections(self, count):
+        # all workers use one client, its connection pool must fit all of them
+        session = getattr(self.client, '_http', None)
+        if session is not None and hasattr(session, 'mount'):
+            from requests.adapters import HTTPAdapter
+            session.mount('https://', HTTPAdapter(pool_connections=count, pool_maxsize=count))
+
+
+class SimulatedStorage(StorageBackend):
+    """
+    Offline bucket with simulated request latency, per-request bandwidth and injected errors.
+    Requests are counted by kind: list (a listing page) and get (a blob read).
+    Subclasses provide names, metadata and data of objects.
+    """
+
+    def __init__(self, *, latency: float = 0.0, bandwidth: Optional[int] = None, error_rate: float = 0.0,
+                 error_code: int = 503, seed: Optional[int] = 0, page_size: int = PAGE_SIZE):
+        """
+        :param latency: float, seconds added to every request, default: 0.0
+        :param bandwidth: int, bytes per second of every read, concurrent reads don't share it, default: None, no cap
+        :param error_rate: float, share of listing page and read requests failing with StorageError, default: 0.0
+        :param error_code: int, HTTP status of injected errors, 503 is retried as throttling,
+        500 as a transient error and 404 is fatal, default: 503
+        :param seed: int, seed of injected errors, default: 0, the same errors on every run
+        :param page_size: int, entries of a listing page, default: 1000
+        """
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.error_rate = error_rate
+        self.error_code = error_code
+        self.page_size = page_size
+        self.requests = dict()
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    @abc.abstractmethod
+    def _names(self, prefix) -> List[str]:
+        """
+        :return: list, sorted names of objects under prefix
+        """
+
+    @abc.abstractmethod
+    def _info(self, name) -> Optional[BlobInfo]:
+        """
+        :return: BlobInfo of existing object, None if it doesn't exist
+        """
+
+    @abc.abstractmethod
+    def _data(self, name, start, end) -> bytes:
+        """
+        :return: bytes, object data from start to end inclusive
+        """
+
+    def count(self, request):
+        with self._lock:
+            self.requests[request] = self.requests.get(request, 0) + 1
+            failed = self.error_rate and self._random.random() < self.error_rate
+        if self.latency:
+            time.sleep(self.latency)
+        if failed:
+            raise StorageError(f"injected {request} error", self.error_code)
+
+    def _pages(self, entries) -> Iterator[list]:
+        # an empty listing is one request as well
+        for start in range(0, max(len(entries), 1), self.page_size):
+            self.count('list')
+            yield entries[start:start + self.page_size]
+
+    def list_prefixes(self, prefix, delimiter='/', start_offset=None, end_offset=None) -> Iterator[Set[str]]:
+        entries = list()
+        for name in self._names(prefix):
+            if (start_offset is not None and name < start_offset) or (end_offset is not None and name >= end_offset):
+                continue
+            rest = name[len(prefix):]
+            if delimiter and delimiter in rest:
+                entry = prefix + rest.split(delimiter)[0] + delimiter
+                if entries and entries[-1] == entry:
+                    continue
+            else:
+                entry = None
+            entries.append(entry)
+        for page in self._pages(entries):
+            yield {entry for entry in page if entry is not None}
+
+    def list_blobs(self, prefix) -> List[BlobInfo]:
+        blobs = list()
+        for page in self._pages(self._names(prefix)):
+            blobs.extend(self._info(name) for name in page)
+        return blobs
+
+    def read(self, blob, file, start=None, end=None):
+        self.count('get')
+        info = self._info(blob.name)
+        if info is None or (blob.generation and blob.generation != info.generation):
+            raise StorageError(f"No such object: {self.name}/{blob.name}", 404)
+        data = self._data(blob.name, start or 0, info.size - 1 if end is None else end)
+        for offset in range(0, len(data), CHUNK_SIZE):
+            chunk = data[offset:offset + CHUNK_SIZE]
+            if self.bandwidth:
+                time.sleep(len(chunk) / self.bandwidth)
+            file.write(chunk)
+
+
+def checksums(data: bytes):
+    """
+    :return: tuple, base64 crc32c and md5 of data in GCS format
+    """
+    return (base64.b64encode(google_crc32c.value(data).to_bytes(4, 'big')).decode(),
+            base64.b64encode(hashlib.md5(data).digest()).decode())
+
+
+class MemoryStorage(SimulatedStorage):
+    """
+    In-memory bucket, ex: MemoryStorage({'tiles/36/U/YA/.../MTD_TL.xml': b'<xml...>', ...}, latency=0.05)
+    """
+
+    def __init__(self, objects: Dict[str, bytes], **options):
+        """
+        :param objects: dict, object name to its content
+        :param options: latency, bandwidth, error_rate, error_code, seed and page_size of SimulatedStorage
+        """
+        super().__init__(**options)
+        self.objects = objects
+        self.names = sorted(objects)
+        # checksums are computed on first listing of an object
+        self._infos = dict()
+
+    def _names(self, prefix) -> List[str]:
+        start = bisect.bisect_left(self.names, prefix)
+        names = list()
+        for name in self.names[start:]:
+            if not name.startswith(prefix):
+                break
+            names.append(name)
+        return names
+
+    def _info(self, name) -> Optional[BlobInfo]:
+        if name not in self.objects:
+            return None
+        info = self._infos.get(name)
+        if info is None:
+            data = self.objects[name]
+            info = self._infos[name] = BlobInfo(name, len(data), *checksums(data), 1)
+        return info
+
+    def _data(self, name, start, end) -> bytes:
+        return self.objects[name][start:end + 1]
+
+
+class LocalStorage(SimulatedStorage):
+    """
+    Bucket mirrored in a local directory, object names are paths relative to it,
+    ex: root/tiles/36/U/YA/S2A_MSIL1C_...SAFE/GRANULE_$folder$ is an empty marker file
+    """
+
+    def __init__(self, root: str, **options):
+        """
+        :param root: str, directory with tiles/ and L2/ folders of the bucket layout
+        :param options: latency, bandwidth, error_rate, error_code, seed and page_size of SimulatedStorage
+        """
+        super().__init__(**options)
+        self.root = Path(root)
+
+    @classmethod
+    def create(cls, root: str, objects: Dict[str, bytes], **options) -> 'LocalStorage':
+        """
+        Write objects into root and open it as a bucket
+        :param objects: dict, object name to its content
+        """
+        for name, data in objects.items():
+            path = Path(root) / name
+            path.parent.mkdir(parents=True, exist_ok=True)
+            path.write_bytes(data)
+        return cls(root, **options)
+
+    def _names(self, prefix) -> List[str]:
+        # only the directory of prefix is walked, ex: tiles/36/U/YA/S2A_MSIL1C_20201 walks tiles/36/U/YA/
+        directory = self.root / prefix.rsplit('/', 1)[0] if '/' in prefix else self.root
+        names = list()
+        for dir_path, _, file_names in os.walk(directory):
+            relative = Path(dir_path).relative_to(self.root).as_posix()
+            for file_name in file_names:
+                name = file_name if relative == '.' else f"{relative}/{file_name}"
+                if name.startswith(prefix):
+                    names.append(name)
+        return sorted(names)
+
+    def _info(self, name) -> Optional[BlobInfo]:
+        try:
+            stat = os.stat(self.root / name)
+        except FileNotFoundError:
+            return None
+        # files are not hashed on listing, local copies are verified by size only
+        return BlobInfo(name, stat.st_size, None, None, stat.st_mtime_ns)
+
+    def _data(self, name, start, end) -> bytes:
+        with open(self.root / name, 'rb') as file:
+            file.seek(start)
+            return file.read(end - start + 1)
@@ -0,0 +1,199 @@
+import time
+import random
+import asyncio
+import logging
+import threading
+
+from collections import namedtuple
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+logging.basicConfig()
+
+ERROR_KIND = namedtuple('kind', 'THROTTLE TRANSIENT FATAL')('throttle', 'transient', 'fatal')
+
+THROTTLE_CODES = frozenset((429, 503))
+TRANSIENT_CODES = frozenset((408, 500, 502, 504))
+
+
+class ChecksumMismatch(ValueError):
+    pass
+
+
+def _status_code(error) -> Optional[int]:
+    # google.api_core exceptions: code, aiohttp.ClientResponseError: status, requests and resumable media: response
+    for code in (getattr(error, 'code', None), getattr(error, 'status', None),
+                 getattr(getattr(error, 'response', None), 'status_code', None)):
+        if isinstance(code, int):
+            return code
+    return None
+
+
+def classify_error(error) -> str:
+    """
+    :return: str, ERROR_KIND of transfer error
+    """
+    code = _status_code(error)
+    if code in THROTTLE_CODES:
+        return ERROR_KIND.THROTTLE
+    if code in TRANSIENT_CODES:
+        return ERROR_KIND.TRANSIENT
+    if code is not None:
+        return ERROR_KIND.FATAL
+    if isinstance(error, (ConnectionError, TimeoutError, asyncio.TimeoutError, ChecksumMismatch)):
+        return ERROR_KIND.TRANSIENT
+    # requests, urllib3 and aiohttp connection errors are not subclasses of builtin ConnectionError
+    if type(error).__module__.split('.')[0] in ('requests', 'urllib3', 'aiohttp', 'http'):
+        return ERROR_KIND.TRANSIENT
+    return ERROR_KIND.FATAL
+
+
+class RetryPolicy:
+    """
+    Retries of transient and throttling errors with jittered exponential backoff
+    """
+
+    def __init__(self, retries: int = 3, *, backoff: float = 1.0, max_backoff: float = 60.0):
+        """
+        :param retries: int, max number of retries of a transfer, default: 3
+        :param backoff: float, base delay in seconds, default: 1.0
+        :param max_backoff: float, max delay in seconds, default: 60.0
+        """
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+
+    def delay(self, error, attempt) -> Optional[float]:
+        """
+        :param error: Exception, transfer error
+        :param attempt: int, number of the failed attempt, starts from 0
+        :return: float, delay before the next attempt or None if transfer is not retried
+        """
+        if attempt >= self.retries or classify_error(error) == ERROR_KIND.FATAL:
+            return None
+        # full jitter
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+
+
+class RateLimiter:
+    """
+    Token bucket for a global bytes per second cap shared by all transfers
+    """
+
+    def __init__(self, bytes_per_second: int, burst: Optional[int] = None):
+        """
+        :param bytes_per_second: int, bandwidth cap
+        :param burst: int, max bytes allowed at once, default: one second of bandwidth
+        """
+        self.bytes_per_second = bytes_per_second
+        self.burst = burst or bytes_per_second
+        self._tokens = self.burst
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self, size) -> float:
+        """
+        :param size: int, number of bytes just transferred
+        :return: float, seconds the caller has to wait to stay under the cap
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.bytes_per_second)
+            self._updated = now
+            self._tokens -= size
+            return max(0.0, -self._tokens / self.bytes_per_second)
+
+    def consume(self, size):
+        delay = self.reserve(size)
+        if delay:
+            time.sleep(delay)
+
+
+class AdaptiveLimiter:
+    """
+    Limit of in-flight transfers adjusted by AIMD: the limit grows by one per window while throughput grows,
+    and is halved on throttling or when errors exceed error_rate within a window.
+    With minimum equal to maximum the limit is fixed.
+    """
+
+    def __init__(self, initial: int, *, minimum: int = 1, maximum: Optional[int] = None,
+                 window: float = 2.0, error_rate: float = 0.1):
+        """
+        :param initial: int, initial limit
+        :param minimum: int, min limit, default: 1
+        :param maximum: int, max limit, default: initial, fixed limit
+        :param window: float, seconds of throughput and error measurement, default: 2.0
+        :param error_rate: float, share of failed transfers in a window that halves the limit, default: 0.1
+        """
+        self.minimum = minimum
+        self.maximum = maximum or initial
+        self.limit = float(min(max(initial, minimum), self.maximum))
+        self.window = window
+        self.error_rate = error_rate
+        self.in_flight = 0
+        self._condition = threading.Condition()
+        self._window_start = time.monotonic()
+        self._window_bytes = 0
+        self._window_done = 0
+        self._window_errors = 0
+        self._window_saturated = False
+        self._last_throughput = 0.0
+        self._last_decrease = 0.0
+
+    @property
+    def adaptive(self) -> bool:
+        return self.maximum > self.minimum
+
+    def acquire(self, timeout: Optional[float] = None) -> bool:
+        with self._condition:
+            acquired = self._condition.wait_for(lambda: self.in_flight < int(self.limit), timeout)
+            if acquired:
+                self.in_flight += 1
+                if self.in_flight >= int(self.limit):
+                    self._window_saturated = True
+            return acquired
+
+    def release(self):
+        with self._condition:
+            self.in_flight -= 1
+            self._condition.notify_all()
+
+    def _decrease(self, now, reason):
+        # one decrease per window, a burst of errors is one congestion signal
+        if now - self._last_decrease < self.window:
+            return
+        self.limit = max(self.minimum, self.limit / 2)
+        self._last_decrease = now
+        logger.info(f"Transfer concurrency decreased to {int(self.limit)}: {reason}")
+
+    def record(self, size: int = 0, error=None):
+        """
+        :param size: int, bytes transferred
+        :param error: Exception, transfer error or None
+        """
+        if not self.adaptive:
+            return
+        with self._condition:
+            now = time.monotonic()
+            self._window_done += 1
+            self._window_bytes += size
+            if error is not None:
+                self._window_errors += 1
+                if classify_error(error) == ERROR_KIND.THROTTLE:
+                    self._decrease(now, f"throttled, {str(error)}")
+
+            elapsed = now - self._window_start
+            if elapsed < self.window:
+                return
+            throughput = self._window_bytes / elapsed
+            if self._window_errors > self.error_rate * self._window_done:
+                self._decrease(now, f"{self._window_errors} errors of {self._window_done} transfers")
+            elif self._window_saturated and throughput >= self._last_throughput * 0.95:
+                # additive increase only while the limit is binding and throughput keeps up
+                self.limit = min(self.maximum, self.limit + 1)
+                logger.info(f"Transfer concurrency increased to {int(self.limit)}, {throughput:.0f} B/s")
+            self._last_throughput = throughput
+            self._window_start = now
+            self._window_bytes = self._window_done = self._window_errors = 0
+            self._window_saturated = False
+            self._condition.notify_all()
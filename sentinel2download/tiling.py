@@ -0,0 +1,178 @@
+import os
+import json
+import shutil
+import hashlib
+import logging
+import tempfile
+import threading
+
+import numpy as np
+import geopandas as gp
+
+from pathlib import Path
+from shapely import wkb
+from typing import Iterable, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+logging.basicConfig()
+
+CACHE_SUFFIX = '.cache'
+USER_CACHE_DIR = Path.home() / '.cache' / 'sentinel2tools'
+# bump when cache layout changes
+CACHE_VERSION = 1
+
+_grids = dict()
+_grids_lock = threading.Lock()
+
+
+class TilingGrid:
+    """
+    Tiling grid stored as memory-mapped numpy arrays: tile names, bounds and WKB geometries.
+    Bounds arrays serve as the spatial index, geometries are decoded only for candidate tiles.
+    Pages are shared between processes mapping the same cache, including forked workers.
+    """
+
+    def __init__(self, cache_dir: str):
+        """
+        :param cache_dir: str, directory of a grid cache built by build_cache()
+        """
+        self.cache_dir = Path(cache_dir)
+        meta = json.loads((self.cache_dir / 'meta.json').read_text())
+        self.crs = meta['crs']
+        self.names = np.load(self.cache_dir / 'names.npy', mmap_mode='r')
+        self.bounds = np.load(self.cache_dir / 'bounds.npy', mmap_mode='r')
+        self._wkb = np.load(self.cache_dir / 'wkb.npy', mmap_mode='r')
+        self._offsets = np.load(self.cache_dir / 'offsets.npy', mmap_mode='r')
+        # decoded geometries of this process
+        self._geometries = dict()
+
+    def __len__(self):
+        return len(self.names)
+
+    def query(self, bounds) -> np.ndarray:
+        """
+        :param bounds: tuple, (minx, miny, maxx, maxy) in grid crs
+        :return: np.ndarray, positions of tiles whose bounds intersect given bounds
+        """
+        minx, miny, maxx, maxy = bounds
+        mask = ((self.bounds[:, 0] <= maxx) & (self.bounds[:, 2] >= minx) &
+                (self.bounds[:, 1] <= maxy) & (self.bounds[:, 3] >= miny))
+        return np.flatnonzero(mask)
+
+    def query_many(self, bounds, chunk_size: int = 64) -> np.ndarray:
+        """
+        :param bounds: array-like, (n, 4) bounds of many regions in grid crs
+        :param chunk_size: int, number of regions compared with tiles at once
+        :return: np.ndarray, positions of tiles whose bounds intersect bounds of any region
+        """
+        bounds = np.asarray(bounds, dtype=np.float64).reshape(-1, 4)
+        if not len(bounds):
+            return np.empty(0, dtype=np.int64)
+        candidates = self.query((bounds[:, 0].min(), bounds[:, 1].min(), bounds[:, 2].max(), bounds[:, 3].max()))
+        tile_bounds = self.bounds[candidates]
+        hit = np.zeros(len(candidates), dtype=bool)
+        for start in range(0, len(bounds), chunk_size):
+            chunk = bounds[start:start + chunk_size, :, None]
+            hit |= ((tile_bounds[:, 0] <= chunk[:, 2]) & (tile_bounds[:, 2] >= chunk[:, 0]) &
+                    (tile_bounds[:, 1] <= chunk[:, 3]) & (tile_bounds[:, 3] >= chunk[:, 1])).any(axis=0)
+        return candidates[hit]
+
+    def geometry(self, position):
+        geometry = self._geometries.get(position)
+        if geometry is None:
+            start, end = self._offsets[position], self._offsets[position + 1]
+            geometry = wkb.loads(self._wkb[start:end].tobytes())
+            self._geometries[position] = geometry
+        return geometry
+
+    def frame(self, positions: Optional[Iterable[int]] = None) -> gp.GeoDataFrame:
+        """
+        :param positions: iterable, tile positions, default: None, all tiles
+        :return: GeoDataFrame, tiles with Name and geometry columns
+        """
+        positions = np.arange(len(self)) if positions is None else np.asarray(positions, dtype=np.int64)
+        return gp.GeoDataFrame({'Name': self.names[positions].tolist()},
+                               geometry=[self.geometry(position) for position in positions],
+                               index=positions, crs=self.crs)
+
+
+def _source_key(grid_path) -> str:
+    stat = os.stat(grid_path)
+    source = f"{os.path.abspath(grid_path)} {stat.st_size} {stat.st_mtime_ns} {CACHE_VERSION}"
+    return hashlib.sha1(source.encode()).hexdigest()
+
+
+def build_cache(grid_path, cache_dir) -> Path:
+    """
+    Convert a grid file with Name column into the memory-mappable layout of TilingGrid
+    :param grid_path: str, grid file readable by geopandas
+    :param cache_dir: str, cache directory, replaced atomically
+    :return: Path, cache directory
+    """
+    logger.info(f"Building grid cache for {grid_path} in {cache_dir}")
+    grid = gp.read_file(grid_path)
+    blobs = [geometry.wkb for geometry in grid.geometry]
+    offsets = np.zeros(len(blobs) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(blob) for blob in blobs])
+
+    cache_dir = Path(cache_dir)
+    cache_dir.parent.mkdir(parents=True, exist_ok=True)
+    build_dir = Path(tempfile.mkdtemp(dir=cache_dir.parent, prefix=f".{cache_dir.name}."))
+    try:
+        np.save(build_dir / 'names.npy', np.array(grid['Name'].astype(str).tolist()))
+        np.save(build_dir / 'bounds.npy', np.ascontiguousarray(grid.geometry.bounds.values, dtype=np.float64))
+        np.save(build_dir / 'wkb.npy', np.frombuffer(b''.join(blobs), dtype=np.uint8))
+        np.save(build_dir / 'offsets.npy', offsets)
+        meta = dict(source=_source_key(grid_path), crs=grid.crs.to_string() if grid.crs else None)
+        (build_dir / 'meta.json').write_text(json.dumps(meta))
+        if cache_dir.is_dir():
+            shutil.rmtree(cache_dir, ignore_errors=True)
+        os.replace(build_dir, cache_dir)
+    except OSError:
+        shutil.rmtree(build_dir, ignore_errors=True)
+        if not (cache_dir / 'meta.json').is_file():
+            raise
+        # another process built the cache concurrently
+    return cache_dir
+
+
+def _cache_dirs(grid_path) -> Tuple[Path, Path]:
+    grid_path = Path(grid_path)
+    # user cache, or next to the grid file if home directory is not writable,
+    # generated files are kept out of the package directory whenever possible
+    user = USER_CACHE_DIR / f"{grid_path.stem}-{_source_key(grid_path)[:16]}"
+    local = grid_path.with_name(grid_path.name + CACHE_SUFFIX)
+    return user, local
+
+
+def _is_current(cache_dir, grid_path) -> bool:
+    meta_path = Path(cache_dir) / 'meta.json'
+    return meta_path.is_file() and json.loads(meta_path.read_text()).get('source') == _source_key(grid_path)
+
+
+def load_grid(grid_path) -> TilingGrid:
+    """
+    Tiling grid of a grid file, converted once and shared by all callers of the process
+    :param grid_path: str, grid file with Name column, ex: sentinel2grid.shp
+    :return: TilingGrid
+    """
+    key = os.path.abspath(grid_path)
+    with _grids_lock:
+        grid = _grids.get(key)
+        if grid is not None:
+            return grid
+
+        user, local = _cache_dirs(grid_path)
+        for cache_dir in (user, local):
+            if _is_current(cache_dir, grid_path):
+                break
+        else:
+            try:
+                cache_dir = build_cache(grid_path, user)
+            except OSError as ex:
+                logger.info(f"Can't write grid cache to {user}: {str(ex)}")
+                cache_dir = build_cache(grid_path, local)
+
+        grid = TilingGrid(cache_dir)
+        _grids[key] = grid
+        return grid
@@ -0,0 +1,322 @@
+import os
+import base64
+import hashlib
+import logging
+import threading
+import google_crc32c
+
+from collections import namedtuple
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from typing import List, Optional, Tuple
+
+from .throttle import ChecksumMismatch, RateLimiter
+
+logger = logging.getLogger(__name__)
+logging.basicConfig()
+
+STATUS = namedtuple('status', 'DOWNLOADED VERIFIED SKIPPED FAILED')('downloaded', 'verified', 'skipped', 'failed')
+
+PART_SUFFIX = '.part'
+STATE_SUFFIX = '.state'
+# reversed Castagnoli polynomial
+CRC32C_POLYNOMIAL = 0x82F63B78
+
+# blobs larger than threshold are loaded in parallel byte ranges, ex: 10 m bands and TCI
+RANGE_THRESHOLD = 64 * 1024 * 1024
+RANGE_SIZE = 16 * 1024 * 1024
+
+
+class BlobResult(tuple):
+    """
+    Tuple (save_path, blob_name) of a blob transfer, status tells if the blob was downloaded,
+    verified against remote checksums, skipped or failed, error is the cause of a failed transfer
+    and size is the number of transferred bytes
+    """
+
+    def __new__(cls, save_path, blob_name, status, error=None, size=0):
+        result = super().__new__(cls, (save_path, blob_name))
+        result.status = status
+        result.error = error
+        result.size = size
+        return result
+
+    def __getnewargs__(self):
+        return self[0], self[1], self.status, self.error, self.size
+
+    def __repr__(self):
+        return f"BlobResult({self[0]!r}, {self[1]!r}, status={self.status!r})"
+
+
+def encode_crc32c(crc) -> str:
+    # GCS format: base64 of big-endian uint32
+    return base64.b64encode(crc.to_bytes(4, 'big')).decode()
+
+
+def _gf2_times(matrix, vector):
+    result = 0
+    index = 0
+    while vector:
+        if vector & 1:
+            result ^= matrix[index]
+        vector >>= 1
+        index += 1
+    return result
+
+
+def _gf2_square(matrix):
+    return [_gf2_times(matrix, row) for row in matrix]
+
+
+def combine_crc32c(crc1, crc2, length2) -> int:
+    """
+    CRC32C of concatenated data from CRC32C of its parts, as zlib crc32_combine
+    :param crc1: int, CRC32C of the first part
+    :param crc2: int, CRC32C of the second part
+    :param length2: int, length of the second part in bytes
+    """
+    if length2 == 0:
+        return crc1
+    # operator for one zero bit, then for two and four zero bits
+    odd = [CRC32C_POLYNOMIAL] + [1 << index for index in range(31)]
+    even = _gf2_square(odd)
+    odd = _gf2_square(even)
+    while True:
+        even = _gf2_square(odd)
+        if length2 & 1:
+            crc1 = _gf2_times(even, crc1)
+        length2 >>= 1
+        if not length2:
+            break
+        odd = _gf2_square(even)
+        if length2 & 1:
+            crc1 = _gf2_times(odd, crc1)
+        length2 >>= 1
+        if not length2:
+            break
+    return crc1 ^ crc2
+
+
+def file_checksums(path, chunk_size: int = 1024 * 1024) -> Tuple[str, str]:
+    """
+    :return: tuple, (crc32c, md5_hash) of a local file in GCS format
+    """
+    crc = 0
+    md5 = hashlib.md5()
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(chunk_size), b''):
+            crc = google_crc32c.extend(crc, chunk)
+            md5.update(chunk)
+    return encode_crc32c(crc), base64.b64encode(md5.digest()).decode()
+
+
+def match_checksums(blob, crc32c, md5_hash) -> bool:
+    """
+    Compare local checksums with remote blob checksums, crc32c is preferred
+    """
+    if blob.crc32c and crc32c:
+        return blob.crc32c == crc32c
+    if blob.md5_hash and md5_hash:
+        return blob.md5_hash == md5_hash
+    return True
+
+
+class ChecksumWriter:
+    """
+    File wrapper that hashes data while it is streamed to disk, writes are held back by an optional rate limiter
+    """
+
+    def __init__(self, file, crc: int = 0, md5=None, rate: Optional[RateLimiter] = None):
+        self.file = file
+        self.crc = crc
+        self.md5 = md5
+        self.rate = rate
+
+    def write(self, data):
+        self.crc = google_crc32c.extend(self.crc, data)
+        if self.md5 is not None:
+            self.md5.update(data)
+        if self.rate is not None:
+            self.rate.consume(len(data))
+        return self.file.write(data)
+
+
+def split_ranges(size, range_size) -> List[Tuple[int, int]]:
+    """
+    :return: list, (start, end) byte ranges, end is inclusive
+    """
+    return [(start, min(start + range_size, size) - 1) for start in range(0, size, range_size)]
+
+
+class PartFile:
+    """
+    Temporary file of a blob transfer, renamed to save path only when the transfer is complete.
+    Single stream transfers resume from the part size, parallel transfers resume completed ranges.
+    """
+
+    def __init__(self, blob, save_path, range_threshold: Optional[int] = RANGE_THRESHOLD,
+                 range_size: int = RANGE_SIZE):
+        """
+        :param blob: BlobInfo, blob to load
+        :param save_path: Path, final path of the blob
+        :param range_threshold: int, blobs larger than threshold in bytes are loaded in ranges, None disables ranges
+        :param range_size: int, size of a range in bytes
+        """
+        self.blob = blob
+        self.save_path = save_path
+        self.path = save_path.with_name(save_path.name + PART_SUFFIX)
+        self.state_path = save_path.with_name(save_path.name + PART_SUFFIX + STATE_SUFFIX)
+        self.ranges = None
+        if range_threshold and blob.size and blob.size > range_threshold:
+            self.ranges = split_ranges(blob.size, range_size)
+        self.crc = None
+        self.md5 = None
+        self._lock = threading.Lock()
+        # completed range index to its crc32c
+        self.completed = self._restore()
+
+    def _restore(self):
+        # part of another blob generation or ranges layout can't be resumed
+        header = f"{self.blob.generation} {self.blob.size} {len(self.ranges or ())}"
+        lines = self.state_path.read_text().splitlines() if self.state_path.is_file() else list()
+        if lines and lines[0] == header and self.path.is_file():
+            return dict(tuple(map(int, line.split())) for line in lines[1:] if line)
+
+        self.discard()
+        with open(self.path, 'wb') as file:
+            if self.ranges:
+                file.truncate(self.blob.size)
+        self.state_path.write_text(header + '\n')
+        return dict()
+
+    def resume_offset(self) -> int:
+        """
+        :return: int, number of bytes loaded by single stream transfer
+        """
+        offset = self.path.stat().st_size
+        if self.blob.size is not None and offset > self.blob.size:
+            # corrupted part
+            with open(self.path, 'wb'):
+                offset = 0
+        return offset
+
+    def stream_writer(self, file, offset) -> ChecksumWriter:
+        """
+        Writer of single stream transfer, only bytes loaded before resume are read back for hashing
+        :param file: file object opened for append
+        :param offset: int, resume offset
+        """
+        writer = ChecksumWriter(file, md5=hashlib.md5())
+        if offset:
+            with open(self.path, 'rb') as part_file:
+                for chunk in iter(lambda: part_file.read(1024 * 1024), b''):
+                    writer.crc = google_crc32c.extend(writer.crc, chunk)
+                    writer.md5.update(chunk)
+        return writer
+
+    def complete_stream(self, writer):
+        self.crc = writer.crc
+        self.md5 = writer.md5
+
+    def pending_ranges(self) -> List[Tuple[int, int, int]]:
+        """
+        :return: list, (index, start, end) of ranges still to load
+        """
+        return [(index, start, end) for index, (start, end) in enumerate(self.ranges)
+                if index not in self.completed]
+
+    def complete_range(self, index, crc):
+        with self._lock:
+            with open(self.state_path, 'a') as file:
+                file.write(f"{index} {crc}\n")
+            self.completed[index] = crc
+
+    def _checksums(self):
+        if not self.ranges:
+            md5 = base64.b64encode(self.md5.digest()).decode() if self.md5 else None
+            return encode_crc32c(self.crc), md5
+        crc = 0
+        for index, (start, end) in enumerate(self.ranges):
+            crc = combine_crc32c(crc, self.completed[index], end - start + 1)
+        # md5 of ranges loaded in parallel can't be combined
+        return encode_crc32c(crc), None
+
+    def discard(self):
+        for path in (self.path, self.state_path):
+            if path.is_file():
+                os.remove(path)
+
+    def commit(self):
+        crc32c, md5_hash = self._checksums()
+        if not match_checksums(self.blob, crc32c, md5_hash):
+            self.discard()
+            raise ChecksumMismatch(f"checksum mismatch, crc32c: {crc32c}, md5: {md5_hash}")
+        os.replace(self.path, self.save_path)
+        os.remove(self.state_path)
+
+
+class ThreadTransfer:
+    """
+    Blob transfers on a thread pool, one thread per in-flight blob
+    """
+
+    def __init__(self, backend, workers: int, *, range_threshold: Optional[int] = RANGE_THRESHOLD,
+                 range_size: int = RANGE_SIZE, rate: Optional[RateLimiter] = None):
+        """
+        :param backend: StorageBackend, bucket to load blobs from
+        :param workers: int, number of threads
+        :param range_threshold: int, blobs larger than threshold in bytes are loaded in parallel ranges,
+        None disables ranges, default: RANGE_THRESHOLD
+        :param range_size: int, size of a range in bytes, default: RANGE_SIZE
+        :param rate: RateLimiter, bandwidth cap shared by all transfers, default: None
+        """
+        self.backend = backend
+        self.concurrency = workers
+        self.range_threshold = range_threshold
+        self.range_size = range_size
+        self.rate = rate
+        self._executor = ThreadPoolExecutor(max_workers=workers)
+        # ranges are loaded by separate workers, blob transfers wait for them
+        self._range_executor = ThreadPoolExecutor(max_workers=workers)
+
+    def _download_range(self, blob, part, index, start, end):
+        with open(part.path, 'r+b') as file:
+            file.seek(start)
+            writer = ChecksumWriter(file, rate=self.rate)
+            self.backend.read(blob, writer, start=start, end=end)
+        part.complete_range(index, writer.crc)
+
+    def _download(self, blob, save_path) -> BlobResult:
+        try:
+            part = PartFile(blob, save_path, self.range_threshold, self.range_size)
+            if part.ranges:
+                futures = [self._range_executor.submit(self._download_range, blob, part, *pending)
+                           for pending in part.pending_ranges()]
+                wait(futures)
+                for future in futures:
+                    future.result()
+            else:
+                offset = part.resume_offset()
+                with open(part.path, 'ab') as file:
+                    writer = part.stream_writer(file, offset)
+                    writer.rate = self.rate
+                    if blob.size is None or offset < blob.size:
+                        self.backend.read(blob, writer, start=offset or None)
+                part.complete_stream(writer)
+            part.commit()
+        except Exception as ex:
+            logger.info(f"Error while loading {blob.name}: {str(ex)}")
+            return BlobResult(None, blob.name, STATUS.FAILED, error=ex)
+        logger.info(f"Loaded {blob.name}")
+        return BlobResult(str(save_path), blob.name, STATUS.DOWNLOADED, size=blob.size or 0)
+
+    def submit(self, blob, save_path) -> Future:
+        """
+        :param blob: BlobInfo, blob to load
+        :param save_path: Path, path to save blob to, parent directory exists
+        :return: Future, resolves to BlobResult (save_path, blob_name), save_path is None if the blob is not loaded
+        """
+        return self._executor.submit(self._download, blob, save_path)
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+        self._range_executor.shutdown(wait=True)
@@ -1,65 +1,398 @@
-import subprocess
 import os
+import re
+import glob
+import shutil
 import logging
 import time
-from typing import List
+from collections import namedtuple, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional, Union
+
+from sentinel2download.metrics import Metrics, MetricsRecorder, BYTES_BUCKETS, NULL_METRICS
+from sentinel2download.products import PRODUCT_LEVEL, BASELINE, DatatakeKey, parse_product_name, datatake_key, \
+    is_product, select_baseline
+from .manifest import ConversionManifest, CONVERSION_STATUS
+from .process import run_streamed
 
 logger = logging.getLogger(__name__)
 logging.basicConfig()
 
+# output_path: str, L2A product path, None if conversion failed, skipped: bool, L2A product exists already,
+# returncode: int, None if the process is not started, elapsed: float, wall seconds,
+# error: str, last output lines or reason of failure, None on success,
+# cpu_time: float, user and system seconds, peak_rss: int, bytes, stages: dict, stage name to seconds,
+# log_path: str, sen2cor output
+ConversionResult = namedtuple('ConversionResult', 'input_path output_path success skipped returncode elapsed error '
+                                                  'cpu_time peak_rss stages log_path',
+                              defaults=(None, None, None, None))
+
+# line of sen2cor output, stage and percent are set for progress markers
+ConversionProgress = namedtuple('ConversionProgress', 'input_path line stage percent')
+
+# ex: Progress[%]: 33.33 : L2A_SceneClass: start of scene classification, elapsed time: 0:01:02.1
+PROGRESS_PATTERN = re.compile(r"Progress\[%\]:\s*(?P<percent>[\d.]+)\s*:\s*(?P<stage>.*?)"
+                              r"(?:,\s*elapsed time:.*)?\s*$")
+STAGE_START = re.compile(r"^(?:start(?:ing)? of\s+)?(?P<stage>.*?)(?:\s+start(?:ed)?)?$", re.IGNORECASE)
+STAGE_END = re.compile(r"^(?:end of\s+(?P<stage>.*)|(?P<finished>.*?)\s+(?:finished|done|end))$", re.IGNORECASE)
+
+LOG_DIR = 'logs'
+
+# products named before December 2016, ex: S2A_OPER_PRD_MSIL1C_PDMC_20160109T154620_R021_V20160108T085317_...SAFE,
+# sen2cor names their L2A products as S2A_USER_PRD_MSIL2A_PDMC_..., with S2A_USER_MTD_SAFL2A_...xml metadata
+LEGACY_NAME = re.compile(r"(?<=_)(?:OPER|USER|MSIL1C|MSIL2A)(?=_)|\.SAFE$")
+LEGACY_METADATA = '*MTD_SAFL2A*.xml'
+
+
+class ConversionResults(list):
+    """
+    List of successfully converted product paths, results keep ConversionResult of every product,
+    report keeps counters and histograms of the run, see MetricsRecorder.report()
+    """
+
+    def __init__(self, results: List[ConversionResult], report: Optional[dict] = None):
+        super().__init__(result.input_path for result in results if result.success)
+        self.results = results
+        self.report = report or dict()
+
+    @property
+    def failed(self) -> List[ConversionResult]:
+        return [result for result in self.results if not result.success]
+
+
+def available_memory() -> Optional[int]:
+    """
+    :return: int, memory available for new processes in bytes, None if unknown
+    """
+    try:
+        with open('/proc/meminfo') as file:
+            for line in file:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    try:
+        return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    except (AttributeError, ValueError, OSError):
+        return None
+
+
+class StageTimer:
+    """
+    Durations of sen2cor processing stages from progress markers of its output.
+    A marker starts a stage and ends the previous one, "end of" and "finished" markers end their own stage.
+    """
+
+    def __init__(self):
+        self.stages = dict()
+        self._current = None
+        self._started = dict()
+
+    def _stop(self, stage, now):
+        started = self._started.pop(stage, None)
+        if started is not None:
+            self.stages[stage] = self.stages.get(stage, 0.0) + now - started
+        if stage == self._current:
+            self._current = None
+
+    def marker(self, label, now=None):
+        now = time.time() if now is None else now
+        # module prefix, ex: L2A_SceneClass: start of scene classification
+        label = label.split(': ', 1)[-1].strip()
+        end = STAGE_END.match(label)
+        if end:
+            self._stop(end.group('stage') or end.group('finished'), now)
+            return
+        stage = STAGE_START.match(label).group('stage')
+        if self._current is not None:
+            self._stop(self._current, now)
+        self._current = stage
+        self._started[stage] = now
+
+    def finish(self, now=None):
+        now = time.time() if now is None else now
+        for stage in list(self._started):
+            self._stop(stage, now)
+        return self.stages
+
+
+def fit_workers(workers, memory_limit) -> int:
+    """
+    :param workers: int, requested number of concurrent sen2cor processes
+    :param memory_limit: int, address space limit of each process in bytes, None for no limit
+    :return: int, number of processes reduced to fit available memory
+    """
+    if not memory_limit:
+        return workers
+    memory = available_memory()
+    if memory is None:
+        return workers
+    fit = max(1, memory // memory_limit)
+    if fit < workers:
+        logger.info(f"Available memory {memory} bytes fits {fit} jobs of {memory_limit} bytes")
+    return min(workers, fit)
+
+
+def output_key(name) -> Union[DatatakeKey, str]:
+    """
+    Key shared by an L1C product and L2A products made of it
+    :param name: str, product name or path
+    :return: DatatakeKey for names of compact naming convention, other names, ex: legacy S2A_OPER_PRD_MSIL1C_...,
+    are keyed by the name without level, origin and .SAFE suffix
+    """
+    product = parse_product_name(name)
+    if product is not None:
+        return datatake_key(product)
+    return LEGACY_NAME.sub('', os.path.basename(os.path.normpath(name)))
+
+
+def _is_l1c_input(path) -> bool:
+    # legacy products are converted as well, their metadata files are named after the product
+    name = os.path.basename(os.path.normpath(path))
+    if parse_product_name(name) is not None:
+        return is_product(path, PRODUCT_LEVEL.L1C)
+    return name.endswith('.SAFE') and 'MSIL1C' in name and os.path.isdir(path)
+
+
+def _is_l2a_output(path) -> bool:
+    if parse_product_name(path) is not None:
+        return is_product(path, PRODUCT_LEVEL.L2A)
+    return bool(glob.glob(os.path.join(glob.escape(path), LEGACY_METADATA)))
+
+
+def l2a_outputs(output_dir_path) -> Dict[Union[DatatakeKey, str], List[str]]:
+    """
+    :return: dict, output_key() to paths of L2A product directories in output directory, complete or not
+    """
+    outputs = defaultdict(list)
+    for entry in os.scandir(output_dir_path):
+        if not entry.is_dir():
+            continue
+        product = parse_product_name(entry.name)
+        if product is not None and product.level == PRODUCT_LEVEL.L2A:
+            outputs[datatake_key(product)].append(entry.path)
+        elif product is None and entry.name.endswith('.SAFE') and 'MSIL2A' in entry.name:
+            outputs[output_key(entry.name)].append(entry.path)
+    return outputs
+
+
+def complete_output(paths) -> Optional[str]:
+    """
+    :param paths: iterable, paths of L2A product directories of a datatake, ex: a value of l2a_outputs()
+    :return: str, path of the complete L2A product of the latest processing baseline, None if no product is complete
+    """
+    complete = [path for path in paths if _is_l2a_output(path)]
+    # the latest processing baseline
+    return max(complete) if complete else None
+
+
+def observe_conversion(metrics: Metrics, result: ConversionResult):
+    """
+    Record counters and sen2cor timings of a conversion result
+    """
+    status = 'skipped' if result.skipped else 'converted' if result.success else 'failed'
+    metrics.increment('conversions', status=status)
+    if result.skipped or result.returncode is None:
+        # sen2cor didn't run
+        return
+    metrics.observe('sen2cor_seconds', result.elapsed)
+    if result.cpu_time is not None:
+        metrics.observe('sen2cor_cpu_seconds', result.cpu_time)
+    if result.peak_rss:
+        metrics.observe('sen2cor_peak_rss_bytes', result.peak_rss, BYTES_BUCKETS)
+    for stage, seconds in (result.stages or {}).items():
+        metrics.observe('sen2cor_stage_seconds', seconds, stage=stage)
+
 
 class Sentinel2Converter:
     """
     Class for converting Sentinel2 L1C to L2A images
     """
 
-    def __init__(self, verbose):
+    def __init__(self, verbose, metrics: Optional[Metrics] = None):
         """
         :param verbose: bool, flag, print logging information, default: False
+        :param metrics: Metrics, receives counters and timings of every conversion, default: None,
+        only run reports are kept
         """
         if verbose:
             logger.setLevel(logging.INFO)
         else:
             logger.setLevel(logging.CRITICAL)
+        self.metrics = metrics or NULL_METRICS
 
     @staticmethod
-    def __convert_l1c_to_l2a(input_tile_path, output_dir_path, sen2cor_path) -> bool:
+    def __convert_l1c_to_l2a(input_tile_path, output_dir_path, sen2cor_path, timeout=None, memory_limit=None,
+                             progress=None, log_dir=None) -> ConversionResult:
         if not os.path.exists(input_tile_path):
             logger.error(f"Check that your input tile directory exists: {input_tile_path}")
-            return False
+            return ConversionResult(input_tile_path, None, False, False, None, 0.0, "input doesn't exist")
         # Creating these folders is required for correct sen2cor processing
         os.makedirs(os.path.join(input_tile_path, "AUX_DATA"), exist_ok=True)
         os.makedirs(os.path.join(input_tile_path, "HTML"), exist_ok=True)
-        logger.info(f"Started converting {input_tile_path}")
-        process = subprocess.run([sen2cor_path, f'--output_dir={output_dir_path}', f'{input_tile_path}'],
-                                 stdout=subprocess.PIPE,
-                                 stderr=subprocess.PIPE,
-                                 universal_newlines=True)
-        success = process.returncode == 0
+        log_dir = log_dir or os.path.join(output_dir_path, LOG_DIR)
+        os.makedirs(log_dir, exist_ok=True)
+        log_path = os.path.join(log_dir, f"{os.path.basename(os.path.normpath(input_tile_path))}.log")
+        logger.info(f"Started converting {input_tile_path}, output is logged to {log_path}")
+
+        timer = StageTimer()
+
+        def on_line(line):
+            search = PROGRESS_PATTERN.search(line)
+            stage = percent = None
+            if search:
+                stage, percent = search.group('stage'), float(search.group('percent'))
+                timer.marker(stage)
+            if progress:
+                progress(ConversionProgress(input_tile_path, line, stage, percent))
+
+        try:
+            usage = run_streamed([sen2cor_path, f'--output_dir={output_dir_path}', f'{input_tile_path}'],
+                                 on_line=on_line, log_path=log_path, timeout=timeout, memory_limit=memory_limit)
+        except OSError as ex:
+            logger.error(f"Can't start {sen2cor_path} for {input_tile_path}: {str(ex)}")
+            return ConversionResult(input_tile_path, None, False, False, None, 0.0, str(ex), log_path=log_path)
+        stages = timer.finish()
+
+        error = None
+        if usage.timed_out:
+            error = f"timed out after {timeout} s"
+        elif usage.returncode != 0:
+            error = '\n'.join(usage.tail)
+
+        output_path = None
+        if error is None:
+            key = output_key(input_tile_path)
+            output_path = complete_output(l2a_outputs(output_dir_path).get(key, ()))
+            if output_path is None:
+                error = f"L2A product is not found in {output_dir_path}"
+
+        success = error is None
         if success:
-            logger.info(f"Successfully processed {input_tile_path}, results are stored at {output_dir_path}")
+            logger.info(f"Successfully processed {input_tile_path}, results are stored at {output_path}")
         else:
             logger.error(f"Something went wrong when trying to convert L1C product {input_tile_path} "
-                         f"to L2A product: {process.stderr}")
-        return success
+                         f"to L2A product: {error}")
+        return ConversionResult(input_tile_path, output_path, success, False, usage.returncode, usage.elapsed, error,
+                                usage.cpu_time, usage.peak_rss, stages, log_path)
+
+    def _convert_recorded(self, manifest, input_tile_path, output_dir_path, sen2cor_path,
+                          timeout, memory_limit, progress, log_dir) -> ConversionResult:
+        name = os.path.basename(input_tile_path)
+        manifest.record(name, CONVERSION_STATUS.RUNNING)
+        result = self.__convert_l1c_to_l2a(input_tile_path, output_dir_path, sen2cor_path, timeout, memory_limit,
+                                           progress, log_dir)
+        if result.success:
+            manifest.record(name, CONVERSION_STATUS.CONVERTED, os.path.basename(result.output_path))
+        else:
+            manifest.record(name, CONVERSION_STATUS.FAILED, error=result.error)
+        return result
+
+    @staticmethod
+    def _pending(manifest, input_paths, output_dir_path, force):
+        """
+        Split L1C products into converted ones and the ones to convert, partial outputs of interrupted runs are removed
+        """
+        outputs = l2a_outputs(output_dir_path)
+        converted, pending = list(), list()
+        for input_path in input_paths:
+            name = os.path.basename(input_path)
+            key = output_key(name)
+            entry = manifest.get(name)
+            if force or (entry and entry.status == CONVERSION_STATUS.RUNNING):
+                for path in outputs.get(key, ()):
+                    logger.info(f"Removing L2A product {path} of {name} before conversion")
+                    shutil.rmtree(path, ignore_errors=True)
+                pending.append(input_path)
+                continue
+
+            output_path = complete_output(outputs.get(key, ()))
+            if output_path is None:
+                pending.append(input_path)
+                continue
+            if not entry or entry.status != CONVERSION_STATUS.CONVERTED:
+                # converted before manifest was used or by other means
+                manifest.record(name, CONVERSION_STATUS.CONVERTED, os.path.basename(output_path))
+            converted.append(ConversionResult(input_path, output_path, True, True, None, 0.0, None))
+        return converted, pending
 
-    def convert(self, input_dir_path, output_dir_path, sen2cor_path='L2A_Process') -> List[str]:
+    def convert_product(self, manifest, input_tile_path, output_dir_path, sen2cor_path='L2A_Process', *,
+                        force: bool = False, timeout: Optional[float] = None, memory_limit: Optional[int] = None,
+                        progress: Optional[Callable[[ConversionProgress], None]] = None,
+                        log_dir: Optional[str] = None) -> ConversionResult:
+        """
+        Convert one L1C product unless it is converted already, options are the same as of convert()
+        :param manifest: ConversionManifest, manifest of output directory the conversion is recorded to
+        :param input_tile_path: str, path to L1C .SAFE product
+        :return: ConversionResult, skipped one if an L2A product of the same datatake and tile exists
+        """
+        converted, pending = self._pending(manifest, [input_tile_path], output_dir_path, force)
+        if converted:
+            logger.info(f"Skipping {input_tile_path}, it is converted already")
+            return converted[0]
+        return self._convert_recorded(manifest, input_tile_path, output_dir_path, sen2cor_path, timeout,
+                                      memory_limit, progress, log_dir)
+
+    def convert(self, input_dir_path, output_dir_path, sen2cor_path='L2A_Process', *,
+                workers: int = 1, memory_limit: Optional[int] = None,
+                timeout: Optional[float] = None, force: bool = False,
+                progress: Optional[Callable[[ConversionProgress], None]] = None,
+                log_dir: Optional[str] = None,
+                baseline: str = BASELINE.LATEST) -> List[str]:
         """
         :param input_dir_path: str, path to a directory with downloaded Sentinel-2 L1C products
         :param output_dir_path: list, tiles to load (ex: {36UYA, 36UYB})
         :param sen2cor_path: str, path to L2A_Process executable
-        :return: List[str],
+        :param workers: int, number of concurrent sen2cor processes, default: 1
+        :param memory_limit: int, address space limit of each sen2cor process in bytes, the number of concurrent
+        processes is reduced to fit available memory, default: None, no limit
+        :param timeout: float, seconds after which a sen2cor process is killed, default: None, no timeout
+        :param force: bool, convert products again even if their L2A products exist, default: False.
+        Conversions are recorded in a manifest in output directory, products with existing L2A products
+        of the same datatake and tile are skipped, failed and interrupted conversions are run again
+        :param progress: callable, called from worker threads with ConversionProgress of every sen2cor output line,
+        default: None
+        :param log_dir: str, directory of sen2cor output logs, one file per product, default: output_dir_path/logs
+        :param baseline: str, products of a datatake reprocessed with several processing baselines to convert:
+        "latest" baseline only, "all" of them, or a baseline number as "N0209", default: "latest"
+        :return: List[str], paths of converted products, ConversionResults with ConversionResult of every product
+        in results attribute, results keep wall time, cpu time, peak RSS and stage durations of every sen2cor run,
+        report attribute keeps counters of conversions by status and histograms of these values
         """
         start_time = time.time()
+        recorder = MetricsRecorder(forward=self.metrics)
         logger.info(f"Started converting L1C products into L2A products")
         if not os.path.exists(input_dir_path):
             logger.info(f"Check that your input directory exists: {input_dir_path}")
         os.makedirs(output_dir_path, exist_ok=True)
-        results = []
-        for tile_dir in os.listdir(input_dir_path):
+        tile_dir_paths = list()
+        for tile_dir in sorted(os.listdir(input_dir_path)):
             tile_dir_path = os.path.join(input_dir_path, tile_dir)
-            status = self.__convert_l1c_to_l2a(tile_dir_path, output_dir_path, sen2cor_path)
-            if status:
-                results.append(tile_dir_path)
+            if _is_l1c_input(tile_dir_path):
+                tile_dir_paths.append(tile_dir_path)
+            elif not tile_dir.startswith('.'):
+                logger.info(f"Skipping {tile_dir_path}, it is not an L1C product")
+        selected = select_baseline(tile_dir_paths, baseline)
+        for tile_dir_path in sorted(set(tile_dir_paths) - set(selected)):
+            logger.info(f"Skipping {tile_dir_path}, it is not selected by baseline policy {baseline}")
+        tile_dir_paths = selected
+
+        manifest = ConversionManifest(output_dir_path)
+        try:
+            results, pending = self._pending(manifest, tile_dir_paths, output_dir_path, force)
+            logger.info(f"{len(results)} products are converted already, {len(pending)} products to convert")
+            for result in results:
+                observe_conversion(recorder, result)
+            workers = fit_workers(workers, memory_limit)
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                for result in executor.map(lambda path: self._convert_recorded(manifest, path, output_dir_path,
+                                                                               sen2cor_path, timeout, memory_limit,
+                                                                               progress, log_dir),
+                                           pending):
+                    observe_conversion(recorder, result)
+                    results.append(result)
+        finally:
+            manifest.close()
+        results = ConversionResults(results, recorder.report())
+        logger.info(f"Converted {len(results)} of {len(results.results)} products with {workers} workers")
         logger.info(f"Finished converting at {time.strftime('%H:%M:%S', time.gmtime(time.time() - start_time))}")
         return results
@@ -0,0 +1,198 @@
+import os
+import re
+import time
+import logging
+import threading
+
+import geopandas as gp
+
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from itertools import product as cartesian
+from typing import Iterable, List, Optional, Union
+
+try:
+    import rasterio
+    import rasterio.shutil
+    from rasterio.features import geometry_mask
+    from rasterio.windows import Window, from_bounds, transform as window_transform
+except ImportError:
+    rasterio = None
+
+logger = logging.getLogger(__name__)
+logging.basicConfig()
+
+# ex: T36UYA_20201001T084801_B04.jp2, T36UYA_20200703T084601_B04_10m.jp2, MSK_CLDPRB_20m.jp2,
+# cropped bands: T36UYA_20201001T084801_B04.tif, masks of other bands are not matched, ex: MSK_DETFOO_B01.jp2
+BAND_PATTERN = re.compile(r"^(?!MSK_(?!CLDPRB)).*_(?P<band>B\d[\dA]|TCI|CLDPRB)(?:_(?P<resolution>\d+)m)?"
+                          r"\.(?:jp2|tif)$")
+# cloud probability mask is CLD band of the downloader
+BAND_NAMES = {'CLDPRB': 'CLD', }
+
+# output_path: str, cropped COG, None if band doesn't intersect AOI or cropping failed,
+# skipped: bool, output exists already, error: str, reason of failure, None on success
+CropResult = namedtuple('CropResult', 'input_path output_path success skipped error')
+
+COMPRESSION = namedtuple('compression', 'DEFLATE LZW ZSTD')('DEFLATE', 'LZW', 'ZSTD')
+
+
+def band_name(path) -> Optional[str]:
+    """
+    :param path: str, band file, ex: T36UYA_20200703T084601_B04_10m.jp2
+    :return: str, band name as in downloader bands, ex: B04, None if path is not a band file
+    """
+    search = BAND_PATTERN.search(os.path.basename(path))
+    if not search:
+        return None
+    return BAND_NAMES.get(search.group('band'), search.group('band'))
+
+
+def band_files(product_path, bands: Optional[Iterable[str]] = None) -> List[str]:
+    """
+    :param product_path: str, downloaded product, .SAFE folder or directory of granule files, or cropped product
+    :param bands: iterable, band names to select, ex: {'B04', 'TCI'}, default: None, all bands
+    :return: list, paths of JP2 or GeoTIFF band files of the product
+    """
+    paths = list()
+    for root, _, names in os.walk(product_path):
+        for name in names:
+            band = band_name(name)
+            if band and (bands is None or band in bands):
+                paths.append(os.path.join(root, name))
+    return sorted(paths)
+
+
+class Sentinel2Cropper:
+    """
+    Class for cropping downloaded Sentinel-2 bands to an AOI and storing them as Cloud-Optimized GeoTIFFs.
+    Only the window of pixels intersecting AOI is read from every band, it is read and written in blocks,
+    so memory footprint is bounded by workers and block size, not by tile size.
+    """
+
+    def __init__(self, aoi: Union[str, gp.GeoDataFrame], verbose: bool = False):
+        """
+        :param aoi: str or GeoDataFrame, path to AOI file or AOI features, ex: Sentinel2Overlap(...).aoi,
+        features without CRS are taken as epsg:4326
+        :param verbose: bool, flag, print logging information, default: False
+        """
+        if rasterio is None:
+            raise ImportError("rasterio is required for cropping: pip install rasterio")
+        if verbose:
+            logger.setLevel(logging.INFO)
+        else:
+            logger.setLevel(logging.CRITICAL)
+
+        aoi = gp.read_file(aoi) if isinstance(aoi, str) else aoi
+        if aoi.crs is None:
+            aoi = aoi.set_crs("epsg:4326")
+        self.aoi = aoi
+        # AOI geometry in CRS of bands, products of one UTM zone share it
+        self._projected = dict()
+        self._lock = threading.Lock()
+
+    def _geometry(self, crs):
+        key = crs.to_string()
+        with self._lock:
+            if key not in self._projected:
+                self._projected[key] = self.aoi.to_crs(crs.to_wkt()).unary_union
+            return self._projected[key]
+
+    @staticmethod
+    def _window(source, geometry) -> Optional[Window]:
+        window = from_bounds(*geometry.bounds, transform=source.transform)
+        window = window.round_offsets(op='floor').round_lengths(op='ceil')
+        try:
+            return window.intersection(Window(0, 0, source.width, source.height))
+        except rasterio.errors.WindowError:
+            # AOI is outside of the band
+            return None
+
+    def _crop_band(self, input_path, output_path, block_size, compression, mask, overwrite) -> CropResult:
+        if os.path.isfile(output_path) and not overwrite:
+            logger.info(f"Skipping {input_path}, {output_path} exists")
+            return CropResult(input_path, output_path, True, True, None)
+        tmp_path, part_path = f"{output_path}.tmp.tif", f"{output_path}.part"
+        try:
+            with rasterio.open(input_path) as source:
+                geometry = self._geometry(source.crs)
+                window = self._window(source, geometry)
+                if window is None or not window.width or not window.height:
+                    logger.info(f"Band {input_path} doesn't intersect AOI")
+                    return CropResult(input_path, None, True, False, None)
+
+                nodata = source.nodata if source.nodata is not None else 0
+                transform = source.window_transform(window)
+                profile = dict(driver='GTiff', width=int(window.width), height=int(window.height),
+                               count=source.count, dtype=source.dtypes[0], crs=source.crs, transform=transform,
+                               nodata=nodata, tiled=True, blockxsize=block_size, blockysize=block_size,
+                               compress=compression)
+                with rasterio.open(tmp_path, 'w', **profile) as target:
+                    rows = range(0, int(window.height), block_size)
+                    columns = range(0, int(window.width), block_size)
+                    for row, column in cartesian(rows, columns):
+                        block = Window(column, row, min(block_size, window.width - column),
+                                       min(block_size, window.height - row))
+                        data = source.read(window=Window(window.col_off + column, window.row_off + row,
+                                                         block.width, block.height))
+                        if mask:
+                            outside = geometry_mask([geometry], out_shape=(int(block.height), int(block.width)),
+                                                    transform=window_transform(block, transform))
+                            data[:, outside] = nodata
+                        target.write(data, window=block)
+
+            # COG layout with overviews is made by copying the tiled file, blocks are streamed
+            rasterio.shutil.copy(tmp_path, part_path, driver='COG', compress=compression, blocksize=block_size,
+                                 overview_resampling='average')
+            # interrupted crops leave no output, thus they are not skipped next time
+            os.replace(part_path, output_path)
+        except Exception as ex:
+            logger.error(f"Error while cropping {input_path}: {str(ex)}")
+            return CropResult(input_path, None, False, False, str(ex))
+        finally:
+            for path in (tmp_path, part_path):
+                if os.path.exists(path):
+                    os.remove(path)
+        logger.info(f"Cropped {input_path} into {output_path}")
+        return CropResult(input_path, output_path, True, False, None)
+
+    def crop(self, input_paths: Union[str, List[str]], output_dir_path: str, *,
+             bands: Optional[Iterable[str]] = None, workers: int = 4, block_size: int = 512,
+             compression: str = COMPRESSION.DEFLATE, mask: bool = False,
+             overwrite: bool = False) -> List[CropResult]:
+        """
+        :param input_paths: str or list, downloaded product directory or their list
+        :param output_dir_path: str, COGs are written to output_dir_path/<product name>/<band file name>.tif
+        :param bands: iterable, bands to crop, ex: {'B04', 'TCI'}, default: None, all bands
+        :param workers: int, number of bands cropped concurrently, default: 4
+        :param block_size: int, size of COG tiles and of blocks read at once in pixels, multiple of 16, default: 512
+        :param compression: str, "DEFLATE", "LZW" or "ZSTD", default: "DEFLATE"
+        :param mask: bool, set pixels outside AOI polygon to nodata, otherwise the whole AOI bounding box is kept,
+        default: False
+        :param overwrite: bool, crop bands again even if their outputs exist, default: False
+        :return: list, CropResult of every band file
+        """
+        if compression not in COMPRESSION:
+            raise ValueError(f"Provide proper compression: {COMPRESSION}")
+        start_time = time.time()
+        if isinstance(input_paths, str):
+            input_paths = [input_paths]
+
+        jobs = list()
+        for product_path in input_paths:
+            product_name = os.path.basename(os.path.normpath(product_path))
+            if product_name.endswith('.SAFE'):
+                product_name = product_name[:-len('.SAFE')]
+            product_dir = os.path.join(output_dir_path, product_name)
+            os.makedirs(product_dir, exist_ok=True)
+            for band_path in band_files(product_path, bands):
+                output_path = os.path.join(product_dir, os.path.splitext(os.path.basename(band_path))[0] + '.tif')
+                jobs.append((band_path, output_path))
+        logger.info(f"Started cropping {len(jobs)} bands of {len(input_paths)} products")
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(lambda job: self._crop_band(*job, block_size, compression, mask, overwrite),
+                                        jobs))
+        failed = len([result for result in results if not result.success])
+        logger.info(f"Cropped {len(results) - failed} of {len(results)} bands")
+        logger.info(f"Finished cropping at {time.strftime('%H:%M:%S', time.gmtime(time.time() - start_time))}")
+        return results
@@ -0,0 +1,51 @@
+import time
+import sqlite3
+import threading
+
+from collections import namedtuple
+from pathlib import Path
+from typing import Optional
+
+CONVERSION_STATUS = namedtuple('status', 'RUNNING CONVERTED FAILED')('running', 'converted', 'failed')
+
+ConversionEntry = namedtuple('ConversionEntry', 'input_name status output_name updated_at error')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS conversions (input_name TEXT PRIMARY KEY, status TEXT NOT NULL, output_name TEXT,
+                                        updated_at REAL NOT NULL, error TEXT);
+"""
+
+
+class ConversionManifest:
+    """
+    Manifest of L1C products converted into the output directory.
+    Products left running by an interrupted conversion are converted again from scratch.
+    """
+
+    FILE_NAME = '.sentinel2conversion.sqlite'
+
+    def __init__(self, output_dir: str):
+        """
+        :param output_dir: str, converter output directory
+        """
+        self.output_dir = Path(output_dir)
+        self.output_dir.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(str(self.output_dir / self.FILE_NAME), check_same_thread=False)
+        self._connection.executescript(SCHEMA)
+
+    def get(self, input_name) -> Optional[ConversionEntry]:
+        with self._lock:
+            row = self._connection.execute("SELECT input_name, status, output_name, updated_at, error "
+                                           "FROM conversions WHERE input_name = ?", (input_name,)).fetchone()
+        return ConversionEntry(*row) if row else None
+
+    def record(self, input_name, status, output_name=None, error=None):
+        with self._lock, self._connection:
+            self._connection.execute("INSERT OR REPLACE INTO conversions "
+                                     "(input_name, status, output_name, updated_at, error) VALUES (?, ?, ?, ?, ?)",
+                                     (input_name, status, output_name, time.time(), error))
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
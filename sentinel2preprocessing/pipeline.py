@@ -0,0 +1,190 @@
+import os
+import time
+import shutil
+import logging
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Optional
+
+from sentinel2download.downloader import Sentinel2Downloader, ProductComplete, PRODUCT_TYPE, CONSTRAINTS
+from sentinel2download.metrics import MetricsRecorder
+from .conversion import Sentinel2Converter, ConversionResult, ConversionResults, ConversionProgress, \
+    l2a_outputs, complete_output, output_key, fit_workers, observe_conversion
+from .manifest import ConversionManifest
+
+logger = logging.getLogger(__name__)
+logging.basicConfig()
+
+
+class Sentinel2Pipeline:
+    """
+    Download L1C products and convert them into L2A products with overlapping stages:
+    a product is passed to conversion workers as soon as all its blobs are loaded,
+    while the following products are being downloaded
+    """
+
+    def __init__(self, downloader: Sentinel2Downloader, converter: Optional[Sentinel2Converter] = None,
+                 verbose: bool = False):
+        """
+        :param downloader: Sentinel2Downloader, loader of L1C products
+        :param converter: Sentinel2Converter, default: None, converter with the same verbose flag
+        :param verbose: bool, flag, print logging information, default: False
+        """
+        if verbose:
+            logger.setLevel(logging.INFO)
+        else:
+            logger.setLevel(logging.CRITICAL)
+        self.downloader = downloader
+        self.converter = converter or Sentinel2Converter(verbose)
+
+    @staticmethod
+    def _product_filter(output_dir_path) -> Callable[[str], bool]:
+        # products converted by previous runs are not loaded again, even if their L1C products are deleted
+        outputs = l2a_outputs(output_dir_path)
+
+        def not_converted(name):
+            # legacy product names are keyed by name
+            if complete_output(outputs.get(output_key(name), ())) is None:
+                return True
+            logger.info(f"Skipping download of {name}, it is converted already")
+            return False
+        return not_converted
+
+    def _convert(self, manifest, recorder, product: ProductComplete, output_dir_path, sen2cor_path, force, timeout,
+                 memory_limit, progress, log_dir, delete_input, cache) -> ConversionResult:
+        name = os.path.basename(product.save_dir)
+        try:
+            failed = [result[1] for result in product.results if not result[0]]
+            if failed:
+                error = f"{len(failed)} of {len(product.results)} blobs are not loaded"
+                logger.error(f"Skipping conversion of {product.save_dir}: {error}")
+                result = ConversionResult(product.save_dir, None, False, False, None, 0.0, error)
+            else:
+                result = self.converter.convert_product(manifest, product.save_dir, output_dir_path, sen2cor_path,
+                                                        force=force, timeout=timeout, memory_limit=memory_limit,
+                                                        progress=progress, log_dir=log_dir)
+        finally:
+            if cache:
+                cache.unpin(name)
+        observe_conversion(recorder, result)
+
+        if result.success and delete_input:
+            logger.info(f"Removing L1C product {product.save_dir}, it is converted into {result.output_path}")
+            if cache:
+                cache.remove(name)
+            else:
+                shutil.rmtree(product.save_dir, ignore_errors=True)
+        return result
+
+    @staticmethod
+    def _result(recorder, future, save_dir) -> ConversionResult:
+        # an unexpected error fails its product only, results of other products are kept
+        try:
+            return future.result()
+        except Exception as ex:
+            logger.error(f"Conversion of {save_dir} failed: {str(ex)}")
+            result = ConversionResult(save_dir, None, False, False, None, 0.0, str(ex))
+            observe_conversion(recorder, result)
+            return result
+
+    def run(self,
+            tiles: list,
+            *,
+            start_date: Optional[str] = None,
+            end_date: Optional[str] = None,
+            constraints: dict = CONSTRAINTS,
+            download_dir: str = './sentinel2imagery/l1c_products',
+            output_dir: str = './sentinel2imagery/l2a_products',
+            cores: int = 5,
+            sen2cor_path: str = 'L2A_Process',
+            workers: int = 1,
+            max_products: Optional[int] = None,
+            delete_input: bool = False,
+            memory_limit: Optional[int] = None,
+            timeout: Optional[float] = None,
+            force: bool = False,
+            progress: Optional[Callable[[ConversionProgress], None]] = None,
+            log_dir: Optional[str] = None,
+            **download_options) -> ConversionResults:
+        """
+        :param tiles: list, tiles to load (ex: {36UYA, 36UYB})
+        :param start_date: str, format: 2020-01-01, start date to search and load products, default: (today - 10 days)
+        :param end_date: str, format: 2020-01-02, end date to search and load products, default: today
+        :param constraints: dict, constraints that products must match, default: {'CLOUDY_PIXEL_PERCENTAGE': 100.0, }
+        :param download_dir: str, directory of L1C products, default: './sentinel2imagery/l1c_products'
+        :param output_dir: str, directory of L2A products, default: './sentinel2imagery/l2a_products'
+        :param cores: int, number of concurrent transfers, default: 5
+        :param sen2cor_path: str, path to L2A_Process executable
+        :param workers: int, number of concurrent sen2cor processes, default: 1
+        :param max_products: int, number of loaded products waiting for or under conversion, downloading is paused
+        while the limit is reached, thus disk usage is bounded by this number of products and blobs of in-flight
+        transfers, default: None, twice the number of workers
+        :param delete_input: bool, remove L1C product once it is converted, default: False
+        :param memory_limit: int, address space limit of each sen2cor process in bytes, default: None, no limit
+        :param timeout: float, seconds after which a sen2cor process is killed, default: None, no timeout
+        :param force: bool, load and convert products again even if their L2A products exist, default: False
+        :param progress: callable, called from worker threads with ConversionProgress of every sen2cor output line,
+        default: None
+        :param log_dir: str, directory of sen2cor output logs, default: output_dir/logs
+        :param download_options: options of Sentinel2Downloader.download_iter: engine, range_threshold, sync, cache,
+        max_cores, bandwidth, retries
+        :return: ConversionResults, paths of converted L1C products, ConversionResult of every loaded product
+        in results attribute, report attribute merges download and conversion counters and histograms
+        """
+        start_time = time.time()
+        logger.info(f"Started loading and converting products of tiles {tiles}")
+        os.makedirs(output_dir, exist_ok=True)
+        workers = fit_workers(workers, memory_limit)
+        slots = threading.BoundedSemaphore(max_products or 2 * workers)
+        cache = download_options.get('cache')
+
+        manifest = ConversionManifest(output_dir)
+        recorder = MetricsRecorder(forward=self.converter.metrics)
+        futures = list()
+        executor = ThreadPoolExecutor(max_workers=workers)
+        products = self.downloader.download_iter(PRODUCT_TYPE.L1C,
+                                                 tiles,
+                                                 start_date=start_date,
+                                                 end_date=end_date,
+                                                 constraints=constraints,
+                                                 output_dir=download_dir,
+                                                 cores=cores,
+                                                 full_download=True,
+                                                 product_filter=None if force else self._product_filter(output_dir),
+                                                 **download_options)
+        try:
+            for product in products:
+                if not isinstance(product, ProductComplete):
+                    continue
+                if cache:
+                    # not evicted by the cache while waiting for conversion
+                    cache.pin(os.path.basename(product.save_dir))
+                if not slots.acquire(blocking=False):
+                    logger.info(f"{max_products or 2 * workers} products are waiting for conversion, "
+                                f"downloading is paused")
+                    slots.acquire()
+                future = executor.submit(self._convert, manifest, recorder, product, output_dir, sen2cor_path, force,
+                                         timeout, memory_limit, progress, log_dir, delete_input, cache)
+                future.add_done_callback(lambda _: slots.release())
+                futures.append((future, product.save_dir))
+            logger.info(f"Finished loading {len(futures)} products "
+                        f"at {time.strftime('%H:%M:%S', time.gmtime(time.time() - start_time))}")
+            results = [self._result(recorder, future, save_dir) for future, save_dir in futures]
+        except BaseException:
+            # queued conversions are dropped, running sen2cor processes are finished
+            for future, save_dir in futures:
+                if future.cancel() and cache:
+                    cache.unpin(os.path.basename(save_dir))
+            raise
+        finally:
+            products.close()
+            executor.shutdown(wait=True)
+            manifest.close()
+
+        # download events are forwarded to the downloader metrics already
+        recorder.merge(self.downloader.run_metrics)
+        results = ConversionResults(results, recorder.report())
+        logger.info(f"Converted {len(results)} of {len(results.results)} products with {workers} workers")
+        logger.info(f"Finished at {time.strftime('%H:%M:%S', time.gmtime(time.time() - start_time))}")
+        return results
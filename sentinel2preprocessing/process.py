@@ -0,0 +1,130 @@
+import os
+import sys
+import time
+import signal
+import logging
+import threading
+import subprocess
+
+from collections import namedtuple, deque
+from typing import Callable, List, Optional
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+logger = logging.getLogger(__name__)
+logging.basicConfig()
+
+# seconds between SIGTERM and SIGKILL of a timed out process
+KILL_GRACE = 10
+
+# cpu_time: float, user and system seconds, peak_rss: int, bytes, both None where wait4 is not available,
+# tail: list, last output lines
+ProcessUsage = namedtuple('ProcessUsage', 'returncode elapsed cpu_time peak_rss timed_out tail')
+
+
+def _limit_memory(process, memory_limit):
+    # preexec_fn is not safe with worker threads, limit is set right after start and inherited by children
+    if resource is None or not hasattr(resource, 'prlimit'):
+        logger.info("Memory limits are supported on Linux only")
+        return
+    try:
+        resource.prlimit(process.pid, resource.RLIMIT_AS, (memory_limit, memory_limit))
+    except ProcessLookupError:
+        pass
+
+
+def _terminate(process, finished: threading.Event):
+    # the whole process group is stopped, the process is reaped by its runner
+    for sig, grace in ((signal.SIGTERM, KILL_GRACE), (signal.SIGKILL, None)):
+        try:
+            os.killpg(process.pid, sig)
+        except ProcessLookupError:
+            return
+        if grace is not None and finished.wait(grace):
+            return
+
+
+def _exit_code(status) -> int:
+    if os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status)
+    return os.WEXITSTATUS(status)
+
+
+def run_streamed(args: List[str], *, on_line: Optional[Callable[[str], None]] = None,
+                 log_path: Optional[str] = None, timeout: Optional[float] = None,
+                 memory_limit: Optional[int] = None, tail_lines: int = 50) -> ProcessUsage:
+    """
+    Run a process in its own session, its merged stdout and stderr are streamed line by line, not kept in memory
+    :param args: list, command line
+    :param on_line: callable, called with every output line without line break
+    :param log_path: str, file output is appended to
+    :param timeout: float, seconds after which the process group is terminated, default: None, no timeout
+    :param memory_limit: int, address space limit in bytes, default: None, no limit
+    :param tail_lines: int, number of last lines kept for error reports
+    :return: ProcessUsage, resource usage of the process and its waited children
+    """
+    start_time = time.time()
+    process = subprocess.Popen(args,
+                               stdout=subprocess.PIPE,
+                               stderr=subprocess.STDOUT,
+                               universal_newlines=True,
+                               bufsize=1,
+                               start_new_session=True)
+    if memory_limit:
+        _limit_memory(process, memory_limit)
+
+    finished = threading.Event()
+    timed_out = threading.Event()
+    watchdog = None
+    if timeout is not None:
+        def expire():
+            timed_out.set()
+            _terminate(process, finished)
+        watchdog = threading.Timer(timeout, expire)
+        watchdog.daemon = True
+        watchdog.start()
+
+    tail = deque(maxlen=tail_lines)
+    log_file = open(log_path, 'a') if log_path else None
+    try:
+        for line in process.stdout:
+            if log_file:
+                log_file.write(line)
+            line = line.rstrip('\n')
+            tail.append(line)
+            if on_line:
+                try:
+                    on_line(line)
+                except Exception as ex:
+                    # the process must be drained and reaped anyway
+                    logger.info(f"Error in output callback of {args[0]}: {str(ex)}")
+    except BaseException:
+        # interrupted runner, the process is not left behind
+        try:
+            os.killpg(process.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+        raise
+    finally:
+        if log_file:
+            log_file.close()
+        process.stdout.close()
+
+        cpu_time = peak_rss = None
+        if hasattr(os, 'wait4'):
+            _, status, usage = os.wait4(process.pid, 0)
+            process.returncode = _exit_code(status)
+            cpu_time = usage.ru_utime + usage.ru_stime
+            # kilobytes on Linux, bytes on macOS
+            peak_rss = usage.ru_maxrss if sys.platform == 'darwin' else usage.ru_maxrss * 1024
+        else:
+            process.wait()
+        finished.set()
+        if watchdog:
+            watchdog.cancel()
+
+    return ProcessUsage(process.returncode, time.time() - start_time, cpu_time, peak_rss,
+                        timed_out.is_set(), list(tail))
@@ -0,0 +1,306 @@
+import os
+import json
+import time
+import logging
+
+import numpy as np
+
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from itertools import product as cartesian
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple, Union
+
+try:
+    import rasterio
+    from rasterio.enums import Resampling
+    from rasterio.transform import Affine, from_origin
+    from rasterio.vrt import WarpedVRT
+    from rasterio.crs import CRS
+    from rasterio.windows import Window, from_bounds
+except ImportError:
+    rasterio = None
+
+from sentinel2download.products import parse_product_name
+from .cropping import BAND_PATTERN, band_files, band_name
+
+logger = logging.getLogger(__name__)
+logging.basicConfig()
+
+# bump when stack layout changes
+STACK_VERSION = 1
+INDEX_NAME = 'stack.json'
+
+# masks are resampled with nearest neighbour whatever resampling is requested
+MASK_BANDS = frozenset(('CLD', ))
+# multi-band true color image is not stacked
+UNSTACKABLE_BANDS = frozenset(('TCI', ))
+
+# input_path: str, product directory, time: str, sensing time, ex: 20201001T084801,
+# skipped: bool, product is in the stack already, error: str, reason of failure, None on success
+StackResult = namedtuple('StackResult', 'input_path time success skipped error')
+
+
+def _product_name(path) -> str:
+    name = os.path.basename(os.path.normpath(path))
+    return name[:-len('.SAFE')] if name.endswith('.SAFE') else name
+
+
+def _resolution(path) -> int:
+    # bands without resolution suffix have a single resolution in a product
+    return int(BAND_PATTERN.search(os.path.basename(path)).group('resolution') or 0)
+
+
+def _save_index(stack_dir, index):
+    tmp_path = stack_dir / f"{INDEX_NAME}.tmp"
+    tmp_path.write_text(json.dumps(index))
+    os.replace(str(tmp_path), str(stack_dir / INDEX_NAME))
+
+
+class Sentinel2Stack:
+    """
+    Time series of a stack directory with (time, band, y, x) axes.
+    Every time step is a memory-mapped (band, y, x) numpy array, mapped on first access,
+    so reading a window touches only its rows. Reading needs numpy only.
+    """
+
+    def __init__(self, stack_dir: str):
+        """
+        :param stack_dir: str, directory written by Sentinel2Stacker.stack()
+        """
+        self.stack_dir = Path(stack_dir)
+        index = json.loads((self.stack_dir / INDEX_NAME).read_text())
+        if index['version'] != STACK_VERSION:
+            raise ValueError(f"Unsupported stack version {index['version']}, expected {STACK_VERSION}")
+        self.bands = index['bands']
+        self.dtype = np.dtype(index['dtype'])
+        self.height, self.width = index['height'], index['width']
+        # affine coefficients (a, b, c, d, e, f) and WKT of the common grid
+        self.transform = tuple(index['transform'])
+        self.crs = index['crs']
+        self.resolution = index['resolution']
+        self.times = [entry['time'] for entry in index['times']]
+        self.products = [entry['product'] for entry in index['times']]
+        self._files = [entry['file'] for entry in index['times']]
+        self._arrays = dict()
+
+    def __len__(self):
+        return len(self.times)
+
+    @property
+    def shape(self) -> Tuple[int, int, int, int]:
+        return len(self.times), len(self.bands), self.height, self.width
+
+    def array(self, position: int) -> np.ndarray:
+        """
+        :param position: int, time step position
+        :return: np.memmap, read-only (band, y, x) array of the time step
+        """
+        if position not in self._arrays:
+            self._arrays[position] = np.load(str(self.stack_dir / self._files[position]), mmap_mode='r')
+        return self._arrays[position]
+
+    def read(self, *, bands: Optional[Sequence[str]] = None, times: Optional[Union[Sequence[int], slice]] = None,
+             window: Optional[Tuple[int, int, int, int]] = None) -> np.ndarray:
+        """
+        :param bands: list, band names, default: None, all bands
+        :param times: list or slice, time step positions, default: None, all time steps
+        :param window: tuple, (row_off, col_off, height, width) in pixels, default: None, the whole grid
+        :return: np.ndarray, (time, band, y, x) array, only the requested part is read
+        """
+        positions = range(len(self.times))
+        positions = positions[times] if isinstance(times, slice) else (positions if times is None else times)
+        band_positions = [self.bands.index(band) for band in bands] if bands else list(range(len(self.bands)))
+        row_off, col_off, height, width = window or (0, 0, self.height, self.width)
+        result = np.empty((len(positions), len(band_positions), min(height, self.height - row_off),
+                           min(width, self.width - col_off)), dtype=self.dtype)
+        for index, position in enumerate(positions):
+            array = self.array(position)
+            for band_index, band_position in enumerate(band_positions):
+                result[index, band_index] = array[band_position, row_off:row_off + height, col_off:col_off + width]
+        return result
+
+
+def open_stack(stack_dir: str) -> Sentinel2Stack:
+    return Sentinel2Stack(stack_dir)
+
+
+class Sentinel2Stacker:
+    """
+    Class for resampling bands of products to a common grid and storing them once as a time series stack.
+    Bands are warped block by block, memory footprint is bounded by workers and block size, not by tile size.
+    """
+
+    def __init__(self, verbose: bool = False):
+        """
+        :param verbose: bool, flag, print logging information, default: False
+        """
+        if rasterio is None:
+            raise ImportError("rasterio is required for stacking: pip install rasterio")
+        if verbose:
+            logger.setLevel(logging.INFO)
+        else:
+            logger.setLevel(logging.CRITICAL)
+
+    @staticmethod
+    def _select_files(product_path, bands) -> Dict[str, str]:
+        """
+        :return: dict, band name to the file of its finest resolution
+        """
+        files = dict()
+        for path in band_files(product_path, bands):
+            band = band_name(path)
+            if band not in files or _resolution(path) < _resolution(files[band]):
+                files[band] = path
+        return files
+
+    @staticmethod
+    def _new_index(files, bands, resolution) -> dict:
+        # grid covers the extent of the finest band of the first product
+        dtypes = list()
+        extent = None
+        for path in files.values():
+            with rasterio.open(path) as source:
+                if source.count != 1:
+                    raise ValueError(f"Band {path} has {source.count} bands, only single band files are stacked")
+                dtypes.append(source.dtypes[0])
+                if extent is None or source.res[0] < extent[0]:
+                    extent = (source.res[0], source.bounds, source.crs)
+        _, bounds, crs = extent
+        transform = from_origin(bounds.left, bounds.top, resolution, resolution)
+        return dict(version=STACK_VERSION, bands=list(bands), dtype=np.result_type(*dtypes).name,
+                    height=int(round((bounds.top - bounds.bottom) / resolution)),
+                    width=int(round((bounds.right - bounds.left) / resolution)),
+                    transform=list(transform)[:6], crs=crs.to_wkt(), resolution=resolution, times=list())
+
+    @staticmethod
+    def _warp_band(path, array, band_position, index, resampling, block_size):
+        resampling = Resampling.nearest if band_name(path) in MASK_BANDS else Resampling[resampling]
+        transform = Affine(*index['transform'])
+        with rasterio.open(path) as source:
+            if source.crs == CRS.from_wkt(index['crs']):
+                # bands of the stack projection are resampled by decimated reads, cheaper than warping
+                reader = source
+            else:
+                reader = WarpedVRT(source, crs=index['crs'], transform=transform, width=index['width'],
+                                   height=index['height'], resampling=resampling)
+            with reader:
+                rows = range(0, index['height'], block_size)
+                columns = range(0, index['width'], block_size)
+                for row, column in cartesian(rows, columns):
+                    height, width = min(block_size, index['height'] - row), min(block_size, index['width'] - column)
+                    block = Window(column, row, width, height)
+                    if reader is source:
+                        window = from_bounds(*rasterio.windows.bounds(block, transform), transform=source.transform)
+                        # boundless reads are warped, they are used only for blocks beyond the band extent
+                        boundless = (window.col_off < 0 or window.row_off < 0 or
+                                     window.col_off + window.width > source.width or
+                                     window.row_off + window.height > source.height)
+                        data = source.read(1, window=window, out_shape=(height, width), resampling=resampling,
+                                           boundless=boundless, fill_value=source.nodata or 0)
+                    else:
+                        data = reader.read(1, window=block)
+                    array[band_position, row:row + height, column:column + width] = data
+
+    def _stack_product(self, product_path, files, stack_dir, index, resampling, block_size, workers) -> str:
+        file_name = f"{_product_name(product_path)}.npy"
+        part_path = stack_dir / f"{file_name}.part"
+        array = np.lib.format.open_memmap(str(part_path), mode='w+', dtype=index['dtype'],
+                                          shape=(len(index['bands']), index['height'], index['width']))
+        completed = False
+        try:
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                futures = [executor.submit(self._warp_band, files[band], array, position, index, resampling,
+                                           block_size)
+                           for position, band in enumerate(index['bands'])]
+                for future in futures:
+                    future.result()
+            array.flush()
+            completed = True
+        finally:
+            # the memory map is closed before its file is renamed or removed
+            del array
+            if not completed:
+                part_path.unlink()
+        os.replace(str(part_path), str(stack_dir / file_name))
+        return file_name
+
+    def stack(self, input_paths: Union[str, List[str]], stack_dir: str, *,
+              bands: Iterable[str] = ('B02', 'B03', 'B04', 'B08'), resolution: int = 10,
+              resampling: str = 'bilinear', block_size: int = 1024, workers: int = 4,
+              overwrite: bool = False) -> List[StackResult]:
+        """
+        :param input_paths: str or list, product directories (.SAFE folders, granule files or cropped products)
+        of one tile or AOI, their sensing times are the time axis
+        :param stack_dir: str, stack directory, products are appended to an existing stack
+        :param bands: iterable, bands to stack in this order, ex: ('B04', 'B08', 'CLD'), the finest resolution
+        of every band is used, default: ('B02', 'B03', 'B04', 'B08')
+        :param resolution: int, pixel size of the common grid in meters, default: 10
+        :param resampling: str, rasterio resampling method, ex: "bilinear", "average", "nearest", masks are always
+        resampled with "nearest", default: "bilinear"
+        :param block_size: int, size of blocks warped at once in pixels, default: 1024
+        :param workers: int, number of bands warped concurrently, default: 4
+        :param overwrite: bool, stack products again even if they are in the stack, default: False
+        :return: list, StackResult of every product, open the stack with open_stack(stack_dir)
+        """
+        start_time = time.time()
+        if isinstance(input_paths, str):
+            input_paths = [input_paths]
+        bands = list(bands)
+        if set(bands) & UNSTACKABLE_BANDS:
+            raise ValueError(f"Bands {sorted(UNSTACKABLE_BANDS)} can't be stacked")
+        if resampling not in Resampling.__members__:
+            raise ValueError(f"Provide proper resampling: {list(Resampling.__members__)}")
+
+        stack_dir = Path(stack_dir)
+        stack_dir.mkdir(parents=True, exist_ok=True)
+        index = None
+        if (stack_dir / INDEX_NAME).is_file():
+            index = json.loads((stack_dir / INDEX_NAME).read_text())
+            if index['bands'] != bands or index['resolution'] != resolution:
+                raise ValueError(f"Stack {stack_dir} has bands {index['bands']} at {index['resolution']} m")
+
+        results = list()
+        for product_path in input_paths:
+            product = parse_product_name(_product_name(product_path))
+            if product is None:
+                logger.error(f"Skipping {product_path}, it is not a Sentinel-2 product")
+                results.append(StackResult(product_path, None, False, False, "not a Sentinel-2 product"))
+                continue
+            name = _product_name(product_path)
+            stacked = [entry for entry in (index or dict()).get('times', ()) if entry['product'] == name]
+            if stacked and not overwrite:
+                logger.info(f"Skipping {product_path}, it is stacked already")
+                results.append(StackResult(product_path, product.sensing_time, True, True, None))
+                continue
+
+            files = self._select_files(product_path, bands)
+            missing = [band for band in bands if band not in files]
+            if missing:
+                logger.error(f"Skipping {product_path}, bands {missing} are not found")
+                results.append(StackResult(product_path, product.sensing_time, False, False,
+                                           f"bands {missing} are not found"))
+                continue
+
+            try:
+                if index is None:
+                    index = self._new_index(files, bands, resolution)
+                file_name = self._stack_product(product_path, files, stack_dir, index, resampling, block_size,
+                                                workers)
+            except Exception as ex:
+                logger.error(f"Error while stacking {product_path}: {str(ex)}")
+                results.append(StackResult(product_path, product.sensing_time, False, False, str(ex)))
+                continue
+
+            index['times'] = [entry for entry in index['times'] if entry['product'] != name]
+            index['times'].append(dict(time=product.sensing_time, product=name, file=file_name))
+            index['times'].sort(key=lambda entry: (entry['time'], entry['product']))
+            # index is saved after every product, an interrupted run keeps stacked products
+            _save_index(stack_dir, index)
+            logger.info(f"Stacked {product_path} into {stack_dir / file_name}")
+            results.append(StackResult(product_path, product.sensing_time, True, False, None))
+
+        stacked = len([result for result in results if result.success])
+        logger.info(f"Stacked {stacked} of {len(results)} products")
+        logger.info(f"Finished stacking at {time.strftime('%H:%M:%S', time.gmtime(time.time() - start_time))}")
+        return results
@@ -4,9 +4,13 @@ __version__ = '1.1'
 __author__ = 'Quantumobile'
 
 install_requires = ['google-cloud-storage==1.32.0',
+                    'google-crc32c==1.0.0',
                     'geopandas==0.8.1',
                     'Rtree==0.9.4', ]
 
+extras_require = {'async': ['aiohttp>=3.6', ],
+                  'cropping': ['rasterio>=1.2', ], }
+
 setup(
     name='sentinel2tools',
     version=__version__,
@@ -15,7 +19,10 @@ setup(
     url="https://github.com/QuantuMobileSoftware/sentinel2tools/",
     packages=find_packages(),
     install_requires=install_requires,
+    extras_require=extras_require,
     package_data={'sentinel2download': ['grid/*', ]},
+    # grid cache written next to the shapefile when the user cache is not writable
+    exclude_package_data={'sentinel2download': ['grid/*.cache', 'grid/*.cache/*', ]},
     python_requires='>=3.7',
     scripts=['scripts/sen2cor_install.sh']
 )